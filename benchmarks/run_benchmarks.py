@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+'''
+Benchmark suite for pyphe. Each benchmark times one of the computationally expensive functions of pyphe on synthetic data (see synthetic.py) for a range of parameters (pinning density, image resolution, number of plates, ...). Results are saved as json files in benchmarks/results, named by date and git commit, so that runs can be compared over time.
+
+Usage:
+    python benchmarks/run_benchmarks.py                 #Run all benchmarks
+    python benchmarks/run_benchmarks.py --quick         #Only run a small subset of parameters
+    python benchmarks/run_benchmarks.py --filter mask   #Only run benchmarks with "mask" in their name
+    python benchmarks/run_benchmarks.py --compare results/old.json results/new.json
+
+To add a benchmark, write a function that prepares the input data and returns a callable to be timed, and register it with the benchmark decorator together with a list of parameter sets. The function can also return a tuple (callable, info), where info is a dict of additional measurements (e.g. accuracy compared to a reference), which is printed and saved with the results. If info contains target_s (maximum time in seconds) or lazy_modules_loaded (modules that should not have been imported), results that miss the target are flagged and the script exits with status 1.
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+#Benchmark the working tree rather than any installed version of pyphe
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+
+benchmarks = {}
+
+def benchmark(params, quick_params=None):
+    '''Register a benchmark function with a list of parameter dicts. quick_params is the subset run with --quick and defaults to the first parameter set.'''
+    def register(f):
+        benchmarks[f.__name__] = (f, params, quick_params if quick_params is not None else params[:1])
+        return f
+    return register
+
+image_params = [{'density' : d, 'resolution' : r} for d in [96, 384, 1536, 6144] for r in [300, 600, 1200]]
+quick_image_params = [{'density' : 1536, 'resolution' : 600}]
+
+
+###Benchmarks: pyphe-quantify###
+
+@benchmark(image_params, quick_image_params)
+def make_grid_auto(density, resolution):
+    from pyphe import quantify
+    image = quantify.check_and_negate(synthetic.make_plate_image(density=density, resolution=resolution))
+    nrows, ncols = synthetic.densities[density]
+    return lambda: quantify.make_grid_auto(image, '%i-%i'%(nrows, ncols))
+
+@benchmark([{'density' : d, 'resolution' : 600, 'angle' : a} for d in [96, 384, 1536, 6144] for a in [0, 2]],
+           [{'density' : 1536, 'resolution' : 600, 'angle' : 2}])
+def make_grid_affine(density, resolution, angle):
+    '''Affine grid fitting from colony centroids on a rotated plate. Reports the number of colonies matched to the grid.'''
+    from pyphe import quantify
+    from skimage.measure import regionprops
+    from skimage.transform import rotate
+    plate = rotate(synthetic.make_plate_image(density=density, resolution=resolution), angle, preserve_range=True, mode='edge').astype(np.uint8)
+    image = quantify.check_and_negate(plate)
+    props = regionprops(quantify.make_mask(image))
+    labels = [r.label for r in props]
+    centroids = [r.centroid for r in props]
+    grid = '%i-%i'%synthetic.densities[density]
+    matched = quantify.match_to_grid(labels, centroids, *quantify.make_grid_affine(centroids, grid, image.shape))
+    info = {'colonies' : len(labels), 'matched' : len(matched)}
+    return (lambda: quantify.make_grid_affine(centroids, grid, image.shape)), info
+
+@benchmark(image_params, quick_image_params)
+def apply_grid_template(density, resolution):
+    '''Placing a grid fitted on one plate on another plate from the same fixture which is shifted by a few pixels.'''
+    from pyphe import quantify
+    nrows, ncols = synthetic.densities[density]
+    template = quantify.make_grid_template(quantify.check_and_negate(synthetic.make_plate_image(density=density, resolution=resolution)), '%i-%i'%(nrows, ncols), True)
+    image = quantify.check_and_negate(np.roll(synthetic.make_plate_image(density=density, resolution=resolution, seed=1), (3, -5), axis=(0, 1)))
+    return lambda: quantify.apply_grid_template(image, template)
+
+@benchmark(image_params, quick_image_params)
+def make_mask(density, resolution):
+    from pyphe import quantify
+    image = quantify.check_and_negate(synthetic.make_plate_image(density=density, resolution=resolution))
+    return lambda: quantify.make_mask(image)
+
+@benchmark([{'density' : d, 'resolution' : 1200, 'tile_size' : ts} for d in [1536, 6144] for ts in [None, 512, 2048]],
+           [{'density' : 6144, 'resolution' : 1200, 'tile_size' : ts} for ts in [None, 1024]])
+def make_mask_tiled(density, resolution, tile_size):
+    '''Thresholding and labelling of a large image as a whole (tile_size None) or in tiles. Reports the peak memory allocated and whether the labels are the same as without tiles.'''
+    import tracemalloc
+    from pyphe import quantify
+    image = quantify.check_and_negate(synthetic.make_plate_image(density=density, resolution=resolution), dtype=np.float32)
+    f = lambda: quantify.make_mask(image, tile_size=tile_size)
+    tracemalloc.start()
+    labels = f()
+    info = {'peak_memory_MB' : tracemalloc.get_traced_memory()[1]/1e6}
+    tracemalloc.stop()
+    info['same_labels'] = bool(np.array_equal(labels, quantify.make_mask(image))) if tile_size else True
+    return f, info
+
+@benchmark([{'method' : m, 'nplates' : 10, 'resolution' : r} for m in ['otsu', 'histogram', 'pooled'] for r in [600, 1200]],
+           [{'method' : m, 'nplates' : 4, 'resolution' : 600} for m in ['otsu', 'histogram', 'pooled']])
+def plate_thresholds(method, nplates, resolution):
+    '''Otsu thresholds of a batch of 8-bit plate images, per plate on the working images (otsu, the default), per plate from integer histograms (histogram) or pooled for the batch (pooled, --batchThreshold). Reports the largest difference to the default thresholds.'''
+    from pyphe import quantify
+    from skimage.filters import threshold_otsu
+    plates = [synthetic.make_plate_image(density=1536, resolution=resolution, seed=i) for i in range(nplates)]
+    images = [quantify.check_and_negate(p) for p in plates]
+    reference = np.array([threshold_otsu(im) for im in images])
+    if method == 'otsu':
+        f = lambda: [threshold_otsu(im) for im in images]
+    elif method == 'histogram':
+        f = lambda: [quantify.threshold_otsu_histogram(*quantify.intensity_histogram(p)) for p in plates]
+    else:
+        f = lambda: quantify.batch_threshold(('plate%i'%i, p) for i, p in enumerate(plates))[0]
+    return f, {'max_threshold_difference' : float(np.abs(np.array(f()) - reference).max())}
+
+@benchmark([{'method' : m, 'density' : d, 'resolution' : 600} for m in ['convexhull', 'fillholes'] for d in [96, 384, 1536, 6144]] + [{'method' : 'skimage', 'density' : 96, 'resolution' : 600}],
+           [{'method' : m, 'density' : 1536, 'resolution' : 600} for m in ['convexhull', 'fillholes']])
+def fill_holes(method, density, resolution):
+    from pyphe import quantify
+    from skimage.filters import threshold_otsu
+    from skimage.morphology import convex_hull_object
+    image = quantify.check_and_negate(synthetic.make_plate_image(density=density, resolution=resolution))
+    mask = image > threshold_otsu(image)
+    if method == 'convexhull':
+        return lambda: quantify.convex_hull_objects(mask)
+    elif method == 'fillholes':
+        return lambda: quantify.binary_fill_holes(mask)
+    else:
+        #Reference implementation previously used by make_mask
+        return lambda: convex_hull_object(mask)
+
+@benchmark([{'mode' : m, 'dtype' : t, 'resolution' : r} for m in ['batch', 'redness'] for t in ['float64', 'float32'] for r in [600, 1200]],
+           [{'mode' : m, 'dtype' : t, 'resolution' : 1200} for m in ['batch', 'redness'] for t in ['float64', 'float32']])
+def preprocess(mode, dtype, resolution):
+    '''Conversion of a colour plate image to the working image. Reports the peak memory allocated.'''
+    import tracemalloc
+    from pyphe import quantify
+    rgb = np.dstack([synthetic.make_plate_image(density=1536, resolution=resolution)]*3)
+    if mode == 'batch':
+        f = lambda: quantify.check_and_negate(rgb, dtype=dtype)
+    else:
+        f = lambda: quantify.prepare_redness_image(rgb, bgDownsample=4, dtype=dtype)
+    tracemalloc.start()
+    f()
+    info = {'peak_memory_MB' : tracemalloc.get_traced_memory()[1]/1e6}
+    tracemalloc.stop()
+    return f, info
+
+_reference_masks = {}
+
+@benchmark([{'mode' : m, 'factor' : f, 'density' : d, 'resolution' : 600} for m in ['local', 'redness'] for f in [1, 2, 4, 8, 16] for d in [384, 1536]],
+           [{'mode' : m, 'factor' : f, 'density' : 1536, 'resolution' : 600} for m in ['local', 'redness'] for f in [1, 4]])
+def background_downsample(mode, factor, density, resolution):
+    '''Local thresholding and redness background subtraction with the background estimated at reduced resolution. Reports agreement of the resulting mask with the full resolution mask.'''
+    from pyphe import quantify
+    plate = synthetic.make_plate_image(density=density, resolution=resolution)
+    if mode == 'local':
+        image = quantify.check_and_negate(plate)
+        get_mask = lambda f: quantify.make_mask(image, local=True, bgDownsample=f)
+    else:
+        rgb = np.dstack([plate]*3)
+        get_mask = lambda f: quantify.make_mask(quantify.prepare_redness_image(rgb, bgDownsample=f), t=1.02, local=True, bgDownsample=f)
+    
+    key = (mode, density, resolution)
+    if key not in _reference_masks:
+        _reference_masks[key] = get_mask(1) > 0
+    ref = _reference_masks[key]
+    mask = get_mask(factor)
+    info = {'mask_pixels_differing' : float((ref != (mask > 0)).sum()/ref.sum()),
+            'colonies' : int(mask.max()), 'colonies_reference' : int(quantify.label(ref).max())}
+    return (lambda: get_mask(factor)), info
+
+@benchmark(image_params, quick_image_params)
+def match_to_grid(density, resolution):
+    from pyphe import quantify
+    from skimage.measure import regionprops
+    image = quantify.check_and_negate(synthetic.make_plate_image(density=density, resolution=resolution))
+    nrows, ncols = synthetic.densities[density]
+    grid, griddist = quantify.make_grid_auto(image, '%i-%i'%(nrows, ncols))
+    props = regionprops(quantify.make_mask(image))
+    labels = [r.label for r in props]
+    centroids = [r.centroid for r in props]
+    return lambda: quantify.match_to_grid(labels, centroids, grid, griddist)
+
+@benchmark([{'density' : d, 'resolution' : r, 'localBackground' : b} for d in [96, 1536] for r in [300, 600, 1200] for b in [0, 5]],
+           [{'density' : 1536, 'resolution' : 600, 'localBackground' : b} for b in [0, 5]])
+def quantify_timecourse_frame(density, resolution, localBackground):
+    '''Quantification of a single timeseries frame with the mask (and colony and annulus index) of the final frame.'''
+    from pyphe import quantify
+    frames = synthetic.make_timecourse(density=density, resolution=resolution, nframes=2)
+    mask = quantify.make_mask(quantify.check_and_negate(frames[-1]))
+    colony_index = quantify.make_colony_index(mask)
+    annulus_index = quantify.make_annulus_index(mask, colony_index[0], localBackground) if localBackground else None
+    return lambda: quantify.quantify_single_image_fromTimecourse(frames[0], mask, colony_index=colony_index, annulus_index=annulus_index)
+
+@benchmark([{'density' : d, 'resolution' : 300, 'nframes' : 10, 'stack' : st} for d in [96, 1536] for st in [False, True]])
+def quantify_timecourse(density, resolution, nframes, stack):
+    from pyphe import quantify
+    from skimage.io import imsave
+    from skimage.io.collection import ImageCollection
+    tmp = tempfile.mkdtemp()
+    for i, frame in enumerate(synthetic.make_timecourse(density=density, resolution=resolution, nframes=nframes)):
+        imsave(os.path.join(tmp, 'frame%03i.png'%i), frame, check_contrast=False)
+    images = ImageCollection(os.path.join(tmp, '*.png'), conserve_memory=True)
+    nrows, ncols = synthetic.densities[density]
+    #With stack=True, the stack is made in the first run and re-used in all others
+    return lambda: quantify.quantify_timecourse(images, '%i-%i'%(nrows, ncols), True, qc=tmp, out=tmp, stack=stack)
+
+@benchmark([{'fixture' : 'som3', 'resolution' : r, 'method' : m} for r in [300, 600] for m in ['crop', 'raw']],
+           [{'fixture' : 'som3', 'resolution' : 300, 'method' : m} for m in ['crop', 'raw']])
+def quantify_raw_scan(fixture, resolution, method):
+    '''Quantification of all plates of a raw scan, by cropping the plates to jpg files (like pyphe-scan) and quantifying those (crop) or directly from the raw scan (raw).'''
+    from pyphe import quantify, scan
+    from pyphe.fixtures import geometries, scale_geometry
+    from skimage.io.collection import ImageCollection
+    tmp = tempfile.mkdtemp()
+    raw = synthetic.make_raw_scan(fixture=fixture, resolution=resolution)
+    geometry = scale_geometry(geometries[fixture], resolution)
+    grid, auto = quantify.parse_grid('auto_1536')
+    if method == 'crop':
+        crops = [os.path.join(tmp, 'plate%i.jpg'%i) for i in range(len(geometry))]
+        def run_crop():
+            scan.crop_plates(raw, geometry, crops)
+            quantify.quantify_batch(ImageCollection(crops), grid, auto, 'batch', qc=None, out=tmp)
+        return run_crop
+    else:
+        names = ['plate%i'%i for i in range(len(geometry))]
+        return lambda: quantify.quantify_raw_scan(raw, geometry, names, grid, auto, qc=None, out=tmp)
+
+@benchmark([{'nplates' : n, 'format' : f, 'operation' : o} for n in [100, 1000] for f in ['csv', 'store'] for o in ['write', 'read']],
+           [{'nplates' : 100, 'format' : f, 'operation' : o} for f in ['csv', 'store'] for o in ['write', 'read']])
+def result_store(nplates, format, operation):
+    '''Writing the results tables of many 1536 plates as one csv file per plate or into a result store (--store), and reading them back for pyphe-analyse.'''
+    from pyphe import quantify, store
+    from pyphe.analysis import read_quantify_results
+    grid, auto = quantify.parse_grid('auto_1536')
+    data = quantify.quantify_single_image(synthetic.make_plate_image(density=1536, resolution=300), 'plate', grid, auto, 'batch', qc=None, out=None)
+    tmp = tempfile.mkdtemp()
+    names = ['plate%05i.jpg'%i for i in range(nplates)]
+    db = os.path.join(tmp, 'results.db')
+    if format == 'csv':
+        write = lambda: [quantify.save_results(data, None, n, 'batch', qc=None, out=tmp, reportAll=True) for n in names]
+        read = lambda: [read_quantify_results(os.path.join(tmp, n+'.csv')) for n in names]
+    else:
+        write = lambda: [quantify.save_results(data, None, n, 'batch', qc=None, reportAll=True, store=db) for n in names]
+        read = lambda: store.read_data_paths([db+'::'+n for n in names])
+    if operation == 'write':
+        return write
+    write()
+    return read
+
+@benchmark([{'nimages' : 10, 'density' : 96, 'resolution' : 300, 'method' : m} for m in ['cli', 'server']])
+def quantify_many_images(nimages, density, resolution, method):
+    '''Quantification of many small images, each submitted separately, by calling pyphe-quantify once per image (cli) or with pyphe-quantify-client and a server with one worker that is started once (server).'''
+    from skimage.io import imsave
+    tmp = tempfile.mkdtemp()
+    paths = []
+    for i in range(nimages):
+        paths.append(os.path.join(tmp, 'plate%03i.png'%i))
+        imsave(paths[-1], synthetic.make_plate_image(density=density, resolution=resolution, seed=i), check_contrast=False)
+    grid = 'auto_%i-%i'%synthetic.densities[density]
+    env = dict(os.environ, PYTHONPATH=repo_dir)
+    out = ['--out', os.path.join(tmp, 'out'), '--qc', os.path.join(tmp, 'qc')]
+    if method == 'cli':
+        argvs = [[sys.executable, os.path.join(repo_dir, 'bin', 'pyphe-quantify'), 'batch', '--grid', grid, '--pattern', p] + out for p in paths]
+    else:
+        import atexit
+        from pyphe import server
+        port = 6060 + os.getpid()%1000
+        address = ['--address', 'localhost:%i'%port, '--keyfile', os.path.join(tmp, 'server.key')]
+        subprocess.Popen([sys.executable, os.path.join(repo_dir, 'bin', 'pyphe-quantify-server'), '--workers', '1'] + address, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        atexit.register(lambda: subprocess.run([sys.executable, os.path.join(repo_dir, 'bin', 'pyphe-quantify-client'), '--shutdown'] + address, env=env, stdout=subprocess.DEVNULL))
+        for i in range(100):
+            try:
+                server.server_status(('localhost', port), keyfile=os.path.join(tmp, 'server.key'))
+                break
+            except OSError:
+                #Key file not written yet or connection refused
+                time.sleep(0.1)
+        argvs = [[sys.executable, os.path.join(repo_dir, 'bin', 'pyphe-quantify-client'), p, '--grid', grid] + address + out for p in paths]
+    def run_all():
+        for argv in argvs:
+            subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return run_all
+
+
+###Benchmarks: pyphe-analyse###
+
+@benchmark([{'density' : 384, 'grid' : 'standard384'}, {'density' : 1536, 'grid' : 'standard1536'}, {'density' : 1536, 'grid' : '1536with384grid'}])
+def plate_grid_normalisation(density, grid):
+    exp = synthetic.make_experiment(nplates=1, density=density)
+    plate = exp.plates.iloc[0]
+    if grid == 'standard384':
+        gridpos_list = [(row, col) for row in range(1, 16, 2) for col in range(1, 24, 2)]
+    elif grid == 'standard1536':
+        gridpos_list = [(row, col) for row in range(1, 32, 4) for col in range(1, 48, 4)]
+        gridpos_list += [(row, col) for row in range(4, 33, 4) for col in range(4, 49, 4)]
+    else:
+        gridpos_list = [(row, col) for row in range(1, 32, 2) for col in range(1, 48, 2)]
+    return lambda: plate.grid_normalisation(gridpos_list)
+
+@benchmark([{'nplates' : n, 'density' : 1536, 'method' : m} for n in [10, 100] for m in ['plate', 'experiment']])
+def rcmedian_check_values(nplates, density, method):
+    '''Row/column median normalisation and value checks for all plates, either plate by plate or for the whole experiment at once.'''
+    exp = synthetic.make_experiment(nplates=nplates, density=density)
+    if method == 'plate':
+        def f():
+            for p in exp.plates:
+                p.rcmedian_normalisation()
+                p.check_values(negative_action=np.nan, inf_action=np.nan)
+        return f
+    else:
+        def f():
+            exp.rcmedian_normalisation()
+            exp.check_values(negative_action=np.nan, inf_action=np.nan)
+        return f
+
+@benchmark([{'nplates' : n, 'density' : 1536, 'group_by' : g} for n in [100, 1000] for g in [None, 'Batch']], quick_params=[{'nplates' : 100, 'density' : 1536, 'group_by' : 'Batch'}])
+def rcmedian_grouped(nplates, density, group_by):
+    '''Row/column median normalisation of the whole experiment, with row/column effects estimated per plate or jointly for all plates of a batch.'''
+    exp = synthetic.make_experiment(nplates=nplates, density=density)
+    return lambda: exp.rcmedian_normalisation(group_by=group_by)
+
+@benchmark([{'nplates' : n, 'method' : m} for n in [10, 100] for m in ['cubic', 'thinplate']], quick_params=[{'nplates' : 10, 'method' : 'thinplate'}])
+def grid_normalisation(nplates, method):
+    '''Reference grid normalisation of 1536 plates with the standard1536 grid, per plate with cubic interpolation or for the whole experiment with thin-plate splines.'''
+    gridpos_list = [(row, col) for row in range(1, 32, 4) for col in range(1, 48, 4)]
+    gridpos_list += [(row, col) for row in range(4, 33, 4) for col in range(4, 49, 4)]
+    exp = synthetic.make_experiment(nplates=nplates, density=1536)
+    def f():
+        with contextlib.redirect_stdout(io.StringIO()):
+            if method == 'cubic':
+                exp.plates.map(lambda x: x.grid_normalisation(gridpos_list))
+            else:
+                exp.grid_normalisation(gridpos_list)
+    return f
+
+@benchmark([{'nplates' : n, 'group_by' : g} for n in [100, 1000] for g in [None, 'Batch']], quick_params=[{'nplates' : 100, 'group_by' : 'Batch'}])
+def fit_corner_extrapolation(nplates, group_by):
+    '''Fit the standard1536 corner extrapolation regression for all plates, optionally with separate coefficients for each batch.'''
+    exp = synthetic.make_experiment(nplates=nplates, density=1536)
+    return lambda: exp.fit_corner_extrapolation(group_by=group_by)
+
+@benchmark([{'nplates' : n, 'density' : 1536} for n in [10, 100]])
+def experiment_generate_long_data(nplates, density):
+    exp = synthetic.make_experiment(nplates=nplates, density=density)
+    return exp.generate_long_data
+
+
+###Benchmarks: pyphe-growthcurves###
+
+@benchmark([{'ncurves' : n, 'ntimepoints' : 100} for n in [96, 384, 1536]])
+def analyse_growthcurve(ncurves, ntimepoints):
+    from pyphe.growthcurves import analyse_growthcurve
+    gdata = synthetic.make_growthcurves(ncurves=ncurves, ntimepoints=ntimepoints)
+    return lambda: analyse_growthcurve(gdata, 4, 3, 'rel', 2.0, False, None, None, None, False)
+
+
+###Benchmarks: pyphe-interpret###
+
+@benchmark([{'nstrains' : n, 'nconditions' : 10} for n in [100, 1000, 5000]])
+def interpret(nstrains, nconditions):
+    from pyphe.interpret import interpret
+    ld = synthetic.make_data_report(nstrains=nstrains, nconditions=nconditions)
+    out_prefix = os.path.join(tempfile.mkdtemp(), 'interpret')
+    #Test each strain against the control strain within each condition
+    return lambda: interpret(ld.copy(), 'Strain', 'Condition', 'Colony_size_corr_checked', 'strain0', out_prefix)
+
+
+###Benchmarks: start-up###
+
+#Packages which pyphe only imports when they are needed (plotting, statistics, image stacks)
+lazy_modules = ['matplotlib', 'seaborn', 'statsmodels', 'scipy.signal', 'skimage.io']
+
+@benchmark([{'command' : c} for c in ['pyphe-quantify --help', 'pyphe-analyse --help', 'pyphe-interpret --help', 'pyphe-growthcurves --help', 'pyphe-scan --help',
+                                      'import pyphe.quantify', 'import pyphe.analysis', 'import pyphe.interpret', 'import pyphe.pipeline', 'import pyphe.server']],
+           [{'command' : 'pyphe-quantify --help'}, {'command' : 'import pyphe.pipeline'}])
+def startup(command):
+    '''Start-up time of a command line tool (with --help) or of importing a pyphe module in a fresh interpreter. Printing help must take less than target_s and importing pyphe modules must not load any of the lazy_modules.'''
+    env = dict(os.environ, PYTHONPATH=repo_dir)
+    if command.startswith('import'):
+        argv = [sys.executable, '-c', command]
+        check = subprocess.check_output([sys.executable, '-c', command + '; import sys; print(" ".join(m for m in %r if m in sys.modules))'%lazy_modules], env=env)
+        info = {'lazy_modules_loaded' : check.decode().split()}
+    else:
+        script, arg = command.split()
+        argv = [sys.executable, os.path.join(repo_dir, 'bin', script), arg]
+        info = {'target_s' : 0.25}
+    return (lambda: subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, check=True)), info
+
+
+###Running and comparing###
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return 'unknown'
+
+def time_callable(f, repeat):
+    '''Call f repeat times and return the wall time of each call in seconds.'''
+    times = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return times
+
+def check_targets(median, info):
+    '''Check the requirements a benchmark reports in its info: a maximum time (target_s) or lazily imported modules that were loaded anyway (lazy_modules_loaded). Returns a description of the failure or None.'''
+    if not info:
+        return None
+    if 'target_s' in info and median > info['target_s']:
+        return 'ABOVE TARGET'
+    if info.get('lazy_modules_loaded'):
+        return 'EAGER IMPORTS'
+    return None
+
+def run(names, quick=False, repeat=3):
+    results = []
+    for name in names:
+        f, params, quick_params = benchmarks[name]
+        for p in (quick_params if quick else params):
+            to_time = f(**p)
+            info = None
+            if isinstance(to_time, tuple):
+                to_time, info = to_time
+            times = time_callable(to_time, repeat)
+            failed = check_targets(np.median(times), info)
+            results.append({'benchmark' : name, 'params' : p, 'times' : times, 'min' : min(times), 'median' : float(np.median(times)), 'info' : info, 'failed' : failed})
+            print('%-32s %-50s %10.4f s %s %s'%(name, json.dumps(p), np.median(times), json.dumps(info) if info else '', failed or ''))
+            sys.stdout.flush()
+    return results
+
+def compare(old_path, new_path, threshold=1.2):
+    '''Print median times of two result files side by side. Ratios above threshold are flagged as regressions.'''
+    with open(old_path) as fh:
+        old = json.load(fh)
+    with open(new_path) as fh:
+        new = json.load(fh)
+    old_results = {(r['benchmark'], json.dumps(r['params'], sort_keys=True)) : r['median'] for r in old['results']}
+
+    print('Comparing %s (%s) to %s (%s)'%(old_path, old['commit'], new_path, new['commit']))
+    print('%-32s %-50s %10s %10s %7s'%('benchmark', 'params', 'old [s]', 'new [s]', 'ratio'))
+    nregressions = 0
+    for r in new['results']:
+        key = (r['benchmark'], json.dumps(r['params'], sort_keys=True))
+        if key not in old_results:
+            continue
+        ratio = r['median']/old_results[key]
+        flag = ''
+        if ratio > threshold:
+            flag = 'SLOWER'
+            nregressions += 1
+        elif ratio < 1/threshold:
+            flag = 'faster'
+        print('%-32s %-50s %10.4f %10.4f %7.2f %s'%(key[0], key[1], old_results[key], r['median'], ratio, flag))
+    return nregressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pyphe benchmark suite on synthetic data.')
+    parser.add_argument('--filter', type=str, default='', help='Only run benchmarks whose name contains this string.')
+    parser.add_argument('--quick', default=False, action='store_true', help='Only run a small subset of parameters for each benchmark.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times each benchmark is timed. Defaults to 3.')
+    parser.add_argument('--out', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results'), help='Folder to save results in. Defaults to benchmarks/results.')
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files instead of running benchmarks.')
+    args = parser.parse_args()
+
+    if args.compare:
+        nregressions = compare(*args.compare)
+        sys.exit(1 if nregressions > 0 else 0)
+
+    names = [n for n in benchmarks if args.filter in n]
+    results = run(names, quick=args.quick, repeat=args.repeat)
+
+    if not os.path.exists(args.out):
+        os.mkdir(args.out)
+    commit = get_commit()
+    out_path = os.path.join(args.out, '%s_%s.json'%(datetime.now().strftime('%Y%m%d-%H%M%S'), commit))
+    with open(out_path, 'w') as fh:
+        json.dump({'commit' : commit, 'date' : str(datetime.now()), 'quick' : args.quick, 'repeat' : args.repeat,
+                   'python' : platform.python_version(), 'numpy' : np.__version__, 'machine' : platform.platform(),
+                   'results' : results}, fh, indent=1)
+    print('Results saved to %s'%out_path)
+
+    nfailed = sum(1 for r in results if r['failed'])
+    if nfailed > 0:
+        print('%i benchmarks did not meet their targets'%nfailed)
+        sys.exit(1)
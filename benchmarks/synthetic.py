@@ -0,0 +1,134 @@
+'''
+Generators for synthetic pyphe input data used by the benchmarks: plate images, image timeseries, colony size tables, data reports and growth curves. All generators are deterministic for a given seed.
+'''
+
+import numpy as np
+import pandas as pd
+
+#Colony rows and columns for the supported pinning densities
+densities = {96 : (8, 12), 384 : (16, 24), 1536 : (32, 48), 6144 : (64, 96)}
+
+#Plate image size in pixels at 600 dpi, as cropped by pyphe-scan with the som3 fixture
+plate_shape_600dpi = (1726, 2603)
+
+
+def plate_shape(resolution):
+    '''Return the (height, width) of a plate image at the given resolution in dpi.'''
+    return tuple(int(x*resolution/600.0) for x in plate_shape_600dpi)
+
+def make_plate_image(density=1536, resolution=600, growth=1.0, missing=0.02, seed=0):
+    '''
+    Make a synthetic plate image as acquired by transmission scanning: dark, round colonies on a light background with uneven illumination and noise. Colonies are arranged in a regular grid with a margin of half a grid spacing.
+
+    Keyword arguments:
+    density (int) -- Number of colonies, one of 96, 384, 1536 or 6144.
+    resolution (int) -- Scanning resolution in dpi, determines the image size.
+    growth (float) -- Scales all colony radii, useful for making timeseries.
+    missing (float) -- Fraction of grid positions without a colony.
+    seed (int) -- Random seed.
+
+    Returns:
+    image (ndarray) -- 2D uint8 array.
+    '''
+
+    rng = np.random.RandomState(seed)
+    nrows, ncols = densities[density]
+    h, w = plate_shape(resolution)
+    sy, sx = h/float(nrows), w/float(ncols)
+
+    #Colony radii, fixed by seed so that timeseries frames are consistent
+    radii = 0.35 * min(sy, sx) * rng.uniform(0.6, 1.0, size=(nrows, ncols))
+    radii[rng.uniform(size=(nrows, ncols)) < missing] = 0
+    radii = (radii * growth).astype(np.float32)
+
+    #Distance of each pixel to its nearest grid position
+    yy = np.arange(h, dtype=np.float32)/sy - 0.5
+    xx = np.arange(w, dtype=np.float32)/sx - 0.5
+    ri = np.clip(np.round(yy), 0, nrows-1).astype(int)
+    ci = np.clip(np.round(xx), 0, ncols-1).astype(int)
+    dy = ((yy - ri) * sy)[:,None]
+    dx = ((xx - ci) * sx)[None,:]
+    dist = np.sqrt(dy**2 + dx**2)
+
+    #Colonies with a soft edge of about 2 pixels
+    colony = np.clip((radii[ri][:,ci] - dist)/2.0 + 0.5, 0, 1)
+
+    #Background with an illumination gradient across the plate
+    background = 200 - 20*np.linspace(0, 1, w, dtype=np.float32)[None,:] - 10*np.linspace(0, 1, h, dtype=np.float32)[:,None]
+    image = background - 120*colony + rng.normal(0, 3, size=(h, w)).astype(np.float32)
+
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+def make_timecourse(density=1536, resolution=600, nframes=10, seed=0):
+    '''Make a list of synthetic plate images with growing colonies. The final frame has fully grown colonies.'''
+    return [make_plate_image(density=density, resolution=resolution, growth=g, seed=seed) for g in np.linspace(0.2, 1, nframes)]
+
+def make_colony_sizes(density=1536, seed=0):
+    '''
+    Make a table of colony sizes for a single plate (rows and columns as string index, like Plate.pos_data) with spatial row/column effects, edge effects and some missing colonies.
+    '''
+
+    rng = np.random.RandomState(seed)
+    nrows, ncols = densities[density]
+    sizes = rng.lognormal(np.log(1000), 0.2, size=(nrows, ncols))
+    sizes *= np.linspace(0.8, 1.2, ncols)[None,:]
+    sizes *= np.linspace(1.1, 0.9, nrows)[:,None]
+    sizes[[0,-1],:] *= 1.3
+    sizes[:,[0,-1]] *= 1.3
+    sizes[rng.uniform(size=sizes.shape) < 0.01] = 0
+
+    return pd.DataFrame(sizes, index=map(str, range(1, nrows+1)), columns=map(str, range(1, ncols+1)))
+
+def make_experiment(nplates=100, density=1536, seed=0):
+    '''
+    Make a pyphe Experiment with synthetic colony sizes and layouts. Half of the plates are assigned to each of two batches (EDT column Batch).
+    '''
+    from pyphe.analysis import Experiment
+
+    nrows, ncols = densities[density]
+    exp_data = pd.DataFrame({'Batch' : ['b%i'%(i%2) for i in range(nplates)], 'Condition' : ['c%i'%(i%4) for i in range(nplates)]}, index=['p%i'%i for i in range(nplates)])
+    exp = Experiment(exp_data)
+    layout = pd.DataFrame([['strain%i'%(r*ncols+c) for c in range(ncols)] for r in range(nrows)], index=map(str, range(1, nrows+1)), columns=map(str, range(1, ncols+1)))
+    for i, (pid, p) in enumerate(exp.plates.items()):
+        p.pos_data['Colony_size'] = make_colony_sizes(density=density, seed=seed+i)
+        p.pos_data['Strain'] = layout
+
+    return exp
+
+def make_data_report(nstrains=1000, nconditions=10, nreps=4, seed=0):
+    '''Make a synthetic long data report as produced by pyphe-analyse, with columns Strain, Condition, Plate, Colony_size_corr_checked and Colony_circularity.'''
+
+    rng = np.random.RandomState(seed)
+    n = nstrains*nconditions*nreps
+    ld = pd.DataFrame({'Strain' : np.tile(np.repeat(['strain%i'%i for i in range(nstrains)], nreps), nconditions),
+                       'Condition' : np.repeat(['c%i'%i for i in range(nconditions)], nstrains*nreps),
+                       'Plate' : ['p%i'%i for i in rng.randint(0, n//1536+1, size=n)],
+                       'Colony_size_corr_checked' : rng.lognormal(0, 0.2, size=n),
+                       'Colony_circularity' : rng.uniform(0.8, 1, size=n)})
+
+    return ld
+
+def make_growthcurves(ncurves=384, ntimepoints=100, seed=0):
+    '''Make a table of logistic growth curves in the format read by pyphe-growthcurves (timepoints as index, one curve per column).'''
+
+    rng = np.random.RandomState(seed)
+    t = np.linspace(0, 48, ntimepoints)
+    rates = rng.uniform(0.2, 0.5, size=ncurves)
+    lags = rng.uniform(4, 12, size=ncurves)
+    curves = 50 + 1000/(1 + np.exp(-rates[None,:]*(t[:,None] - lags[None,:] - 10)))
+    curves += rng.normal(0, 5, size=curves.shape)
+
+    return pd.DataFrame(curves, index=t, columns=['%i-%i'%(i//24+1, i%24+1) for i in range(ncurves)])
+
+def make_raw_scan(fixture='som3', density=1536, resolution=600, seed=0):
+    '''Make a synthetic raw scan of a fixture as acquired by pyphe-scan, with a synthetic plate image (see make_plate_image) in each bay and a dark fixture around them.'''
+    from pyphe.fixtures import geometries, scale_geometry, parse_geometry
+
+    bays = [parse_geometry(g) for g in scale_geometry(geometries[fixture], resolution)]
+    raw = np.full((max(y+h for w, h, x, y in bays), max(x+w for w, h, x, y in bays)), 30, dtype=np.uint8)
+    for i, (w, h, x, y) in enumerate(bays):
+        plate = make_plate_image(density=density, resolution=resolution, seed=seed+i)
+        #Plates are cropped rotated by 90 degrees, see scan.crop_plates
+        raw[y:y+h, x:x+w] = plate[:w, :h].T
+
+    return raw
@@ -1,13 +1,11 @@
 import pandas as pd
+import warnings
 from warnings import warn
 import os
 from scipy import interpolate
+from functools import lru_cache
 import numpy as np
-
-from matplotlib.backends.backend_pdf import PdfPages
-from matplotlib import pyplot as plt
-import seaborn as sns
-sns.set_style('white')
+from pyphe.store import split_data_path, read_data_paths, list_images
 
 class Experiment():
     '''
@@ -54,6 +52,226 @@ plates - A pandas Series of Plate objects, the index is identical to exp_data
 
         return summary_long
 
+    def _stack_pos_data(self, key, plates=None):
+        '''Stack pos_data[key] of all plates (or the given subset of plates) into a single plates x rows x columns array. Plates are aligned by their row and column labels, positions missing on a plate are nan.
+        Returns:
+        stacked (ndarray) -- 3D float array
+        rows (Index) -- Row labels of the stacked array
+        cols (Index) -- Column labels of the stacked array
+        '''
+        
+        if plates is None:
+            plates = self.plates
+        frames = [p.pos_data[key] for p in plates]
+        rows, cols = frames[0].index, frames[0].columns
+        for f in frames[1:]:
+            #Usually all plates have the same layout
+            if not f.index.equals(rows):
+                rows = rows.append(f.index[~f.index.isin(rows)])
+            if not f.columns.equals(cols):
+                cols = cols.append(f.columns[~f.columns.isin(cols)])
+        
+        stacked = np.full((len(frames), len(rows), len(cols)), np.nan)
+        for i, f in enumerate(frames):
+            if f.index.equals(rows) and f.columns.equals(cols):
+                stacked[i] = f.values
+            else:
+                stacked[i][np.ix_(rows.get_indexer(f.index), cols.get_indexer(f.columns))] = f.values
+        return stacked, rows, cols
+
+    def _unstack_pos_data(self, stacked, rows, cols, key, like, plates=None):
+        '''Store a stacked array (as returned by _stack_pos_data) as pos_data[key] of each plate, with the same rows and columns as pos_data[like].'''
+        
+        if plates is None:
+            plates = self.plates
+        for i, p in enumerate(plates):
+            f = p.pos_data[like]
+            p.pos_data[key] = pd.DataFrame(stacked[i][np.ix_(rows.get_indexer(f.index), cols.get_indexer(f.columns))], index=f.index, columns=f.columns)
+
+    def rcmedian_normalisation(self, inkey='Colony_size', outkey='Colony_size_corr', group_by=None):
+        '''Apply row/column median normalisation to all plates at once. Without group_by, each plate is normalised by its own row/column medians, which gives identical results to calling Plate.rcmedian_normalisation for each plate but is much faster for large experiments. 
+        With group_by, row/column effects are estimated jointly for all plates which share the same value in that exp_data column (e.g. scan date or scanner bay). Each plate is first scaled by its median, then row and column medians are taken across all plates of the group. This smooths out noise in the row/column medians of sparse or low density plates. Finally, each plate is scaled to a median of 1.
+
+        Required aguments:
+        inkey (str) -- The key in pos_data which to use as input
+        outkey (str) -- The key in pos_data under which to store the result
+        Keyword arguments:
+        group_by (str) -- Column in exp_data by which to group plates for estimating row/column effects. Defaults to None (no grouping).
+        Returns:
+        None
+        '''
+        
+        stacked, rows, cols = self._stack_pos_data(inkey)
+        with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+            #All-nan rows/columns/plates have nan medians, just like in pandas
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            if group_by is None:
+                row_medians = np.nanmedian(stacked, axis=2)
+                col_medians = np.nanmedian(stacked, axis=1)
+            else:
+                scaled = stacked / np.nanmedian(stacked.reshape(len(stacked), -1), axis=1)[:,None,None]
+                groups, group_idx = np.unique(self.exp_data[group_by].astype(str).values, return_inverse=True)
+                row_medians = np.empty(stacked.shape[:2])
+                col_medians = np.empty((len(stacked), stacked.shape[2]))
+                for g in range(len(groups)):
+                    in_group = group_idx == g
+                    row_medians[in_group] = np.nanmedian(scaled[in_group].transpose(1,0,2).reshape(len(rows), -1), axis=1)
+                    col_medians[in_group] = np.nanmedian(scaled[in_group].transpose(2,0,1).reshape(len(cols), -1), axis=1)
+            normed = stacked / row_medians[:,:,None]
+            normed = normed / col_medians[:,None,:]
+            normed = normed / np.nanmedian(normed.reshape(len(normed), -1), axis=1)[:,None,None]
+        self._unstack_pos_data(normed, rows, cols, outkey, inkey)
+
+    def check_values(self, inkey='Colony_size_corr', outkey='Colony_size_corr_checked', negative_action=0, inf_action=10):
+        '''Check for and deal with invalid values (see Plate.check_values) in all plates at once. Gives identical results to calling the Plate method for each plate. Instead of printing invalid positions for each plate, a table of all invalid positions is returned.
+
+        Keyworkd arguments:
+        inkey (str) -- The data to use (must be a key in exp.plates.pos_data)
+        negative_action (float) -- Value to assign to negative fitness. Defaults to 0. np.nan is allowed too. Set to None if no action required.
+        inf_action (float) -- Value to assign to inf values. Defaults to 10. np.nan is allowed too. Set to None if no action required.
+
+        Returns:
+        report (DataFrame) -- One line for each invalid value with columns Plate, Row, Column, Value and Problem (negative, -inf or inf). Plate pos_data is modified in place.
+        '''
+        
+        #Plates without any data are only given an empty output DataFrame
+        empty = [p.pos_data[inkey].empty for p in self.plates]
+        for p, e in zip(self.plates, empty):
+            if e:
+                p.pos_data[outkey] = pd.DataFrame([[]])
+        if all(empty):
+            return pd.DataFrame(columns=['Plate', 'Row', 'Column', 'Value', 'Problem'])
+        
+        full = self.plates[[not e for e in empty]]
+        stacked, rows, cols = self._stack_pos_data(inkey, plates=full)
+        
+        #Report
+        with np.errstate(invalid='ignore'):
+            pi, ri, ci = np.nonzero(np.isinf(stacked) | (stacked < 0))
+        values = stacked[pi, ri, ci]
+        report = pd.DataFrame({'Plate' : full.index[pi], 'Row' : rows[ri], 'Column' : cols[ci], 'Value' : values,
+                               'Problem' : np.where(np.isneginf(values), '-inf', np.where(np.isposinf(values), 'inf', 'negative'))})
+        
+        #Actions
+        if inf_action is not None:
+            inf_action = float(inf_action)
+            if pd.isnull(inf_action):
+                stacked[np.isinf(stacked)] = inf_action
+            else:
+                stacked[np.isneginf(stacked)] = -inf_action
+                stacked[np.isposinf(stacked)] = inf_action
+            self._unstack_pos_data(stacked, rows, cols, inkey, inkey, plates=full)
+        
+        if negative_action is not None:
+            negative_action = float(negative_action)
+            with np.errstate(invalid='ignore'):
+                stacked[np.isfinite(stacked) & (stacked < 0)] = negative_action
+            self._unstack_pos_data(stacked, rows, cols, outkey, inkey, plates=full)
+        
+        return report
+
+    def fit_corner_extrapolation(self, inkey='Colony_size', group_by=None):
+        '''Fit the linear regression used to extrapolate the bottom left and top right corners of standard1536 grids (see Plate.grid_normalisation). The top left and bottom right corner colonies of all plates are predicted from their horizontal and vertical grid neighbours by ordinary least squares. Corners with missing values are left out.
+
+        Keyword arguments:
+        inkey (str) -- The key in pos_data which to use as input. Defaults to Colony_size.
+        group_by (str) -- Column in exp_data by which to group plates, fitting separate coefficients for each group. Defaults to None (one fit for all plates).
+
+        Returns:
+        coefs (DataFrame) -- One row per group (a single row named 'all' if group_by is None) with columns horizontal_neighbour_coeff, vertical_neighbour_coeff, intercept_coeff, r2 and n (number of corners used for fitting).
+        '''
+        
+        stacked, rows, cols = self._stack_pos_data(inkey)
+        #This corner, horizontal neighbour, vertical neighbour for top left and bottom right corners
+        corners = [[('1','1'), ('1','5'), ('5','1')], [('32','48'), ('32','44'), ('28','48')]]
+        idx = np.array([[(rows.get_loc(r), cols.get_loc(c)) for r, c in corner] for corner in corners])
+        vals = stacked[:, idx[:,:,0], idx[:,:,1]]
+        
+        groups = self.exp_data[group_by].values if group_by else np.full(len(stacked), 'all')
+        coefs = pd.DataFrame(columns=['horizontal_neighbour_coeff', 'vertical_neighbour_coeff', 'intercept_coeff', 'r2', 'n'], dtype=float)
+        for g in pd.unique(groups):
+            gvals = vals[groups == g].reshape(-1, 3)
+            gvals = gvals[~np.isnan(gvals).any(axis=1)]
+            if len(gvals) < 3:
+                raise ValueError('Not enough corners for extrapolating corners in group %s, at least two plates with complete corners are required'%g)
+            X = np.column_stack([gvals[:,1], gvals[:,2], np.ones(len(gvals))])
+            beta = np.linalg.lstsq(X, gvals[:,0], rcond=None)[0]
+            residuals = gvals[:,0] - X @ beta
+            r2 = 1 - (residuals**2).sum() / ((gvals[:,0] - gvals[:,0].mean())**2).sum()
+            coefs.loc[g] = [beta[0], beta[1], beta[2], r2, len(gvals)]
+        return coefs
+
+    def grid_normalisation(self, gridpos_list, inkey='Colony_size', outkey='Colony_size_corr', set_missing_nan=True, remove_grid_outliers=False, k=3):
+        '''Apply reference-grid normalisation to all plates at once, interpolating the grid with a thin-plate spline instead of the piecewise cubic interpolation used by Plate.grid_normalisation. The thin-plate spline is a linear operator from grid values to all positions, so it is computed only once for a grid layout and all plates are interpolated together (see thin_plate_interpolation). The spline also extrapolates smoothly beyond the convex hull of the grid, so the corners of standard1536 plates do not need to be extrapolated separately.
+        Grid colonies which are nan or 0, outlier removal and the Near_missing_grid, Grid and Reference_surface outputs are handled as in Plate.grid_normalisation.
+
+        Required arguments:
+        gridpos_list (list) -- list of two-length tuples, containing row and column positions as integers)
+
+        Keyword arguments:
+        set_missing_nan (bool) - Set colonies near grid positions which are 0 or nan (usually indicating pinning errors) to nan (Recommended).
+        inkey (str) -- The key in pos_data which to use as input. Defaults to Colony_size.
+        outkey (str) -- The key in pos_data under which to store the result. Defaults to Colony_size_corr.
+        remove_grid_outliers (bool) -- Remove grid outliers with a z-score of more than k, if they are not on the edge.
+        k (float) -- Grid positions with a Z-score of greater than k will be removed from grid. Only required when remove_grid_outliers is True, otherwise ignored.
+
+        Returns:
+        None
+        '''
+        
+        stacked, rows, cols = self._stack_pos_data(inkey)
+        nplates, nrows, ncols = stacked.shape
+        grid_rows = rows.get_indexer([str(r) for r, c in gridpos_list])
+        grid_cols = cols.get_indexer([str(c) for r, c in gridpos_list])
+        if (grid_rows < 0).any() or (grid_cols < 0).any():
+            raise ValueError('Some grid positions are not on the plates')
+        
+        #Coordinates of grid positions and of all positions, by row and column label
+        gridpos = np.array(gridpos_list, dtype=float)
+        positions = np.array([(int(r), int(c)) for r in rows for c in cols], dtype=float)
+        
+        #Look for grid colonies that are nan or 0 and mark them and their neighbours
+        grid = stacked[:, grid_rows, grid_cols]
+        missing = np.isnan(grid) | (grid == 0)
+        grid[missing] = np.nan
+        neighbours = (np.abs(gridpos[:,None,:] - positions[None,:,:]) <= 1).all(axis=2)
+        na_mask = (missing.astype(float) @ neighbours > 0).reshape(stacked.shape)
+        self._unstack_pos_data(na_mask, rows, cols, 'Near_missing_grid', inkey)
+        for p in self.plates:
+            p.pos_data['Near_missing_grid'] = p.pos_data['Near_missing_grid'].astype(bool)
+        
+        if missing.any():
+            if set_missing_nan:
+                print('%i grid colonies on %i plates have size 0, probably due to pinning errors. These and neighbouring colonies will be set to nan.'%(missing.sum(), missing.any(axis=1).sum()))
+            else:
+                print('%i grid colonies on %i plates have size 0, probably due to pinning errors. I will ignore this for now and interpolate grid values based on surrounding grid colonies. However, it is recommended that you set these to nan. Affected colonies are marked in the Near_missing_grid column.'%(missing.sum(), missing.any(axis=1).sum()))
+        
+        if remove_grid_outliers:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                z_scores = (grid - np.nanmean(grid, axis=1)[:,None]) / np.nanstd(grid, axis=1, ddof=1)[:,None]
+            #Whatever the z-score, dont remove grid positions on edges of plate
+            on_edge = np.isin(grid_rows, [0, nrows-1]) | np.isin(grid_cols, [0, ncols-1])
+            with np.errstate(invalid='ignore'):
+                z_score_mask = (np.abs(z_scores) > k) & ~on_edge[None,:]
+            grid[z_score_mask] = np.nan
+            print('Removed %i outlier grid colonies from %i plates'%(z_score_mask.sum(), z_score_mask.any(axis=1).sum()))
+        
+        grid_stacked = np.full(stacked.shape, np.nan)
+        grid_stacked[:, grid_rows, grid_cols] = grid
+        self._unstack_pos_data(grid_stacked, rows, cols, 'Grid', inkey)
+        
+        #Interpolate, the spline passes through the grid values but avoid rounding errors at the grid positions themselves
+        ref_surface = thin_plate_interpolation(gridpos, grid, positions).reshape(stacked.shape)
+        ref_surface[:, grid_rows, grid_cols] = np.where(np.isnan(grid), ref_surface[:, grid_rows, grid_cols], grid)
+        self._unstack_pos_data(ref_surface, rows, cols, 'Reference_surface', inkey)
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr_data = stacked / ref_surface
+        if set_missing_nan:
+            corr_data[na_mask] = np.nan
+        self._unstack_pos_data(corr_data, rows, cols, outkey, inkey)
+
     def batch_gitter(self, plate_format, grid_image_folder='grid_images', dat_file_folder='dat_files', inverse='TRUE', remove_noise='TRUE', autorotate='FALSE', gitter_script_name='gitter_script.R'):
         '''
         Wrapper script for gitter. The Experiment object's exp_data must have an Image_path column for this to work.
@@ -89,6 +307,84 @@ plates - A pandas Series of Plate objects, the index is identical to exp_data
         print('Gitter script created, please run the following command: Rscript %s'%gitter_script_name)
 
 
+def _thin_plate_kernel(d):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(d > 0, d**2 * np.log(d), 0.0)
+
+@lru_cache(maxsize=8)
+def _thin_plate_system(gridpos, positions):
+    '''Kernel matrices of the thin-plate spline for a grid layout: the system matrix (grid kernel plus linear polynomial terms) and the evaluation matrix for all positions.'''
+    gridpos = np.array(gridpos, dtype=float).reshape(-1, 2)
+    positions = np.array(positions, dtype=float).reshape(-1, 2)
+    n = len(gridpos)
+    system = np.zeros((n+3, n+3))
+    system[:n,:n] = _thin_plate_kernel(np.sqrt(((gridpos[:,None,:] - gridpos[None,:,:])**2).sum(axis=2)))
+    system[:n,n] = system[n,:n] = 1
+    system[:n,n+1:] = gridpos
+    system[n+1:,:n] = gridpos.T
+    evaluation = np.hstack([_thin_plate_kernel(np.sqrt(((positions[:,None,:] - gridpos[None,:,:])**2).sum(axis=2))), np.ones((len(positions), 1)), positions])
+    return system, evaluation
+
+def _thin_plate_solve(system, evaluation, present, values):
+    '''Fit thin-plate splines to the values (k x present grid colonies) and evaluate them at all positions. Returns nan if there are too few grid colonies.'''
+    n = len(present)
+    keep = np.concatenate([np.flatnonzero(present), np.arange(n, n+3)])
+    rhs = np.vstack([values.T, np.zeros((3, values.shape[0]))])
+    try:
+        coefs = np.linalg.solve(system[np.ix_(keep, keep)], rhs)
+    except np.linalg.LinAlgError:
+        #Fewer than three grid colonies or all on one line
+        return np.full((values.shape[0], len(evaluation)), np.nan)
+    return (evaluation[:, keep] @ coefs).T
+
+@lru_cache(maxsize=8)
+def _grid_interpolation_weights(gridpos, positions):
+    system, evaluation = _thin_plate_system(gridpos, positions)
+    weights = _thin_plate_solve(system, evaluation, np.ones(len(gridpos), dtype=bool), np.eye(len(gridpos))).T
+    weights.flags.writeable = False
+    return weights
+
+def grid_interpolation_weights(gridpos, positions):
+    '''
+    Compute the thin-plate spline interpolation from grid positions to arbitrary positions as a weight matrix. The interpolated values for a vector of grid values v are weights @ v. The spline passes through all grid values and extrapolates smoothly beyond the grid. Results are cached, so the weights for a given grid layout are only computed once.
+
+    Required arguments:
+    gridpos (ndarray) -- n x 2 array of row and column coordinates of the grid colonies.
+    positions (ndarray) -- m x 2 array of row and column coordinates of the positions to interpolate.
+
+    Returns:
+    weights (ndarray) -- m x n array (read-only).
+    '''
+    return _grid_interpolation_weights(tuple(map(tuple, gridpos)), tuple(map(tuple, positions)))
+
+def thin_plate_interpolation(gridpos, values, positions):
+    '''
+    Interpolate grid values of many plates with thin-plate splines. Plates with all grid values present are interpolated with the precomputed weights (see grid_interpolation_weights). For all plates sharing the same pattern of missing (nan) grid values, the spline is fitted by a single linear solve using the cached kernel matrices of the layout.
+
+    Required arguments:
+    gridpos (ndarray) -- n x 2 array of row and column coordinates of the grid colonies.
+    values (ndarray) -- k x n array of grid values for k plates, nan where missing.
+    positions (ndarray) -- m x 2 array of row and column coordinates of the positions to interpolate.
+
+    Returns:
+    interpolated (ndarray) -- k x m array. All nan for plates with fewer than three grid values.
+    '''
+    gridpos = tuple(map(tuple, gridpos))
+    positions = tuple(map(tuple, positions))
+    system, evaluation = _thin_plate_system(gridpos, positions)
+    
+    present = ~np.isnan(values)
+    interpolated = np.empty((len(values), len(positions)))
+    patterns, pattern_idx = np.unique(present, axis=0, return_inverse=True)
+    for i, pattern in enumerate(patterns):
+        in_pattern = pattern_idx.ravel() == i
+        if pattern.all():
+            interpolated[in_pattern] = values[in_pattern] @ _grid_interpolation_weights(gridpos, positions).T
+        else:
+            interpolated[in_pattern] = _thin_plate_solve(system, evaluation, pattern, values[np.ix_(in_pattern, pattern)])
+    return interpolated
+
+
 class Plate():
     '''This object holds all data for a single plate. Two empty, all-purpose pandas series are initilased to hold the bulk of the data associated with the Plate object: Plate.meta_data can be used to store meta data of all sorts and these will be included in the output report. Plate.pos_data is used to store pandas dataframes that have the same shape as the gridformat and are used to store actual growth data and analysis results.
     Keyword arguments:
@@ -119,10 +415,13 @@ class Plate():
         circularity.columns = circularity.columns.map(str)
         self.pos_data['Colony_circularity'] = circularity
         
-    def read_pypheredness_single_image(self):
-        '''Read  column from pyphe-quantify redness output file'''
+    def read_pypheredness_single_image(self, data=None):
+        '''Read  column from pyphe-quantify redness output file, or from a result store if Data_path is <store>::<image name>. Alternatively, a results table returned by the pyphe.quantify functions can be given as data and is used instead of reading the file.'''
         
-        dat = pd.read_csv(self.meta_data['Data_path'])
+        if data is None:
+            dat = read_quantify_results(self.meta_data['Data_path'])
+        else:
+            dat = data[['row', 'column', 'mean_intensity', 'circularity']].apply(pd.to_numeric)
 
         size = dat.pivot(index='row', columns='column', values='mean_intensity')
         size.index.name = None
@@ -138,10 +437,13 @@ class Plate():
         circularity.columns = circularity.columns.map(str)
         self.pos_data['Colony_circularity'] = circularity
     
-    def read_pyphebatch_single_image(self):
-        '''Read  column from pyphe-quantify redness output file'''
+    def read_pyphebatch_single_image(self, data=None):
+        '''Read  column from pyphe-quantify batch output file, or from a result store if Data_path is <store>::<image name>. Alternatively, a results table returned by the pyphe.quantify functions can be given as data and is used instead of reading the file.'''
         
-        dat = pd.read_csv(self.meta_data['Data_path'])
+        if data is None:
+            dat = read_quantify_results(self.meta_data['Data_path'])
+        else:
+            dat = data[['row', 'column', 'area', 'circularity']].apply(pd.to_numeric)
 
         size = dat.pivot(index='row', columns='column', values='area')
         size.index.name = None
@@ -180,17 +482,20 @@ class Plate():
                 self.pos_data[c] = tf.astype(float)
                 
         
-    def read_layout_single_plate(self, kwargs={'header':None}):
-        '''Read the layout of a single file in wide format. This is essentially a wrapper for pandas' read_csv() function which will store returned DataFrame in the pos_data Series of the plate instance. The path of the layout file needs to be provided in the exp_data file in a column named Layout_path. The layout file should not have any header or index information but this can be overriden by supplying keyword arguments as a dictionary to the kwargs argument. Any keyword arguments provided will be passed to pandas' read_csv() function.'''
+    def read_layout_single_plate(self, kwargs={'header':None}, layout=None):
+        '''Read the layout of a single file in wide format. This is essentially a wrapper for pandas' read_csv() function which will store returned DataFrame in the pos_data Series of the plate instance. The path of the layout file needs to be provided in the exp_data file in a column named Layout_path. The layout file should not have any header or index information but this can be overriden by supplying keyword arguments as a dictionary to the kwargs argument. Any keyword arguments provided will be passed to pandas' read_csv() function. Alternatively, the layout can be given as a DataFrame (in the same format, labels are replaced) and is used instead of reading the file.'''
         
-        imported = pd.read_csv(self.meta_data['Layout_path'], **kwargs)
+        if layout is None:
+            imported = pd.read_csv(self.meta_data['Layout_path'], **kwargs)
+        else:
+            imported = layout.copy()
         imported.index = map(str, range(1, len(imported.index)+1))
         imported.columns = map(str, range(1, len(imported.columns)+1))
 
         self.pos_data['Strain'] = imported
         
     def rcmedian_normalisation(self, inkey='Colony_size', outkey='Colony_size_corr'):
-        '''This function implements row/column median normalisation with smoothing of row/column medians across plates.
+        '''This function implements row/column median normalisation using the row/column medians of this plate. To estimate row/column effects jointly across plates, use Experiment.rcmedian_normalisation with group_by.
 
         Required aguments:
         inkey (str) -- The key in pos_data which to use as input
@@ -341,17 +646,22 @@ class Plate():
                 except Exception:
                     pass
 
+        from matplotlib import pyplot as plt
+        from matplotlib.backends.backend_pdf import PdfPages
+        import seaborn as sns
+
         if pdf_path:
             pdf = PdfPages(os.path.join(pdf_path, str(self.plateid))+'.pdf')
 
-        for key in toPlot:
-            fig, ax = plt.subplots()
-            sns.heatmap(data=self.pos_data[key], ax=ax)
-            ax.set_title(key)
-            if pdf:
-                pdf.savefig()
-                fig.clf()
-                plt.close(fig)
+        with sns.axes_style('white'):
+            for key in toPlot:
+                fig, ax = plt.subplots()
+                sns.heatmap(data=self.pos_data[key], ax=ax)
+                ax.set_title(key)
+                if pdf:
+                    pdf.savefig()
+                    fig.clf()
+                    plt.close(fig)
                 
         if pdf_path:
             pdf.close()
@@ -434,6 +744,12 @@ class Plate():
 
         return long_data
 
+def read_quantify_results(data_path):
+    '''Read a pyphe-quantify results table from a csv file or, for data paths of the form <store>::<image name>, from a result store (see pyphe.store).'''
+    if split_data_path(data_path) is not None:
+        return read_data_paths([data_path])[data_path]
+    return pd.read_csv(data_path)
+
 def check_mkdir(dirPath):
     '''
 Create a directory if it does not exist already.
@@ -467,9 +783,19 @@ def check_exp_data(exp_data, layouts=False):
     print('....OK')
     
     print('Checking all data files exist')
+    stores = {}
     for ip in exp_data['Data_path']:
-        if not os.path.isfile(ip):
+        stored = split_data_path(ip)
+        if stored is not None:
+            stores.setdefault(stored[0], []).append(stored[1])
+        elif not os.path.isfile(ip):
             raise IOError('Data file does not exist: %s'%ip)
+    for store, images in stores.items():
+        if not os.path.isfile(store):
+            raise IOError('Result store does not exist: %s'%store)
+        missing = set(images) - set(list_images(store).index)
+        if missing:
+            raise IOError('Images not found in result store %s: %s'%(store, ', '.join(sorted(missing))))
     print('...OK')
     
     if layouts:
@@ -479,9 +805,9 @@ def check_exp_data(exp_data, layouts=False):
                 raise IOError('Layout file does not exist: %s'%ip)
         print('...OK')
 
-def pyphe_cmd(wdirectory=None, grid_norm=None, out_ld=None, qcplots=None, check_setNA=None, qcplot_dir=None, exp_data_path=None, extrapolate_corners=None, grid_pos=None, rcmedian=None, input_type=None, load_layouts=None):
+def pyphe_cmd(wdirectory=None, grid_norm=None, out_ld=None, qcplots=None, check_setNA=None, qcplot_dir=None, exp_data_path=None, extrapolate_corners=None, grid_pos=None, rcmedian=None, input_type=None, load_layouts=None, rcmedian_by=None, grid_interpolation='cubic', extrapolate_corners_by=None):
     '''
-    This function was written to be called from the GUI script provided. But it can also be used to run the entire standard pipeline in one place.
+    This function was written to be called from the GUI script provided. But it can also be used to run the entire standard pipeline in one place. To run the pipeline on data in memory, use analyse().
     '''
     
     print('###Step 1: Load data###')
@@ -495,6 +821,56 @@ def pyphe_cmd(wdirectory=None, grid_norm=None, out_ld=None, qcplots=None, check_
     check_exp_data(exp_data, layouts=load_layouts)
     print('Table checks completed')
     
+    analyse(exp_data, input_type, layouts=True if load_layouts else None, grid_pos=grid_pos if grid_norm else None, grid_interpolation=grid_interpolation, 
+            extrapolate_corners=extrapolate_corners, extrapolate_corners_by=extrapolate_corners_by, rcmedian=rcmedian, rcmedian_by=rcmedian_by, 
+            check_setNA=check_setNA, qcplot_dir=qcplot_dir if qcplots else None, out_ld=out_ld)
+
+def analyse(exp_data, input_type, data=None, layouts=None, grid_pos=None, grid_interpolation='cubic', extrapolate_corners=False, extrapolate_corners_by=None, rcmedian=False, rcmedian_by=None, check_setNA=True, qcplot_dir=None, out_ld=None):
+    '''
+    Run the pyphe-analyse pipeline (loading data, normalisation, checks and aggregation into a long data report) on an experiment. Data and layouts are read from the files given in the Data_path and Layout_path columns of exp_data, or can be passed in directly so that the pipeline runs without any intermediate files (e.g. results tables returned by quantify.quantify_batch, see also pipeline.run_pipeline). Nothing is written to disk unless qcplot_dir or out_ld are given.
+
+    Required arguments:
+    exp_data (DataFrame) -- Experimental design table with one row per plate, indexed by plate ID.
+    input_type (str) -- One of gitter, pyphe-quantify-redness, pyphe-quantify-batch or pyphe-growthcurves.
+
+    Keyword arguments:
+    data (dict) -- Results tables of pyphe-quantify (batch or redness) for each plate ID. If None (the default), data is read from Data_path, which can also refer to results in a result store as <store>::<image name>.
+    layouts (dict or bool) -- Layout DataFrames (in the same format as layout files) for each plate ID, or True to read layouts from Layout_path. Defaults to None (no layouts).
+    grid_pos (str) -- Reference grid layout for grid normalisation (standard384, standard1536 or 1536with384grid). Defaults to None (no grid normalisation).
+    grid_interpolation (str) -- cubic or thinplate, see Experiment.grid_normalisation.
+    extrapolate_corners (bool) -- Extrapolate the missing corners of standard1536 grids (only with cubic interpolation).
+    extrapolate_corners_by (str) -- Column in exp_data by which to group plates for the corner extrapolation.
+    rcmedian (bool) -- Perform row/column median normalisation.
+    rcmedian_by (str) -- Column in exp_data by which to group plates for the row/column median normalisation.
+    check_setNA (bool) -- Set negative and infinite values after normalisation to NA.
+    qcplot_dir (str) -- Folder to save qc plots in. Defaults to None (no qc plots).
+    out_ld (str) -- Path to save the data report to. Defaults to None (not saved).
+
+    Returns:
+    ld (DataFrame) -- The data report in long format.
+    '''
+    
+    if extrapolate_corners_by and (extrapolate_corners_by not in exp_data.columns):
+        raise ValueError('Column %s, which was given for grouping plates in the corner extrapolation, is not in the Experimental Design Table'%extrapolate_corners_by)
+    if rcmedian_by and (rcmedian_by not in exp_data.columns):
+        raise ValueError('Column %s, which was given for grouping plates in the row/column median normalisation, is not in the Experimental Design Table'%rcmedian_by)
+    if data is not None:
+        if input_type not in ['pyphe-quantify-redness', 'pyphe-quantify-batch']:
+            raise ValueError('Data can only be passed in directly for pyphe-quantify-redness and pyphe-quantify-batch input')
+        missing = [i for i in exp_data.index if i not in data]
+        if missing:
+            raise ValueError('No data given for plates %s'%', '.join(map(str, missing)))
+    if isinstance(layouts, dict):
+        missing = [i for i in exp_data.index if i not in layouts]
+        if missing:
+            raise ValueError('No layouts given for plates %s'%', '.join(map(str, missing)))
+    
+    #Read the results of all plates in result stores at once rather than plate by plate
+    if data is None and input_type in ['pyphe-quantify-redness', 'pyphe-quantify-batch']:
+        stored = read_data_paths(exp_data['Data_path'])
+        if stored:
+            data = {i : stored.get(p) for i, p in exp_data['Data_path'].items()}
+    
     exp = Experiment(exp_data)
     print('Created pyphe experiment object')
     
@@ -503,13 +879,15 @@ def pyphe_cmd(wdirectory=None, grid_norm=None, out_ld=None, qcplots=None, check_
         exp.plates.map(Plate.read_gitter_single_image)
 
     elif input_type == 'pyphe-quantify-redness':
-        exp.plates.map(Plate.read_pypheredness_single_image)
+        for i, p in exp.plates.items():
+            p.read_pypheredness_single_image(data=None if data is None else data[i])
         
     elif input_type == 'pyphe-growthcurves':
         exp.plates.map(Plate.read_pgc_single_image)
         
     elif input_type == 'pyphe-quantify-batch':
-                exp.plates.map(Plate.read_pyphebatch_single_image)
+        for i, p in exp.plates.items():
+            p.read_pyphebatch_single_image(data=None if data is None else data[i])
     
     else:
         raise ValueError('Unrecignised input_type')
@@ -517,12 +895,16 @@ def pyphe_cmd(wdirectory=None, grid_norm=None, out_ld=None, qcplots=None, check_
     
     
     #Load the layouts
-    if load_layouts:
+    if layouts is True:
         exp.plates.map(Plate.read_layout_single_plate)
         print('Layouts loaded sucessfully')
+    elif layouts is not None:
+        for i, p in exp.plates.items():
+            p.read_layout_single_plate(layout=layouts[i])
+        print('Layouts loaded sucessfully')
     
     #Perform norms
-    if grid_norm:
+    if grid_pos:
         if input_type == 'pyphe-quantify-redness':
             raise ValueError('Grid normalisation does not make sense for redness input')
             
@@ -539,24 +921,18 @@ def pyphe_cmd(wdirectory=None, grid_norm=None, out_ld=None, qcplots=None, check_
             raise ValueError('grid_pos must be one of ["Standard 384 (top left)", "standard384", "Standard 1536 (top left and bottom right)", "standard1536", "1536with384grid"]')
 
 
-        if extrapolate_corners:
-            from sklearn.linear_model import LinearRegression
-            #Make a table of  features
-            vals = pd.DataFrame(columns=['thisCorner', 'horizontalNeighbour', 'verticalNeighbour'])
-            for i,p in exp.plates.items():
-                vals.loc[i+'_topLeft'] = [p.pos_data['Colony_size'].loc['1','1'], p.pos_data['Colony_size'].loc['1','5'], p.pos_data['Colony_size'].loc['5','1']]
-                vals.loc[i+'_bottomRight'] = [p.pos_data['Colony_size'].loc['32','48'], p.pos_data['Colony_size'].loc['32','44'], p.pos_data['Colony_size'].loc['28','48']]
-            mlm = LinearRegression()
-            mlm.fit(vals.iloc[:,1:], vals.iloc[:,0])
+        if grid_interpolation == 'thinplate':
+            print('Interpolating reference grids with thin-plate splines')
+            exp.grid_normalisation(gridpos_list)
+
+        elif extrapolate_corners:
+            coefs = exp.fit_corner_extrapolation(group_by=extrapolate_corners_by)
             print('Extrapolating missing corners based on the following regression: ')
-            print('    horizontal_neighbour_coeff: ' +  str(mlm.coef_[0]))
-            print('    vertical_neighbour_coeff: ' +  str(mlm.coef_[1]))
-            print('    intercept_coeff: ' +  str(mlm.intercept_))
-            print('    accuracy: ' +str(mlm.score(vals.iloc[:,1:], vals.iloc[:,0])))
-                        
-            exp.plates.map(lambda x: x.grid_normalisation(gridpos_list, 
-                                                  extrapolate_corners=True, horizontal_neighbour_coeff=mlm.coef_[0], 
-                                                  vertical_neighbour_coeff=mlm.coef_[1],  intercept_coeff=mlm.intercept_))
+            print(coefs.to_string())
+            plate_coefs = coefs.loc[exp.exp_data[extrapolate_corners_by].values] if extrapolate_corners_by else coefs.loc[['all']*len(exp.plates)]
+            for p, (g, c) in zip(exp.plates, plate_coefs.iterrows()):
+                p.grid_normalisation(gridpos_list, extrapolate_corners=True, horizontal_neighbour_coeff=c['horizontal_neighbour_coeff'], 
+                                     vertical_neighbour_coeff=c['vertical_neighbour_coeff'], intercept_coeff=c['intercept_coeff'])
                               
         else:
             exp.plates.map(lambda x: x.grid_normalisation(gridpos_list) )
@@ -564,31 +940,39 @@ def pyphe_cmd(wdirectory=None, grid_norm=None, out_ld=None, qcplots=None, check_
         
     if rcmedian:
         print('Performing row/column median normalisation')
-        if grid_norm:
+        if grid_pos:
             ikey = 'Colony_size_corr'
             okey = 'Colony_size_corr'
         else:
             ikey = 'Colony_size'
             okey = 'Colony_size_corr'
 
-        exp.plates.map(lambda x: x.rcmedian_normalisation(inkey=ikey, outkey=okey))
+        if rcmedian_by:
+            print('Estimating row/column effects jointly for plates with the same %s'%rcmedian_by)
+        exp.rcmedian_normalisation(inkey=ikey, outkey=okey, group_by=rcmedian_by)
     
     #Perform checks and qc
     if check_setNA:
         print('Checking for infinite and negative fitness values')
-        if (not grid_norm) and (not rcmedian):
-            exp.plates.map(lambda x: x.check_values(inkey='Colony_size', outkey='Colony_size_checked', negative_action=np.nan, inf_action=np.nan))
+        if (not grid_pos) and (not rcmedian):
+            report = exp.check_values(inkey='Colony_size', outkey='Colony_size_checked', negative_action=np.nan, inf_action=np.nan)
         else:
-            exp.plates.map(lambda x: x.check_values(inkey='Colony_size_corr', outkey='Colony_size_corr_checked', negative_action=np.nan, inf_action=np.nan))
+            report = exp.check_values(inkey='Colony_size_corr', outkey='Colony_size_corr_checked', negative_action=np.nan, inf_action=np.nan)
+        if len(report.index) > 0:
+            print('Found %i invalid values in %i plates, these have been set to NA. Number of invalid values per plate:'%(len(report.index), report['Plate'].nunique()))
+            print(report.groupby(['Plate', 'Problem']).size().unstack(fill_value=0).to_string())
         
-    if qcplots:
+    if qcplot_dir:
         print('Making qc plots')
         exp.plates.map(lambda x: x.plot_pos_data(pdf_path=qcplot_dir))
         
     #Export
     print('Exporting data')
     ld = exp.generate_long_data()
-    ld.to_csv(out_ld)
+    if out_ld:
+        ld.to_csv(out_ld)
     print('Done')
     
+    return ld
+    
     
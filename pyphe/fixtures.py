@@ -0,0 +1,25 @@
+'''
+Geometry of the plate bays of the scanning fixtures, used by pyphe-scan and pyphe-scan-timecourse for cropping plates from raw scans and by pyphe-quantify for quantifying raw scans directly. This module has no dependencies so that it can be imported before the command line arguments are parsed.
+'''
+
+#Fixture cropping parameters, change/add your own if you know what you are doing
+#ImageMagick-style geometry strings (<width>x<height>+<x-offset>+<y-offset>) of each bay at 600 dpi
+geometries = {
+'som3_edge':['2034x2865+84+0', '2034x2865+2292+0', '2034x2865+97+3135', '2034x2865+2317+3135'],
+'som3' : ['1726x2603+257+127', '1726x2603+2434+127', '1726x2603+257+3274', '1726x2603+2434+3274'],
+'petrie' : ['2105x2105+20+300', '2105x2105+2222+290', '2105x2105+20+3534', '2105x2105+2214+3534'],
+'som3-color' : ['1726x2603+398+616', '1726x2603+2574+616', '1726x2603+398+3764', '1726x2603+2574+3764'],
+}
+
+
+def parse_geometry(g):
+    '''Parse a geometry string into a tuple of integers (width, height, x-offset, y-offset).'''
+    return tuple(map(int, g.replace('+', 'x').split('x')))
+
+def scale_geometry(geometry, resolution):
+    '''Scale a list of geometry strings defined at 600 dpi to the given resolution in dpi.'''
+    scaled = []
+    for g in geometry:
+        glist = [str(int(x*(resolution/600.0))) for x in parse_geometry(g)]
+        scaled.append(glist[0] + 'x' + glist[1] + '+' + glist[2] + '+' + glist[3])
+    return scaled
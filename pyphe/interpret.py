@@ -1,7 +1,5 @@
 import pandas as pd
-from scipy.stats import ttest_ind
 import numpy as np
-from statsmodels.stats.multitest import multipletests as multit
 from warnings import warn
 
 def count_reps(inseries):
@@ -14,12 +12,12 @@ def count_reps(inseries):
     return out
     
 
-from scipy.stats import mstats_basic
-
-def interpret(ld, condition_column, strain_column, values_column, control_condition, out_prefix, circularity=None, set_missing_na=False):
+def interpret(ld, condition_column, strain_column, values_column, control_condition, out_prefix=None, circularity=None, set_missing_na=False):
     '''
-    Interpret experimental data report produced by pyphe-analyse. 
+    Interpret experimental data report produced by pyphe-analyse. The replicate table and summary statistics are saved as <out_prefix>_reps.csv and <out_prefix>_summaryStats.csv, unless out_prefix is None. The data report ld is not modified. Returns the summary statistics.
     '''
+    from scipy.stats import ttest_ind
+    from statsmodels.stats.multitest import multipletests as multit
     
     
     ###Check if essential columns exist
@@ -64,6 +62,7 @@ def interpret(ld, condition_column, strain_column, values_column, control_condit
     print('Number of non-NA data points: %i'%len(ld.loc[~pd.isnull(ld[values_column])].index))
 
     ###Simple QC filters
+    ld = ld.copy()
     n_datapoints = (~ld[values_column].isnull()).sum()
     if circularity:
         ld.loc[ld['Colony_circularity']<circularity, values_column] = np.nan
@@ -96,12 +95,13 @@ def interpret(ld, condition_column, strain_column, values_column, control_condit
     assert (ld_stats.pivot_table(index=strain_column, columns=[condition_column,'rep'], values=values_column, aggfunc=len).unstack().dropna()==1.0).all()
 
     #Save this table:
-    ld_stats_piv.to_csv(out_prefix+'_reps.csv')
+    if out_prefix is not None:
+        ld_stats_piv.to_csv(out_prefix+'_reps.csv')
     ###Compute summary stats
-    mean_fitness = ld_stats_piv.stack().groupby('Condition').mean()
-    median_fitness = ld_stats_piv.stack().groupby('Condition').median()
-    fitness_stdev = ld_stats_piv.stack().groupby('Condition').std()
-    obs_count = ld_stats_piv.stack().groupby('Condition').agg(lambda x: (~x.isnull()).sum())
+    mean_fitness = ld_stats_piv.stack().groupby(level=strain_column).mean()
+    median_fitness = ld_stats_piv.stack().groupby(level=strain_column).median()
+    fitness_stdev = ld_stats_piv.stack().groupby(level=strain_column).std()
+    obs_count = ld_stats_piv.stack().groupby(level=strain_column).agg(lambda x: (~x.isnull()).sum())
 
     #Compute effect sizes
     median_effect_size = median_fitness.div(median_fitness[control_condition], axis=0)
@@ -146,8 +146,11 @@ def interpret(ld, condition_column, strain_column, values_column, control_condit
 
 
     combined_data = combined_data.swaplevel(axis=1).sort_index(axis=1)
-    combined_data.to_csv(out_prefix+'_summaryStats.csv')
-    print('Interpretation completed and results saved.')
+    if out_prefix is not None:
+        combined_data.to_csv(out_prefix+'_summaryStats.csv')
+        print('Interpretation completed and results saved.')
+    else:
+        print('Interpretation completed.')
 
     return combined_data
         
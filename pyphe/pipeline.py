@@ -0,0 +1,55 @@
+'''
+Run the pyphe pipeline (pyphe-quantify, pyphe-analyse and pyphe-interpret) in-process, passing results between stages as tables in memory instead of through csv files:
+
+    quantified, ld, stats = pipeline.run_pipeline(exp_data, '32-48', images=images,
+                                                  analyse_args={'grid_pos' : 'standard1536'},
+                                                  interpret_args={'condition_column' : 'Condition', 'strain_column' : 'Strain', 'values_column' : 'Colony_size_corr_checked', 'control_condition' : 'YES'})
+
+Nothing is written to disk unless output paths are given for a stage. The individual stages can also be used on their own, see quantify.quantify_single_image, analysis.analyse and interpret.interpret.
+'''
+
+from pyphe import quantify
+from pyphe.analysis import analyse
+from pyphe.interpret import interpret
+
+
+def run_pipeline(exp_data, grid, mode='batch', images=None, quantify_args=None, analyse_args=None, interpret_args=None):
+    '''
+    Quantify all plates of an experiment, analyse them and optionally interpret the resulting data report.
+
+    Required arguments:
+    exp_data (DataFrame) -- Experimental design table with one row per plate, indexed by plate ID. Needs an Image_path column unless images are given.
+    grid (str) -- Grid to use for quantification, as for pyphe-quantify --grid (e.g. 32-48 or auto_1536).
+
+    Keyword arguments:
+    mode (str) -- Quantification mode, batch or redness. Defaults to batch.
+    images (dict) -- Plate images (2D or 3D arrays) for each plate ID. If None (the default), images are read from Image_path.
+    quantify_args (dict) -- Keyword arguments for quantify.quantify_single_image, e.g. t, d, s, negate or gridTemplate (a template as returned by quantify.load_grid_template). out and qc default to None (no output files).
+    analyse_args (dict) -- Keyword arguments for analysis.analyse, e.g. grid_pos, rcmedian or layouts.
+    interpret_args (dict) -- Keyword arguments for interpret.interpret (condition_column, strain_column, values_column, control_condition and optionally out_prefix, circularity, set_missing_na). Defaults to None (no interpretation).
+
+    Returns:
+    quantified (dict) -- Results table of each plate, by plate ID.
+    ld (DataFrame) -- Data report in long format.
+    stats (DataFrame) -- Summary statistics, or None if interpret_args is None.
+    '''
+
+    quantify_args = dict({'out' : None, 'qc' : None}, **(quantify_args or {}))
+    grid, auto = quantify.parse_grid(grid)
+
+    if images is None:
+        from skimage.io import imread
+
+    quantified = {}
+    for i, r in exp_data.iterrows():
+        image = images[i] if images is not None else imread(r['Image_path'])
+        quantified[i] = quantify.quantify_single_image(image, str(i), grid, auto, mode, **quantify_args)
+    print('Quantified %i plates'%len(quantified))
+
+    ld = analyse(exp_data, 'pyphe-quantify-'+mode, data=quantified, **(analyse_args or {}))
+
+    stats = None
+    if interpret_args is not None:
+        stats = interpret(ld, **interpret_args)
+
+    return quantified, ld, stats
@@ -1,21 +1,32 @@
 import os
+import json
+import inspect
 import numpy as np
 import pandas as pd
 import math
 from warnings import warn
-from matplotlib import pyplot as plt
-from scipy.spatial import distance
-from scipy.signal import find_peaks
-from scipy.stats import trim_mean
+from scipy.spatial import distance, cKDTree
+from scipy.ndimage import find_objects, binary_fill_holes, gaussian_filter, label as ndi_label
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from concurrent.futures import ThreadPoolExecutor
 import math
 
-from skimage.filters import threshold_otsu, gaussian, threshold_local
-from skimage.morphology import remove_small_objects, convex_hull_object
+from skimage.filters import threshold_otsu
+from skimage.morphology import remove_small_objects, convex_hull_image
 from skimage.segmentation import clear_border
 from skimage.util import invert
-from skimage.measure import regionprops, label
+from skimage.measure import regionprops, label, ransac
 from skimage.color import label2rgb
 from skimage.draw import rectangle_perimeter
+from skimage.transform import resize, AffineTransform
+
+from pyphe import timing
+from pyphe.fixtures import parse_geometry
+from pyphe.store import write_results
+
+#ransac takes its random seed as rng since scikit-image 0.21 and as random_state in earlier versions
+_ransac_seed = 'rng' if 'rng' in inspect.signature(ransac).parameters else 'random_state'
 
 def make_grid(gd):
     '''
@@ -42,7 +53,61 @@ def make_grid(gd):
     return grid, 0.5*(griddistx+griddisty)
 
 
+def parse_grid(grid):
+    '''
+    Converts a grid argument as passed to pyphe-quantify (a predefined grid, auto_r-c or a custom grid definition) to a grid definition and a boolean indicating whether automatic grid fitting should be used.
+    '''
+    
+    #Predefined grids
+    if grid == 'pp3_96':
+        grid = '8-12-1-2-3-4'
+        auto = False
+    elif grid == 'pp3_384':
+        grid = '16-24-30-38-1254-821'
+        auto = False
+    elif grid == 'pp3_1536':
+        grid = '32-48-43-50-2545-1690'
+        auto = False
+        
+    elif grid == 'auto_96':
+        auto = True
+        grid = '8-12'
+    elif grid == 'auto_384':
+        auto = True
+        grid = '16-24'
+    elif grid == 'auto_1536':
+        auto = True
+        grid = '32-48'
+    
+    elif grid.startswith('auto_'):
+        auto = True
+        griddef = grid[5:]
+        try:
+            griddef = griddef.split('-')
+            griddef = map(int, griddef)
+            grid = '-'.join(map(str,griddef))
+        except Exception:
+            raise ValueError('Invalid grid definition. If auto grid fitting with custom numbers of rows/columns is desired, the grid argument must be "auto_r-c", where r and c are the numbers of rows/columns respectively')
+            
+    
+    else:
+        auto = False
+        
+    #If user defined grid, check if in the right format
+    if not auto: 
+        if not len(grid.split('-'))==6:
+            raise ValueError('Grid definition not in correct format. Must be one of auto_96, auto_384, auto_1536, pp3_96, pp3_384, p3_1536 or a custom grid definition consisting of 6 integers separated by "-".')
+        grid = grid.split('-')
+        try:
+            grid = list(map(int, grid))
+        except Exception:
+            raise ValueError('Grid definition not in correct format. Must be one of auto_96, auto_384, auto_1536, pp3_96, pp3_384, pp3_1536 or a custom grid definition consisting of 6 integers separated by "-".')
+    
+    return grid, auto
+
 def make_grid_auto(im, grid):
+    from scipy.signal import find_peaks
+    from scipy.stats import trim_mean
 
     nrows, ncols = map(int,grid.split('-'))
     
@@ -90,6 +155,194 @@ def make_grid_auto(im, grid):
     return grid, 0.5*(colmed+rowmed)
     
 
+def make_grid_affine(centroids, grid, image_shape):
+    '''
+    Fit a grid to the centroids of detected colonies allowing for any affine transformation (rotation, scaling, shear and offset) of the grid. This works for plates which are not aligned with the image borders, where make_grid_auto fails.
+    
+    The two lattice vectors of the grid are first estimated from the displacements between each colony and its nearest neighbours. The colonies are then assigned integer lattice coordinates and the affine transformation from lattice coordinates to image coordinates is fitted robustly (RANSAC), so that noise blobs and misplaced colonies do not affect the fit. Finally, the window of rows and columns containing most colonies is chosen, ties are broken by choosing the window closest to the image centre.
+    
+    Required arguments:
+    centroids (list) -- (y, x) centroids of putative colonies, e.g. from regionprops.
+    grid (str) -- Number of rows and columns, as "r-c".
+    image_shape (tuple) -- Shape of the image.
+    
+    Returns:
+    grid (dict) -- Mapping of (row, column) to (y, x) positions, as returned by make_grid_auto.
+    griddist (float) -- Mean distance between grid positions.
+    '''
+    
+    nrows, ncols = map(int,grid.split('-'))
+    pts = np.array(list(centroids), dtype=float).reshape(-1,2)
+    if len(pts) < 5:
+        raise ValueError('Not enough colonies detected for affine grid fitting.')
+    
+    #Displacements to the four nearest neighbours. Only keep those with typical length, this removes diagonals and noise blobs
+    dists, idx = cKDTree(pts).query(pts, k=5)
+    vecs = (pts[idx[:,1:]] - pts[:,None,:]).reshape(-1,2)
+    lengths = dists[:,1:].ravel()
+    typical = np.median(dists[:,1])
+    vecs = vecs[(lengths > 0.7*typical) & (lengths < 1.3*typical)]
+    
+    #Split into column (mostly horizontal) and row (mostly vertical) steps, point all in the same direction and average
+    horizontal = np.abs(vecs[:,1]) > np.abs(vecs[:,0])
+    col_vecs = vecs[horizontal] * np.sign(vecs[horizontal][:,1:2])
+    row_vecs = vecs[~horizontal] * np.sign(vecs[~horizontal][:,0:1])
+    if (len(col_vecs) == 0) or (len(row_vecs) == 0):
+        raise ValueError('Could not determine grid orientation for affine grid fitting.')
+    basis = np.column_stack([np.median(col_vecs, axis=0), np.median(row_vecs, axis=0)])
+    
+    #Lattice coordinates (column, row) relative to the colony closest to the centre of all colonies
+    origin = pts[np.argmin(((pts - np.median(pts, axis=0))**2).sum(axis=1))]
+    lattice = np.linalg.solve(basis, (pts - origin).T).T
+    lattice_int = np.round(lattice)
+    near_node = (np.abs(lattice - lattice_int) < 0.25).all(axis=1)
+    if near_node.sum() < 3:
+        raise ValueError('Not enough colonies on a regular grid for affine grid fitting.')
+    
+    #Robust fit of lattice coordinates to image coordinates (both as x, y)
+    model, inliers = ransac((lattice_int[near_node], pts[near_node][:,::-1]), AffineTransform, min_samples=3, residual_threshold=0.25*typical, max_trials=100, **{_ransac_seed : 0})
+    if inliers is None:
+        raise ValueError('Affine grid fitting failed.')
+    cols_found = lattice_int[near_node][inliers][:,0].astype(int)
+    rows_found = lattice_int[near_node][inliers][:,1].astype(int)
+    
+    #Place the window of nrows x ncols so that it contains most colonies. Break ties by choosing the window closest to the image centre
+    centre_col, centre_row = model.inverse(np.array([[image_shape[1]/2.0, image_shape[0]/2.0]]))[0]
+    def best_offset(found, n, centre):
+        offsets = np.arange(min(found.min(), found.max()-n+1), max(found.min(), found.max()-n+1)+1)
+        counts = np.array([((found >= o) & (found < o+n)).sum() for o in offsets])
+        candidates = offsets[counts == counts.max()]
+        return candidates[np.argmin(np.abs(candidates + (n-1)/2.0 - centre))]
+    col_offset = best_offset(cols_found, ncols, centre_col)
+    row_offset = best_offset(rows_found, nrows, centre_row)
+    
+    nodes = np.array([[col_offset + c, row_offset + r] for r in range(nrows) for c in range(ncols)], dtype=float)
+    positions = model(nodes)
+    grid = {}
+    for (c, r), (x, y) in zip(nodes - [col_offset, row_offset], positions):
+        grid[(int(r)+1, int(c)+1)] = (y, x)
+    griddist = 0.5*(np.linalg.norm(model.params[:2,0]) + np.linalg.norm(model.params[:2,1]))
+    
+    return grid, griddist
+
+def _normalised_profile(image, axis):
+    '''
+    Mean intensity profile of an image along an axis, normalised to zero mean and unit standard deviation.
+    '''
+    
+    profile = image.mean(axis=axis)
+    profile = profile - profile.mean()
+    sd = profile.std()
+    if sd > 0:
+        profile = profile / sd
+    return profile
+
+def _profile_shift(ref, profile, max_shift):
+    '''
+    Find the shift (with sub-pixel precision) of profile relative to ref by cross-correlation, testing all shifts up to max_shift. A positive shift means that features in profile are found at larger positions than in ref.
+    '''
+    
+    n = min(len(ref), len(profile))
+    shifts = np.arange(-max_shift, max_shift+1)
+    scores = np.array([np.mean(ref[max(0,-s):n-max(0,s)] * profile[max(0,s):n+min(0,s)]) for s in shifts])
+    
+    #Refine by fitting a parabola through the best shift and its neighbours
+    i = np.argmax(scores)
+    shift = float(shifts[i])
+    if 0 < i < len(shifts)-1:
+        denom = scores[i-1] - 2*scores[i] + scores[i+1]
+        if denom < 0:
+            shift += 0.5 * (scores[i-1] - scores[i+1]) / denom
+    return shift
+
+def make_grid_template(image, grid, auto, centroids=None):
+    '''
+    Fit the grid to a reference image (either automatically or from a grid definition, see parse_grid) and store it as a template, together with the row and column intensity profiles of the reference image. The template can be applied to other images of plates from the same fixture position with apply_grid_template.
+    
+    Required arguments:
+    image (ndarray) -- Pre-processed 2D reference image (as returned by check_and_negate or prepare_redness_image).
+    grid -- Grid definition as returned by parse_grid.
+    auto (bool) -- Whether to fit the grid automatically.
+    
+    Keyword arguments:
+    centroids (list) -- Centroids of colonies in the reference image. If given, automatic grid fitting is done with make_grid_affine.
+    
+    Returns:
+    template (dict) -- Grid positions, distance between grid positions, image shape and intensity profiles of the reference image.
+    '''
+    
+    if auto and (centroids is not None):
+        grid, griddist = make_grid_affine(centroids, grid, image.shape)
+    elif auto:
+        grid, griddist = make_grid_auto(image, grid)
+    else:
+        grid, griddist = make_grid(grid)
+    
+    #Profiles of the two halves of the image are used to detect rotations
+    h, w = image.shape
+    template = {'positions' : [[r, c, float(y), float(x)] for (r, c), (y, x) in grid.items()],
+                'griddist' : float(griddist),
+                'shape' : [h, w],
+                'row_profiles' : [_normalised_profile(image[:,:w//2], 1).tolist(), _normalised_profile(image[:,w//2:], 1).tolist()],
+                'col_profiles' : [_normalised_profile(image[:h//2,:], 0).tolist(), _normalised_profile(image[h//2:,:], 0).tolist()]}
+    
+    return template
+
+def apply_grid_template(image, template, max_shift=None):
+    '''
+    Place the grid stored in a template on an image. Shifts of the plate relative to the reference image are detected by cross-correlation of row and column intensity profiles, separately for the left/right and top/bottom halves of the image, and small rotations are corrected for from the differences in shift between the halves. This is much cheaper than fitting the grid from scratch and does not depend on all rows and columns being present on the plate.
+    
+    Required arguments:
+    image (ndarray) -- Pre-processed 2D image.
+    template (dict) -- Grid template as returned by make_grid_template.
+    
+    Keyword arguments:
+    max_shift (int) -- Largest shift to test in pixels. Defaults to half the distance between grid positions, larger shifts can not be told apart from shifts by a whole row/column.
+    
+    Returns:
+    grid (dict) -- Mapping of (row, column) to (y, x) positions, as returned by make_grid_auto.
+    griddist (float) -- Distance between grid positions.
+    '''
+    
+    griddist = template['griddist']
+    if max_shift is None:
+        max_shift = int(griddist/2)
+    h, w = template['shape']
+    ih, iw = image.shape
+    
+    #Vertical shifts in left and right half, horizontal shifts in top and bottom half
+    dy_left = _profile_shift(np.array(template['row_profiles'][0]), _normalised_profile(image[:,:iw//2], 1), max_shift)
+    dy_right = _profile_shift(np.array(template['row_profiles'][1]), _normalised_profile(image[:,iw//2:], 1), max_shift)
+    dx_top = _profile_shift(np.array(template['col_profiles'][0]), _normalised_profile(image[:ih//2,:], 0), max_shift)
+    dx_bottom = _profile_shift(np.array(template['col_profiles'][1]), _normalised_profile(image[ih//2:,:], 0), max_shift)
+    
+    #Small angle rotation (clockwise) about the image centre. Centres of the halves are half an image width/height apart
+    dy = 0.5*(dy_left + dy_right)
+    dx = 0.5*(dx_top + dx_bottom)
+    angle = 0.5*((dy_right - dy_left)/(w/2.0) - (dx_bottom - dx_top)/(h/2.0))
+    cy, cx = h/2.0, w/2.0
+    
+    grid = {}
+    for r, c, y, x in template['positions']:
+        grid[(r, c)] = (y + dy + angle*(x-cx), x + dx - angle*(y-cy))
+    
+    return grid, griddist
+
+def save_grid_template(template, path):
+    '''
+    Save a grid template as json.
+    '''
+    with open(path, 'w') as fh:
+        json.dump(template, fh)
+
+def load_grid_template(path):
+    '''
+    Load a grid template saved with save_grid_template.
+    '''
+    with open(path, 'r') as fh:
+        return json.load(fh)
+    
+
 def match_to_grid(labels, centroids, grid, griddist, d=3, reportAll=False):
     '''
     From a list of grid positions and a list of centroids, construct a distance matrix between all pairs and return the best fits as a dictionary.
@@ -120,85 +373,382 @@ def match_to_grid(labels, centroids, grid, griddist, d=3, reportAll=False):
     return dm
 
 
-def make_mask(image, t=1, s=1, hardImageThreshold=None, hardSizeThreshold=None, local=False, convexhull=False):
+def convex_hull_objects(mask, workers=None):
+    '''
+    Replace each connected component (8-connectivity) of a binary mask by its convex hull. The result is the same as that of skimage.morphology.convex_hull_object() but the hull of each object is computed on the object's bounding box only rather than the whole image, and objects are processed in parallel.
+    
+    Required arguments:
+    mask (ndarray) -- 2D boolean array.
+    
+    Keyword arguments:
+    workers (int) -- Number of threads to use. Defaults to the number of processors.
+    
+    Returns:
+    hulls (ndarray) -- 2D boolean array.
+    '''
+    
+    labels = label(mask, connectivity=2)
+    hulls = np.zeros(mask.shape, dtype=bool)
+    
+    def object_hull(args):
+        i, sl = args
+        return sl, convex_hull_image(labels[sl] == i+1)
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for sl, hull in executor.map(object_hull, enumerate(find_objects(labels))):
+            hulls[sl] |= hull
+    
+    return hulls
+
+def estimate_background(image, sigma, downsample=1, mode='nearest'):
     '''
-    Identifies suitable morphological components from image by thresholding.
+    Estimate the smooth background of an image by gaussian blur. With downsample > 1, the image is first reduced by averaging blocks of downsample x downsample pixels, blurred with a correspondingly smaller sigma and then interpolated back to full size. This is much faster for large sigmas and gives very similar results as long as sigma is large compared to downsample. With downsample=1, the result is identical to skimage.filters.gaussian (and threshold_local with method gaussian).
+    
+    Required arguments:
+    image (ndarray) -- 2D float array.
+    sigma (float) -- Standard deviation of the gaussian kernel in pixels of the full size image.
+    
+    Keyword arguments:
+    downsample (int) -- Downsampling factor.
+    mode (str) -- How image borders are handled, passed on to scipy.ndimage.gaussian_filter.
+    
+    Returns:
+    background (ndarray) -- 2D float array of the same shape as image.
     '''
     
-    if local:
-        mask = image > t*threshold_local(image, 151)
+    if downsample <= 1:
+        return gaussian_filter(image, sigma, mode=mode, truncate=4.0)
+    
+    f = int(downsample)
+    h, w = image.shape
+    
+    #Pad to a multiple of the downsampling factor and average blocks
+    padded = np.pad(image, ((0, -h%f), (0, -w%f)), mode='edge')
+    small = padded.reshape(padded.shape[0]//f, f, padded.shape[1]//f, f).mean(axis=(1,3))
+    
+    #Block averaging already blurs by a box filter with variance (f**2-1)/12, account for that in the remaining gaussian 
+    small_sigma = np.sqrt(max(sigma**2 - (f**2-1)/12.0, 0))/f
+    small = gaussian_filter(small, small_sigma, mode=mode, truncate=4.0)
+    
+    #Interpolate back to full size. Block centres are aligned with pixel centres of the padded image
+    background = resize(small, padded.shape, order=1, mode='edge', anti_aliasing=False)
+    
+    return background[:h,:w]
 
+def threshold_otsu_pooled(images, nbins=256):
+    '''
+    Otsu threshold of the pooled intensities of several images (or tiles of an image), computed from the sum of their histograms without concatenating the images. For a single image, the result is the same as skimage.filters.threshold_otsu.
+    '''
+    
+    lo = min(im.min() for im in images)
+    hi = max(im.max() for im in images)
+    if lo == hi:
+        return lo
+    
+    #Like skimage, use one bin per value for integer images
+    if np.issubdtype(images[0].dtype, np.integer):
+        counts = sum(np.bincount(np.subtract(im, lo, dtype=np.intp).ravel(), minlength=int(hi)-int(lo)+1) for im in images)
+        bin_centers = np.arange(lo, hi+1)
     else:
+        counts = sum(np.histogram(im, bins=nbins, range=(lo, hi))[0] for im in images)
+        edges = np.histogram_bin_edges([], bins=nbins, range=(lo, hi))
+        bin_centers = (edges[:-1] + edges[1:])/2
+    
+    return threshold_otsu(hist=(counts, bin_centers))
+
+def intensity_histogram(orig_image):
+    '''
+    Histogram of an integer (e.g. 8-bit) image with one bin per intensity level, computed directly on the image without converting it to float. For colour images, the channels are summed (like check_and_negate, which averages them).
+    
+    Returns:
+    counts (ndarray) -- Number of pixels with each intensity level.
+    scale (int) -- Intensity level i corresponds to i/scale in the working image before negation.
+    '''
+    
+    if not np.issubdtype(orig_image.dtype, np.integer):
+        raise ValueError('Intensity histograms can only be computed for integer images.')
+    channels = 1
+    if len(orig_image.shape) == 3:
+        channels = orig_image.shape[2]
+        orig_image = orig_image.sum(axis=2, dtype=np.uint32)
+    
+    return np.bincount(orig_image.ravel()), 255*channels
+
+def threshold_otsu_histogram(counts, scale, negate=True):
+    '''
+    Otsu threshold from an intensity histogram (see intensity_histogram), in the units of the working image returned by check_and_negate.
+    '''
+    
+    levels = np.arange(len(counts))/float(scale)
+    if negate:
+        counts, levels = counts[::-1], 1 - levels[::-1]
+    
+    #Restrict to the range of intensities in the image, like threshold_otsu
+    nonzero = np.flatnonzero(counts)
+    counts, levels = counts[nonzero[0]:nonzero[-1]+1], levels[nonzero[0]:nonzero[-1]+1]
+    if len(counts) == 1:
+        return levels[0]
+    
+    return threshold_otsu(hist=(counts, levels))
+
+def batch_threshold(images, negate=True, max_deviation=0.1):
+    '''
+    Compute a single Otsu threshold for a batch of plates from the pooled intensity histograms of all plates. Plates from the same batch share agar and illumination, and a pooled threshold is more robust than thresholds of single plates, which can be far off for plates with few or no colonies. The threshold of each plate and its deviation from the pooled threshold are reported.
+    
+    Required arguments:
+    images (iterable) -- (name, image) pairs of integer images, all greyscale or all colour.
+    
+    Keyword arguments:
+    negate (bool) -- Whether images are negated before thresholding (see check_and_negate).
+    max_deviation (float) -- Plates whose own threshold deviates by more than this fraction from the pooled threshold are flagged.
+    
+    Returns:
+    threshold (float) -- The pooled threshold, in units of the working image.
+    report (DataFrame) -- Threshold, deviation from the pooled threshold (as a fraction) and flag for each plate, indexed by plate name.
+    '''
+    
+    pooled, scale, thresholds = np.zeros(0, dtype=np.intp), None, {}
+    for name, image in images:
+        counts, s = intensity_histogram(image)
+        if scale is not None and s != scale:
+            raise ValueError('Images in a batch must either all be greyscale or all be colour images.')
+        scale = s
+        thresholds[name] = threshold_otsu_histogram(counts, scale, negate=negate)
+        if len(counts) > len(pooled):
+            pooled = np.pad(pooled, (0, len(counts)-len(pooled)))
+        pooled[:len(counts)] += counts
+    if scale is None:
+        raise ValueError('No images to compute a threshold from.')
+    threshold = threshold_otsu_histogram(pooled, scale, negate=negate)
+    
+    report = pd.DataFrame({'Threshold' : pd.Series(thresholds)})
+    report.index.name = 'Plate'
+    report['Deviation'] = report['Threshold']/threshold - 1
+    report['Flagged'] = report['Deviation'].abs() > max_deviation
+    
+    return threshold, report
+
+def _tiles(shape, tile_size):
+    '''Slices of the square tiles of the given size covering an image, in raster order.'''
+    return [np.s_[r:r+tile_size, c:c+tile_size] for r in range(0, shape[0], tile_size) for c in range(0, shape[1], tile_size)]
+
+def _merge_tile_labels(labels, n, tile_size, connectivity):
+    '''
+    Find the objects of an image labelled tile by tile, with labels numbered consecutively across tiles. Labels of neighbouring foreground pixels on either side of a tile seam belong to the same object. Returns the object of each label, as an array of length n+1.
+    '''
+    
+    pairs = []
+    for axis in [0, 1]:
+        for p in range(tile_size, labels.shape[axis], tile_size):
+            a, b = np.take(labels, p-1, axis=axis), np.take(labels, p, axis=axis)
+            #Diagonal neighbours are only connected with connectivity 2
+            for x, y in [(a, b), (a[:-1], b[1:]), (a[1:], b[:-1])][:1 if connectivity == 1 else 3]:
+                both = (x > 0) & (y > 0)
+                pairs.append((x[both], y[both]))
+    
+    i = np.concatenate([x for x, y in pairs] + [np.zeros(0, dtype=labels.dtype)])
+    j = np.concatenate([y for x, y in pairs] + [np.zeros(0, dtype=labels.dtype)])
+    graph = coo_matrix((np.ones(len(i), dtype=bool), (i, j)), shape=(n+1, n+1))
+    
+    return connected_components(graph, directed=False)[1]
+
+def _map_tiles(f, tiles, workers):
+    '''Apply f to all tiles in parallel and yield the results in order. At most workers tiles are processed at a time, so that memory use is bounded.'''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i in range(0, len(tiles), workers):
+            yield from executor.map(f, tiles[i:i+workers])
+
+def make_mask_tiled(image, t=1, s=1, hardImageThreshold=None, hardSizeThreshold=None, tile_size=2048, workers=None, info=None):
+    '''
+    Identify colonies by thresholding like make_mask, but process the image in tiles so that, apart from the returned label image, memory use is bounded by the tile size. The result is the same label image as that of make_mask. Tiles are processed in parallel. The Otsu threshold is computed from the pooled histograms of all tiles. Small objects are filtered and objects touching the image border removed after stitching objects across tile seams, so objects spanning several tiles are handled correctly. Local thresholding and filling of holes are not supported.
+    
+    Required arguments:
+    image (ndarray) -- 2D image (e.g. as returned by check_and_negate).
+    
+    Keyword arguments:
+    t, s, hardImageThreshold, hardSizeThreshold, info -- See make_mask.
+    tile_size (int) -- Height and width of the tiles in pixels.
+    workers (int) -- Number of threads to use. Defaults to the number of processors.
+    
+    Returns:
+    labels (ndarray) -- 2D int32 array of object labels, numbered in raster order.
+    '''
+    
+    tiles = _tiles(image.shape, tile_size)
+    workers = workers or os.cpu_count()
+    labels = np.zeros(image.shape, dtype=np.int32)
+    
+    with timing.stage('threshold'):
         if hardImageThreshold:
             thresh = hardImageThreshold
         else:
-            thresh = t*threshold_otsu(image)
-            
-        mask = image>thresh
+            thresh = t*threshold_otsu_pooled([image[tl] for tl in tiles])
+    if info is not None:
+        info['threshold'] = thresh
+    
+    #Filter small objects. Object sizes are computed with connectivity 1 like in remove_small_objects
+    if hardSizeThreshold:
+        size_thresh = hardSizeThreshold
+    else:
+        size_thresh = s * np.prod(image.shape) * 0.00005
+    
+    def label_tile(tl):
+        tile_labels, k = ndi_label(image[tl] > thresh)
+        return tl, tile_labels, k, np.bincount(tile_labels.ravel(), minlength=k+1)[1:]
+    
+    with timing.stage('remove_small_objects'):
+        n, sizes = 0, [np.zeros(1, dtype=np.intp)]
+        for tl, tile_labels, k, tile_sizes in _map_tiles(label_tile, tiles, workers):
+            tile_labels[tile_labels > 0] += n
+            labels[tl] = tile_labels
+            n += k
+            sizes.append(tile_sizes)
+        objects = _merge_tile_labels(labels, n, tile_size, 1)
+        keep = np.bincount(objects, weights=np.concatenate(sizes))[objects] >= size_thresh
+        keep[0] = False
     
-    #Fill holes. Warning: takes a long time
+    #Label remaining objects with connectivity 2 and record the first pixel of each label in raster order
+    def label_kept(tl):
+        tile_labels, k = ndi_label(keep[labels[tl]], structure=np.ones((3,3)))
+        first = np.empty(k, dtype=np.int64)
+        for i, sl in enumerate(find_objects(tile_labels)):
+            row = sl[0].start
+            col = sl[1].start + np.argmax(tile_labels[row, sl[1]] == i+1)
+            first[i] = (tl[0].start+row)*image.shape[1] + tl[1].start+col
+        return tl, tile_labels, k, first
+    
+    with timing.stage('clear_border'):
+        n, firsts = 0, []
+        for tl, tile_labels, k, first in _map_tiles(label_kept, tiles, workers):
+            tile_labels[tile_labels > 0] += n
+            labels[tl] = tile_labels
+            n += k
+            firsts.append(first)
+        objects = _merge_tile_labels(labels, n, tile_size, 2)
+        
+        #Remove objects touching the border and number the others by their first pixel in raster order, like label
+        removed = np.zeros(objects.max()+1, dtype=bool)
+        removed[objects[np.concatenate([labels[0], labels[-1], labels[:,0], labels[:,-1]])]] = True
+        removed[objects[0]] = True
+        object_first = np.full(len(removed), np.iinfo(np.int64).max)
+        np.minimum.at(object_first, objects[1:], np.concatenate(firsts + [np.zeros(0, dtype=np.int64)]))
+        kept = np.flatnonzero(~removed)
+        numbers = np.zeros(len(removed), dtype=np.int32)
+        numbers[kept[np.argsort(object_first[kept])]] = np.arange(1, len(kept)+1)
+        renumber = numbers[objects]
+    
+    with timing.stage('label'):
+        for tl in tiles:
+            labels[tl] = renumber[labels[tl]]
+    
+    return labels
+
+def make_mask(image, t=1, s=1, hardImageThreshold=None, hardSizeThreshold=None, local=False, convexhull=False, fillholes=False, bgDownsample=1, tile_size=None, info=None):
+    '''
+    Identifies suitable morphological components from image by thresholding. Holes in components can be filled by replacing each component by its convex hull (convexhull=True) or, much faster, by filling only holes which are fully enclosed (fillholes=True). The local threshold (local=True) is estimated at a resolution reduced by bgDownsample (see estimate_background). If tile_size is given, the image is processed in tiles of this size with the same result (see make_mask_tiled), which is not possible with local thresholding or filling holes. If a dict is given as info, the threshold used is stored in it under threshold (None for local thresholding).
+    '''
+    
+    if tile_size:
+        if local or convexhull or fillholes:
+            raise ValueError('Tiled segmentation can not be combined with local thresholding, convexhull or fillholes.')
+        return make_mask_tiled(image, t=t, s=s, hardImageThreshold=hardImageThreshold, hardSizeThreshold=hardSizeThreshold, tile_size=tile_size, info=info)
+    
+    with timing.stage('threshold'):
+        if local:
+            #Gaussian local threshold with a block size of 151, sigma=(151-1)/6 like skimage.filters.threshold_local
+            mask = image > t*estimate_background(image, 25.0, downsample=bgDownsample, mode='reflect')
+            thresh = None
+
+        else:
+            if hardImageThreshold:
+                thresh = hardImageThreshold
+            else:
+                thresh = t*threshold_otsu(image)
+                
+            mask = image>thresh
+    if info is not None:
+        info['threshold'] = thresh
+    
+    #Fill holes
     if convexhull:
-        mask = convex_hull_object(mask)
+        with timing.stage('convex_hull_objects'):
+            mask = convex_hull_objects(mask)
+    elif fillholes:
+        with timing.stage('fill_holes'):
+            mask = binary_fill_holes(mask)
         
     #Filter small components. The default threshold is 0.00005 of the image area 
     if hardSizeThreshold:
         size_thresh = hardSizeThreshold
     else:
         size_thresh = s * np.prod(image.shape) * 0.00005
-    mask = remove_small_objects(mask, min_size=size_thresh)
+    with timing.stage('remove_small_objects'):
+        mask = remove_small_objects(mask, min_size=size_thresh)
     
     
     #Clear border
-    mask = clear_border(mask)
+    with timing.stage('clear_border'):
+        mask = clear_border(mask)
     
     #Label connected components
-    mask = label(mask)
+    with timing.stage('label'):
+        mask = label(mask)
     
     return mask
 
-def check_and_negate(orig_image, negate=True):
+def check_and_negate(orig_image, negate=True, dtype=np.float64, out=None):
     '''
-    Check if image is greyscale, convert if it isn't. Convert to float and invert intensities.
+    Check if image is greyscale, convert if it isn't. Convert to float and invert intensities. The input image is not modified and only a single working image of the given float dtype is allocated, all further operations are done in-place. Using float32 halves the memory required and is faster, at the cost of slightly different results. If out is given, the working image is written into this array (of the same height and width as the image) instead of a new one.
     '''
-    image = np.copy(orig_image)
     
     #Check if images are grayscale and convert if necessary
-    if len(image.shape) == 3:
+    if len(orig_image.shape) == 3:
         warn('Image is not in greyscale, converting before processing')
-        image = image.astype(int).mean(axis=2)
+        image = orig_image.mean(axis=2, dtype=dtype, out=out)
+    elif out is None:
+        image = orig_image.astype(dtype)
+    else:
+        out[...] = orig_image
+        image = out
 
-    #Convert to float and re-scale to [0,1]            
-    image = image.astype(float)
-    image = image / 255.0
+    #Re-scale to [0,1]            
+    image /= 255.0
     
     #Negate images if required
     if negate:
-        image = invert(image)
+        np.subtract(1, image, out=image)
         
     return image
 
-def quantify_single_image_size(orig_image, grid, auto, t=1, d=3, s=1, negate=True, reportAll=False, hardImageThreshold=None, hardSizeThreshold=None, localThresh=None, convexhull=False):
+def measure_colonies(mask, image):
     '''
-    Process a single image to extract colony sizes.
+    Measure label, area, centroid, mean intensity and perimeter of all objects in a label image and return them as a table indexed by label.
     '''
     
-    #Prepare image
-    image = check_and_negate(orig_image, negate=negate)
+    with timing.stage('regionprops'):
+        data = {r.label : {p : r[p] for p in ['label', 'area', 'centroid', 'mean_intensity', 'perimeter']} for r in regionprops(mask, intensity_image=image)}
+        data = pd.DataFrame(data).transpose()
     
-    #Create grid
-    if auto:
-        grid, griddist = make_grid_auto(image, grid)
-    else:
-        grid, griddist = make_grid(grid)
-        
-    #Make mask
-    mask = make_mask(image, t=t, s=s, hardImageThreshold=hardImageThreshold, hardSizeThreshold=hardSizeThreshold, local=localThresh, convexhull=convexhull)
+    return data
+
+def assign_to_grid(data, image, grid, auto, d=3, reportAll=False, gridTemplate=None, affine=False):
+    '''
+    Fit the grid to an image and match the colonies measured by measure_colonies() to grid positions. Returns the table of colonies which have a grid position, with row, column and circularity added.
+    '''
     
-    #Measure regionprobs
-    data = {r.label : {p : r[p] for p in ['label', 'area', 'centroid', 'mean_intensity', 'perimeter']} for r in regionprops(mask, intensity_image=image)}
-    data = pd.DataFrame(data).transpose()
+    #Create grid. Affine grid fitting uses the centroids of the detected colonies
+    with timing.stage('make_grid'):
+        if gridTemplate is not None:
+            grid, griddist = apply_grid_template(image, gridTemplate)
+        elif auto and affine:
+            grid, griddist = make_grid_affine(data['centroid'], grid, image.shape)
+        elif auto:
+            grid, griddist = make_grid_auto(image, grid)
+        else:
+            grid, griddist = make_grid(grid)
     
-    blob_to_pos = match_to_grid(data['label'], data['centroid'], grid, griddist, d=d, reportAll=reportAll)
+    with timing.stage('match_to_grid'):
+        blob_to_pos = match_to_grid(data['label'], data['centroid'], grid, griddist, d=d, reportAll=reportAll)
     
     #Select only those blobs which have a corresponding grid position
     data = data.loc[[l in blob_to_pos for l in data['label']]]
@@ -210,146 +760,484 @@ def quantify_single_image_size(orig_image, grid, auto, t=1, d=3, s=1, negate=Tru
     #Add circularity
     data['circularity'] = (4 * math.pi * data['area']) / (data['perimeter']**2)
     
+    #Record the grid fit like a grid definition (rows, columns and positions of the first and last colony)
+    rows, cols = max(grid)
+    (y1, x1), (y2, x2) = grid[(1,1)], grid[(rows,cols)]
+    data.attrs.update({'grid_rows' : rows, 'grid_columns' : cols, 'grid_x1' : float(x1), 'grid_y1' : float(y1), 'grid_x2' : float(x2), 'grid_y2' : float(y2), 'grid_spacing' : float(griddist)})
+    
+    return data
+
+def quantify_single_image_size(orig_image, grid, auto, t=1, d=3, s=1, negate=True, reportAll=False, hardImageThreshold=None, hardSizeThreshold=None, localThresh=None, convexhull=False, fillholes=False, bgDownsample=1, dtype=np.float64, gridTemplate=None, affine=False, tileSize=None):
+    '''
+    Process a single image to extract colony sizes.
+    '''
+    
+    #Prepare image
+    with timing.stage('check_and_negate'):
+        image = check_and_negate(orig_image, negate=negate, dtype=dtype)
+    
+    #Make mask
+    info = {}
+    with timing.stage('make_mask'):
+        mask = make_mask(image, t=t, s=s, hardImageThreshold=hardImageThreshold, hardSizeThreshold=hardSizeThreshold, local=localThresh, convexhull=convexhull, fillholes=fillholes, bgDownsample=bgDownsample, tile_size=tileSize, info=info)
+    
+    data = measure_colonies(mask, image)
+    data = assign_to_grid(data, image, grid, auto, d=d, reportAll=reportAll, gridTemplate=gridTemplate, affine=affine)
+    data.attrs['threshold'] = info['threshold']
+    
     #Make qc image
-    qc = label2rgb(mask, image=orig_image, bg_label=0)
+    with timing.stage('qc_image'):
+        qc = label2rgb(mask, image=orig_image, bg_label=0)
     
     return (data, qc)
 
-def quantify_single_image_redness(orig_image, grid, auto, t=1, d=3, s=1, negate=True, reportAll=False, hardImageThreshold=None, hardSizeThreshold=None):
+def quantify_single_image_redness(orig_image, grid, auto, t=1, d=3, s=1, negate=True, reportAll=False, hardImageThreshold=None, hardSizeThreshold=None, bgDownsample=1, dtype=np.float64, gridTemplate=None, affine=False):
     '''
     Process a single image (phloxine mode).
     '''
     
     #Prepare image
-    image = prepare_redness_image(orig_image)
-    
-    #Create grid
-    if auto:
-        grid, griddist = make_grid_auto(image, grid)
-    else:
-        grid, griddist = make_grid(grid)
+    with timing.stage('prepare_redness_image'):
+        image = prepare_redness_image(orig_image, bgDownsample=bgDownsample, dtype=dtype)
     
     #Make mask
     #Adjust threshold for redness images slightly, just what works in practise. t parameter is still applied as additional coefficient
-    mask = make_mask(image, t=1.02*t, s=s, hardImageThreshold=hardImageThreshold, hardSizeThreshold=hardSizeThreshold, local=True)
+    info = {}
+    with timing.stage('make_mask'):
+        mask = make_mask(image, t=1.02*t, s=s, hardImageThreshold=hardImageThreshold, hardSizeThreshold=hardSizeThreshold, local=True, bgDownsample=bgDownsample, info=info)
     
-    #Measure regionprobs
-    data = {r.label : {p : r[p] for p in ['label', 'area', 'centroid', 'mean_intensity', 'perimeter']} for r in regionprops(mask, intensity_image=image)}
-    data = pd.DataFrame(data).transpose()
+    data = measure_colonies(mask, image)
+    data = assign_to_grid(data, image, grid, auto, d=d, reportAll=reportAll, gridTemplate=gridTemplate, affine=affine)
+    data.attrs['threshold'] = info['threshold']
     
-    blob_to_pos = match_to_grid(data['label'], data['centroid'], grid, griddist, d=d, reportAll=reportAll)
+    #Make qc image, add bounding boxes to blobs with grid assigned
+    with timing.stage('qc_image'):
+        qc = np.copy(orig_image)
+        for region in regionprops(mask):
+            if region.label in data['label']: 
+                minr, minc, maxr, maxc = region.bbox
+                bboxrows, bboxcols = rectangle_perimeter([minr, minc], end=[maxr, maxc], shape=image.shape, clip=True)
+                qc[bboxrows, bboxcols,:] = np.array((255,255,255))
+
+    return (data, qc)
     
-    #Select only those blobs which have a corresponding grid position
-    data = data.loc[[l in blob_to_pos for l in data['label']]]
+def quantify_single_image(orig_image, image_name, grid, auto, mode, qc='qc_images', out='pyphe_quant', t=1, d=3, s=1, negate=True, reportAll=False, hardImageThreshold=None, hardSizeThreshold=None, localThresh=None, convexhull=False, fillholes=False, bgDownsample=1, dtype=np.float64, gridTemplate=None, affine=False, tileSize=None, store=None):
+    '''
+    Analyse a single image in batch or redness mode and save the results table and qc image. Set out or qc to None to skip saving the results table or qc image. If the path of a result store is given as store, the results table is written to the store instead of out (see save_results). In batch mode, the mask can be made in tiles of size tileSize (see make_mask_tiled). Returns the results table.
+    '''
     
-    #Add grid position information to table
-    data['row'] = data['label'].map(lambda x: blob_to_pos[x].split('-')[0])
-    data['column'] = data['label'].map(lambda x: blob_to_pos[x].split('-')[1])
+    if mode == 'batch':
+        data, qc_image = quantify_single_image_size(orig_image, grid, auto, t=t, d=d, s=s, negate=negate, reportAll=reportAll, hardImageThreshold=hardImageThreshold, hardSizeThreshold=hardSizeThreshold, localThresh=localThresh, convexhull=convexhull, fillholes=fillholes, bgDownsample=bgDownsample, dtype=dtype, gridTemplate=gridTemplate, affine=affine, tileSize=tileSize)
+    elif mode == 'redness':
+        data, qc_image = quantify_single_image_redness(orig_image, grid, auto, t=t, d=d, s=s, negate=negate, reportAll=reportAll, hardImageThreshold=hardImageThreshold, hardSizeThreshold=hardSizeThreshold, bgDownsample=bgDownsample, dtype=dtype, gridTemplate=gridTemplate, affine=affine)
+    else:
+        raise ValueError('Mode must be batch or redness.')
     
-    #Add circularity
-    data['circularity'] = (4 * math.pi * data['area']) / (data['perimeter']**2)
+    return save_results(data, qc_image, image_name, mode, qc=qc, out=out, reportAll=reportAll, store=store)
+
+def save_results(data, qc_image, image_name, mode, qc='qc_images', out='pyphe_quant', reportAll=False, store=None):
+    '''
+    Save the results table and the annotated qc image of a single image in batch or redness mode. Set out or qc to None to skip saving the results table or qc image. If the path of a result store (an SQLite database, see pyphe.store) is given as store, the results table, threshold, grid fit and timings of the image are written to the store instead of a csv file in out. Returns the results table.
+    '''
     
-    #Make qc image, add bounding boxes to blobs with grid assigned
-    qc = np.copy(orig_image)
-    for region in regionprops(mask):
-        if region.label in data['label']: 
-            minr, minc, maxr, maxc = region.bbox
-            bboxrows, bboxcols = rectangle_perimeter([minr, minc], end=[maxr, maxc], shape=image.shape, clip=True)
-            qc[bboxrows, bboxcols,:] = np.array((255,255,255))
+    if not reportAll:
+        data = data.drop('label', axis=1)
+    if store is not None:
+        with timing.stage('write_store'):
+            write_results(store, image_name, data, mode=mode, timings=timing.image_timings(image_name))
+    elif out is not None:
+        with timing.stage('write_csv'):
+            data.to_csv(os.path.join(out, image_name+'.csv'))
 
-    return (data, qc)
+    #Add labels and grid positions to qc image and save
+    if qc is None:
+        return data
+    with timing.stage('qc_plot'):
+        from matplotlib import pyplot as plt
+        import seaborn as sns
+        #Draw qc images in the seaborn white style, which does not depend on styles set by other modules
+        with sns.axes_style('white'):
+            fig, ax = plt.subplots()
+            ax.imshow(qc_image)
+            if not reportAll:
+                annot = data['row'].astype(str) + '-' + data['column'].astype(str)
+            else:
+                annot = data['label']
+            if mode == 'redness':
+                annot = annot + '\n' + data['mean_intensity'].astype(float).round(4).astype(str)
+            for (i,r), a in zip(data.iterrows(), annot):
+                ax.text(r['centroid'][1], r['centroid'][0], a, fontdict={'size':1.5, 'color':'w'})
+                
+            plt.savefig(os.path.join(qc, 'qc_'+image_name+'.png'), dpi=900)
+            plt.clf()
+            plt.close()
     
-def quantify_batch(images, grid, auto, mode, qc='qc_images', out='pyphe_quant', t=1, d=3, s=1, negate=True, reportAll=False, reportFileNames=None, hardImageThreshold=None, hardSizeThreshold=None, localThresh=None, convexhull=False):
+    return data
+    
+def quantify_raw_scan(raw, geometry, image_names, grid, auto, qc='qc_images', out='pyphe_quant', t=1, d=3, s=1, negate=True, reportAll=False, hardImageThreshold=None, hardSizeThreshold=None, localThresh=None, convexhull=False, fillholes=False, bgDownsample=1, dtype=np.float64, gridTemplate=None, affine=False, store=None):
     '''
-    Analyse colony size for batch of plates. Depending on mode, either the quantify_single_image_grey or quantify_single_image_redness function is applied to all images.
+    Analyse colony sizes of all plates of a raw (uncropped) scan, without writing and reading back cropped plate images. The plates are taken from the raw scan as views, rotated in the same way as by pyphe-scan (see scan.crop_plates), and stacked into a single working image, separated by an empty row. Thresholding, filling holes, filtering of small objects and labelling are done once for the whole stack. Colonies are then split into plates by their position and matched to the grid of each plate. The Otsu threshold is computed from the pooled histogram of all plates (see threshold_otsu_pooled), unless localThresh or hardImageThreshold is set, and can therefore differ slightly from that of quantifying each cropped plate separately. Apart from this, results are the same as those of quantify_single_image on the cropped plates.
+    
+    Required arguments:
+    raw (ndarray) -- The raw scan.
+    geometry (list) -- Geometry strings of the bays, scaled to the scan resolution (see fixtures.scale_geometry).
+    image_names (list) -- Name of the plate in each bay, used for naming output files. Bays with name None are skipped (e.g. empty bays in the last scan of a batch).
+    grid, auto -- Grid of each plate, as returned by parse_grid.
+    
+    All other arguments are the same as for quantify_single_image. gridTemplate must be None or a template as returned by make_grid_template.
+    
+    Returns:
+    results (dict) -- Results tables of all plates, with image names as keys.
     '''
-
-    for fname, im in zip(images.files, images):
-        
-        if mode == 'batch':
-            data, qc_image = quantify_single_image_size(np.copy(im), grid, auto, t=t, d=d, s=s, negate=negate, reportAll=reportAll, hardImageThreshold=hardImageThreshold, hardSizeThreshold=hardSizeThreshold, localThresh=localThresh, convexhull=convexhull)
-        elif mode == 'redness':
-            data, qc_image = quantify_single_image_redness(np.copy(im), grid, auto, t=t, d=d, s=s, negate=negate, reportAll=reportAll, hardImageThreshold=hardImageThreshold, hardSizeThreshold=hardSizeThreshold)
+    
+    bays = [(name, parse_geometry(g)) for name, g in zip(image_names, geometry) if name is not None]
+    plates = [raw[y:y+h, x:x+w].swapaxes(0,1) for name, (w, h, x, y) in bays]
+    starts = np.cumsum([0] + [p.shape[0]+1 for p in plates])
+    views = [np.s_[a:a+p.shape[0], :p.shape[1]] for a, p in zip(starts, plates)]
+    
+    #Stack working images of all plates
+    with timing.stage('check_and_negate'):
+        image = np.zeros((starts[-1]-1, max(p.shape[1] for p in plates)), dtype=dtype)
+        for v, p in zip(views, plates):
+            check_and_negate(p, negate=negate, dtype=dtype, out=image[v])
+    
+    with timing.stage('threshold'):
+        mask = np.zeros(image.shape, dtype=bool)
+        if localThresh:
+            for v in views:
+                mask[v] = image[v] > t*estimate_background(image[v], 25.0, downsample=bgDownsample, mode='reflect')
+            thresh = None
         else:
-            raise ValueError('Mode must be batch or redness.')
+            if hardImageThreshold:
+                thresh = hardImageThreshold
+            else:
+                thresh = t*threshold_otsu_pooled([image[v] for v in views])
+            for v in views:
+                mask[v] = image[v] > thresh
+    
+    #Plates are separated by background so that no objects are joined across plates
+    if convexhull:
+        with timing.stage('convex_hull_objects'):
+            mask = convex_hull_objects(mask)
+    elif fillholes:
+        with timing.stage('fill_holes'):
+            mask = binary_fill_holes(mask)
+    
+    #The default size threshold depends on the plate area, so filter each plate separately
+    with timing.stage('remove_small_objects'):
+        for v in views:
+            size_thresh = hardSizeThreshold if hardSizeThreshold else s * np.prod(image[v].shape) * 0.00005
+            remove_small_objects(mask[v], min_size=size_thresh, out=mask[v])
+    
+    #Label once and find objects touching the border of their plate
+    with timing.stage('label'):
+        labels = label(mask)
+        keep = np.ones(labels.max()+1, dtype=bool)
+        for v in views:
+            lv = labels[v]
+            for edge in [lv[0], lv[-1], lv[:,0], lv[:,-1]]:
+                keep[edge] = False
+        keep[0] = False
+        #Labels are numbered in raster order, so the objects of each plate have consecutive labels. Renumber them from 1 for each plate, without the removed objects
+        renumber = (np.cumsum(keep)*keep).astype(labels.dtype)
+    
+    results = {}
+    first = 1
+    for (name, g), v, p in zip(bays, views, plates):
+        timing.set_image(name)
+        with timing.stage('label'):
+            last = max(first-1, labels[v].max())
+            plate_renumber = np.zeros(last+1, dtype=labels.dtype)
+            plate_renumber[first:] = np.maximum(renumber[first:last+1] - renumber[:first].max(), 0)
+            plate_labels = plate_renumber[labels[v]]
+            first = last+1
         
-        image_name = os.path.basename(fname)
-        if not reportAll:
-            data.drop('label', axis=1).to_csv(os.path.join(out, image_name+'.csv'))
-        else:
-            data.to_csv(os.path.join(out, image_name+'.csv'))
+        data = measure_colonies(plate_labels, image[v])
+        data = assign_to_grid(data, image[v], grid, auto, d=d, reportAll=reportAll, gridTemplate=gridTemplate, affine=affine)
+        data.attrs['threshold'] = thresh
+        qc_image = None
+        if qc is not None:
+            with timing.stage('qc_image'):
+                qc_image = label2rgb(plate_labels, image=p, bg_label=0)
+        results[name] = save_results(data, qc_image, name, 'batch', qc=qc, out=out, reportAll=reportAll, store=store)
     
-        #Add labels and grid positions to qc image and save
-        fig, ax = plt.subplots()
-        ax.imshow(qc_image)
-        if not reportAll:
-            data['annot'] = data['row'].astype(str) + '-' + data['column'].astype(str)
+    return results
+
+def quantify_batch(images, grid, auto, mode, qc='qc_images', out='pyphe_quant', t=1, d=3, s=1, negate=True, reportAll=False, reportFileNames=None, hardImageThreshold=None, hardSizeThreshold=None, localThresh=None, convexhull=False, fillholes=False, bgDownsample=1, dtype=np.float64, gridTemplate=None, affine=False, geometry=None, tileSize=None, batchThreshold=False, store=None):
+    '''
+    Analyse colony size for batch of plates. Depending on mode, either the quantify_single_image_grey or quantify_single_image_redness function is applied to all images. If gridTemplate is given, the grid is only fitted once and then placed on each image with apply_grid_template. gridTemplate can be "first" (fit on the first image) or the path to a template file, which is loaded if it exists or otherwise fitted on the first image and saved.
+    If geometry (a list of geometry strings scaled to the scan resolution, see fixtures.scale_geometry) is given, images are raw scans of a fixture and all plates of each scan are quantified together with quantify_raw_scan, in batch mode only. Plates are named <scan name>_bay<n>, bays are numbered in the order of the geometry strings.
+    If batchThreshold is True (batch mode only), a single Otsu threshold is computed from the pooled histograms of all plates and used for all of them (see batch_threshold), unless hardImageThreshold is given. The threshold of each plate and its deviation from the pooled threshold are saved as pyphe-quantify_thresholds.csv in the output folder.
+    If the path of a result store is given as store, the results tables of all images are written to this store instead of one csv file per image in out (see save_results).
+    Set out or qc to None to skip saving results tables or qc images. Returns a dictionary of results tables, with image file names (or plate names) as keys.
+    '''
+    
+    if geometry is not None and mode != 'batch':
+        raise ValueError('Raw scans can only be quantified in batch mode.')
+    if batchThreshold and (mode != 'batch' or localThresh):
+        raise ValueError('A batch threshold can only be used in batch mode and not with local thresholding.')
+    
+    bays = [parse_geometry(g) for g in geometry] if geometry is not None else None
+    bay_names = lambda fname: ['%s_bay%i'%(os.path.splitext(os.path.basename(fname))[0], b+1) for b in range(len(bays))]
+    
+    if batchThreshold and not hardImageThreshold:
+        def plates():
+            for i, fname in enumerate(images.files):
+                im = images[i]
+                if bays is None:
+                    yield os.path.basename(fname), im
+                else:
+                    for name, (w, h, x, y) in zip(bay_names(fname), bays):
+                        yield name, im[y:y+h, x:x+w]
+        
+        timing.set_image(None)
+        with timing.stage('batch_threshold'):
+            threshold, report = batch_threshold(plates(), negate=negate)
+        hardImageThreshold = t*threshold
+        print('Using threshold %.4f for all plates (pooled Otsu threshold %.4f, multiplied by t)'%(hardImageThreshold, threshold))
+        flagged = report.index[report['Flagged']]
+        if len(flagged) > 0:
+            print('Otsu thresholds of %i plates deviate by more than 10%% from the pooled threshold: %s'%(len(flagged), ', '.join(map(str, flagged))))
+        if out is not None:
+            report.to_csv(os.path.join(out, 'pyphe-quantify_thresholds.csv'))
+    
+    template = None
+    if gridTemplate:
+        if gridTemplate != 'first' and os.path.exists(gridTemplate):
+            template = load_grid_template(gridTemplate)
+            print('Using grid template %s'%gridTemplate)
         else:
-            data['annot'] = data['label']
-        if mode == 'redness':
-            data['annot'] = data['annot'] + '\n' + data['mean_intensity'].astype(float).round(4).astype(str)
-        for i,r in data.iterrows():
-            ax.text(r['centroid'][1], r['centroid'][0], r['annot'], fontdict={'size':1.5, 'color':'w'})
-                
-        plt.savefig(os.path.join(qc, 'qc_'+image_name+'.png'), dpi=900)
-        plt.clf()
-        plt.close()
+            timing.set_image(os.path.basename(images.files[0]))
+            with timing.stage('make_grid_template'):
+                if mode == 'redness':
+                    ref = prepare_redness_image(images[0], bgDownsample=bgDownsample, dtype=dtype)
+                elif geometry is not None:
+                    w, h, x, y = bays[0]
+                    ref = check_and_negate(images[0][y:y+h, x:x+w].swapaxes(0,1), negate=negate, dtype=dtype)
+                else:
+                    ref = check_and_negate(images[0], negate=negate, dtype=dtype)
+                centroids = [r.centroid for r in regionprops(make_mask(ref, local=(mode == 'redness')))] if affine else None
+                template = make_grid_template(ref, grid, auto, centroids=centroids)
+            del ref
+            if gridTemplate != 'first':
+                save_grid_template(template, gridTemplate)
+                print('Grid template fitted on %s and saved to %s'%(images.files[0], gridTemplate))
 
-def quantify_single_image_fromTimecourse(orig_image, mask, negate=True, calibrate='x'):
+    results = {}
+    for i, fname in enumerate(images.files):
+        timing.set_image(os.path.basename(fname))
+        with timing.stage('load_image'):
+            im = images[i]
+        if geometry is not None:
+            results.update(quantify_raw_scan(im, geometry, bay_names(fname), grid, auto, qc=qc, out=out, t=t, d=d, s=s, negate=negate, reportAll=reportAll, hardImageThreshold=hardImageThreshold, hardSizeThreshold=hardSizeThreshold, localThresh=localThresh, convexhull=convexhull, fillholes=fillholes, bgDownsample=bgDownsample, dtype=dtype, gridTemplate=template, affine=affine, store=store))
+            continue
+        results[os.path.basename(fname)] = quantify_single_image(im, os.path.basename(fname), grid, auto, mode, qc=qc, out=out, t=t, d=d, s=s, negate=negate, reportAll=reportAll, hardImageThreshold=hardImageThreshold, hardSizeThreshold=hardSizeThreshold, localThresh=localThresh, convexhull=convexhull, fillholes=fillholes, bgDownsample=bgDownsample, dtype=dtype, gridTemplate=template, affine=affine, tileSize=tileSize, store=store)
+    
+    return results
+
+def make_colony_index(mask, background_step=8):
+    '''
+    Precompute the positions of all colony pixels in a labelled mask and of a sample of background pixels, so that colony and background intensities can be gathered from timeseries images without passes over the full image. The background sample consists of the background pixels in every background_step-th row. As whole rows are skipped, only a fraction of each image is read. With the default of every 8th row, the mean background intensity differs from that of all background pixels by less than 0.01 (on the 0-255 scale of 8-bit images) for the test images.
+    
+    Required arguments:
+    mask (ndarray) -- Labelled mask, e.g. as returned by make_mask.
+    
+    Keyword arguments:
+    background_step (int) -- Take the background sample from every background_step-th row. Set to 1 to use all background pixels.
+    
+    Returns:
+    labels (ndarray) -- Labels of all colonies.
+    pixels (ndarray) -- Flat indices of all colony pixels.
+    pixel_labels (ndarray) -- For each colony pixel, the index of its label in labels.
+    background (ndarray) -- Flat indices of the background sample.
+    '''
+    
+    flat = mask.ravel()
+    pixels = np.flatnonzero(flat)
+    labels, pixel_labels = np.unique(flat[pixels], return_inverse=True)
+    rows, cols = np.nonzero(mask[::background_step] == 0)
+    background = rows*(background_step*mask.shape[1]) + cols
+    return labels, pixels, pixel_labels, background
+
+def make_annulus_index(mask, labels, width, gap=2):
     '''
-    Apply a previously determined mask to an image from a timeseries.
+    Precompute an annulus of background pixels around each colony in a labelled mask, used for estimating the local background of each colony. Annuli start gap pixels from the colony edge and are width pixels wide. Background pixels are assigned to the closest colony only, so annuli of neighbouring colonies do not overlap and never contain colony pixels.
+    
+    Required arguments:
+    mask (ndarray) -- Labelled mask, e.g. as returned by make_mask.
+    labels (ndarray) -- Labels of all colonies, as returned by make_colony_index.
+    width (int) -- Width of the annulus in pixels.
+    
+    Keyword arguments:
+    gap (int) -- Distance between colony edge and annulus in pixels.
+    
+    Returns:
+    ring_pixels (ndarray) -- Flat indices of all annulus pixels.
+    ring_labels (ndarray) -- For each annulus pixel, the index of its colony in labels.
     '''
     
+    #expand_labels requires scikit-image 0.18 or later, import it here so that other modes work with older versions
+    from skimage.segmentation import expand_labels
+    
+    outer = expand_labels(mask, distance=gap+width).ravel()
+    inner = expand_labels(mask, distance=gap).ravel() if gap > 0 else mask.ravel()
+    ring_pixels = np.flatnonzero((outer > 0) & (inner == 0))
+    ring_labels = np.searchsorted(labels, outer[ring_pixels])
+    return ring_pixels, ring_labels
+
+def quantify_single_image_fromTimecourse(orig_image, mask, negate=True, calibrate='x', colony_index=None, annulus_index=None):
+    '''
+    Apply a previously determined mask to an image from a timeseries. Only the colony pixels and a sample of background pixels are gathered from the image (see make_colony_index, pass colony_index to avoid recomputing it for every image). By default, a single mean background intensity, the mean of the background sample, is subtracted. If annulus_index is given (see make_annulus_index), the local background of each colony is estimated from the mean of its annulus instead. Colonies without any annulus pixels fall back to the global mean.
+    '''
+    
+    if colony_index is None:
+        colony_index = make_colony_index(mask)
+    labels, pixels, pixel_labels, background = colony_index
+    
     #Prepare image. Don't do any scaling. The scaling depends on the maximum and minimum pixel intensity which is not very stable.
     #Negate images if required
+    values = orig_image.ravel()[pixels]
+    bgvalues = orig_image.ravel()[background]
     if negate:
-        image = invert(orig_image)
-    else:
-        image = orig_image
+        values = invert(values)
+        bgvalues = invert(bgvalues)
 
     #Get background intensity
-    bgmask = (mask==0).astype(int)
-    bgdata = {r.label : r['mean_intensity'] for r in regionprops(bgmask, intensity_image=image)}
-    bgmean = bgdata[1]
-    #subtract mean background from image, floor again to avoid rare case of negative values
-    image = image - bgmean
+    bgmean = bgvalues.mean(dtype=np.float64)
+    if annulus_index is not None:
+        ring_pixels, ring_labels = annulus_index
+        ring_values = orig_image.ravel()[ring_pixels]
+        if negate:
+            ring_values = invert(ring_values)
+        ring_counts = np.bincount(ring_labels, minlength=len(labels))
+        ring_sums = np.bincount(ring_labels, weights=ring_values, minlength=len(labels))
+        bgmean = np.where(ring_counts > 0, ring_sums/np.maximum(ring_counts, 1), bgmean)[pixel_labels]
+    #subtract mean background from colony pixels, floor again to avoid rare case of negative values
+    image = values - bgmean
     image[image<0] = 0
 
     #transform with calibration function
     image_trafo = eval(calibrate.replace('x', 'image'))
     
     #Get intensity data for each blob
-    data = {r.label : r['mean_intensity']*r['area'] for r in regionprops(mask, intensity_image=image_trafo)}
+    sums = np.bincount(pixel_labels, weights=image_trafo, minlength=len(labels))
+    data = dict(zip(labels.tolist(), sums))
 
     return data
 
         
-def quantify_timecourse(images, grid, auto, qc='qc_images', out='pyphe_quant', t=1, d=3, s=1, negate=True, reportAll=False, reportFileNames=False, hardImageThreshold=None, hardSizeThreshold=None, calibrate='x', timepoints=None, localThresh=None, convexhull=False):
+def make_image_stack(files, path, workers=None):
     '''
-    Analyse a timeseries of images. Make the mask based on the last image and extract intensity information from all previous images based on that.
+    Decode a timeseries of 8-bit greyscale images once and store them as a single memory-mapped stack (frames x height x width) in npy format. Images are decoded in parallel. The list of source files and their modification times is saved next to the stack (path + ".files.txt") so that load_image_stack can check whether the stack is still up to date.
+    
+    Required arguments:
+    files (list) -- Paths of the images in the timeseries.
+    path (str) -- Path of the stack file.
+    
+    Keyword arguments:
+    workers (int) -- Number of threads for decoding. Defaults to the number of processors.
+    
+    Returns:
+    stack (ndarray) -- Read-only memory-mapped array.
     '''
-    #Get final image
-    if negate:
-        fimage = invert(images[-1])   
-    else: 
-        fimage = images[-1]
+    from skimage.io import imread
     
-    #Create grid
-    if auto:
-        grid, griddist = make_grid_auto(fimage, grid)
+    first = imread(files[0])
+    if (first.dtype != np.uint8) or (first.ndim != 2):
+        raise ValueError('Image stacks are only supported for 8-bit greyscale images.')
+    stack = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(len(files),)+first.shape)
+    stack[0] = first
+    
+    def decode(i):
+        image = imread(files[i])
+        if image.shape != first.shape:
+            raise ValueError('All images in a timeseries must have the same dimensions, %s does not.'%files[i])
+        stack[i] = image
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(decode, range(1, len(files))))
+    stack.flush()
+    del stack
+    
+    with open(path+'.files.txt', 'w') as fh:
+        fh.write(''.join('%s\t%s\n'%(f, os.path.getmtime(f)) for f in files))
+    
+    return np.load(path, mmap_mode='r')
+
+def load_image_stack(files, path, workers=None):
+    '''
+    Return the memory-mapped image stack at path if it exists and was made from the same, unmodified files. Otherwise make it first with make_image_stack.
+    '''
+    
+    if os.path.exists(path) and os.path.exists(path+'.files.txt'):
+        with open(path+'.files.txt', 'r') as fh:
+            stacked = fh.read()
+        if stacked == ''.join('%s\t%s\n'%(f, os.path.getmtime(f)) for f in files):
+            print('Using image stack %s'%path)
+            return np.load(path, mmap_mode='r')
+    
+    print('Making image stack %s'%path)
+    return make_image_stack(files, path, workers=workers)
+
+def quantify_timecourse(images, grid, auto, qc='qc_images', out='pyphe_quant', t=1, d=3, s=1, negate=True, reportAll=False, reportFileNames=False, hardImageThreshold=None, hardSizeThreshold=None, calibrate='x', timepoints=None, localThresh=None, convexhull=False, fillholes=False, bgDownsample=1, gridTemplate=None, affine=False, localBackground=0, stack=False, tileSize=None):
+    '''
+    Analyse a timeseries of images. Make the mask based on the last image and extract intensity information from all previous images based on that. If gridTemplate is the path of an existing template file, the grid is placed on the last image with apply_grid_template. If the file does not exist, the grid fitted on the last image is saved as template. If localBackground > 0, the background of each colony is estimated from an annulus of that width around it (see make_annulus_index) rather than from a sample of all background pixels (see make_colony_index). If stack is True, all images are first decoded into a memory-mapped stack saved in the output folder (see load_image_stack), which is re-used when the same images are analysed again. If tileSize is given, the mask is made in tiles of this size (see make_mask_tiled).
+    Set out or qc to None to skip saving the results table (and image stack) or qc image. Returns the results table.
+    '''
+    image_name = os.path.basename(images.files[-1])
+    timing.set_image(image_name)
+    
+    #Decode all images into a memory-mapped stack or read them from the collection when needed
+    if stack and (out is not None):
+        with timing.stage('load_image_stack'):
+            frames = load_image_stack(images.files, os.path.join(out, image_name+'.stack.npy'))
     else:
-        grid, griddist = make_grid(grid)
+        frames = images
+    
+    #Get final image
+    with timing.stage('load_image'):
+        if negate:
+            fimage = invert(frames[-1])   
+        else: 
+            fimage = frames[-1]
     
     #Make mask
-    mask = make_mask(fimage, t=t, s=s, hardSizeThreshold=hardSizeThreshold, convexhull=convexhull)
+    with timing.stage('make_mask'):
+        mask = make_mask(fimage, t=t, s=s, hardSizeThreshold=hardSizeThreshold, convexhull=convexhull, fillholes=fillholes, tile_size=tileSize)
+    
+    #Create grid
+    with timing.stage('make_grid'):
+        centroids = [r.centroid for r in regionprops(mask)] if affine else None
+        if gridTemplate and gridTemplate != 'first' and os.path.exists(gridTemplate):
+            grid, griddist = apply_grid_template(fimage, load_grid_template(gridTemplate))
+        elif gridTemplate and gridTemplate != 'first':
+            template = make_grid_template(fimage, grid, auto, centroids=centroids)
+            save_grid_template(template, gridTemplate)
+            grid, griddist = apply_grid_template(fimage, template)
+        elif auto and affine:
+            grid, griddist = make_grid_affine(centroids, grid, fimage.shape)
+        elif auto:
+            grid, griddist = make_grid_auto(fimage, grid)
+        else:
+            grid, griddist = make_grid(grid)
     
     #Make table of intensities over time
-    data = {fname : quantify_single_image_fromTimecourse(orig_image, mask, negate=negate, calibrate=calibrate) for fname,orig_image in zip(images.files, images)}
+    colony_index = make_colony_index(mask)
+    annulus_index = make_annulus_index(mask, colony_index[0], localBackground) if localBackground else None
+    data = {}
+    for i, fname in enumerate(images.files):
+        timing.set_image(os.path.basename(fname))
+        with timing.stage('load_image'):
+            orig_image = frames[i]
+        with timing.stage('quantify_frame'):
+            data[fname] = quantify_single_image_fromTimecourse(orig_image, mask, negate=negate, calibrate=calibrate, colony_index=colony_index, annulus_index=annulus_index)
     data = pd.DataFrame(data).transpose()
+    timing.set_image(image_name)
     
     #Get centroids and match to positions
-    centroids = {r.label : r['centroid'] for r in regionprops(mask)}
-    blob_to_pos = match_to_grid(centroids.keys(), centroids.values(), grid, griddist, d=d, reportAll=reportAll)
+    with timing.stage('match_to_grid'):
+        centroids = {r.label : r['centroid'] for r in regionprops(mask)}
+        blob_to_pos = match_to_grid(centroids.keys(), centroids.values(), grid, griddist, d=d, reportAll=reportAll)
     
     #Select only those blobs which have a corresponding grid position
     data = data.loc[:,[l in blob_to_pos for l in data.columns]]
@@ -374,45 +1262,54 @@ def quantify_timecourse(images, grid, auto, qc='qc_images', out='pyphe_quant', t
             data.index = range(1,len(data.index)+1)
 
     #Save table
-    image_name = os.path.basename(images.files[-1])
-    data.to_csv(os.path.join(out, image_name+'.csv'))
+    if out is not None:
+        with timing.stage('write_csv'):
+            data.to_csv(os.path.join(out, image_name+'.csv'))
 
     #make qc image
-    qc_image = label2rgb(mask, image=images[-1], bg_label=0)
-    fig, ax = plt.subplots()
-    ax.imshow(qc_image)
-    if not reportAll:
-        for blob in blob_to_pos:
-            ax.text(centroids[blob][1], centroids[blob][0], blob_to_pos[blob], fontdict={'size':1.5, 'color':'w'})
-    else:
-        for blob in blob_to_pos:
-            ax.text(centroids[blob][1], centroids[blob][0], blob, fontdict={'size':1.5, 'color':'w'})
+    if qc is None:
+        return data
+    with timing.stage('qc_plot'):
+        from matplotlib import pyplot as plt
+        import seaborn as sns
+        with sns.axes_style('white'):
+            qc_image = label2rgb(mask, image=frames[-1], bg_label=0)
+            fig, ax = plt.subplots()
+            ax.imshow(qc_image)
+            if not reportAll:
+                for blob in blob_to_pos:
+                    ax.text(centroids[blob][1], centroids[blob][0], blob_to_pos[blob], fontdict={'size':1.5, 'color':'w'})
+            else:
+                for blob in blob_to_pos:
+                    ax.text(centroids[blob][1], centroids[blob][0], blob, fontdict={'size':1.5, 'color':'w'})
 
-    plt.savefig(os.path.join(qc, 'qc_'+image_name+'.png'), dpi=900)
-    plt.clf()
-    plt.close()
+            plt.savefig(os.path.join(qc, 'qc_'+image_name+'.png'), dpi=900)
+            plt.clf()
+            plt.close()
+    
+    return data
 
-def prepare_redness_image(orig_image):
+def prepare_redness_image(orig_image, bgDownsample=1, dtype=np.float64):
     '''
-    Prepare image for thresholding and analysis. Channels are weighted by (0, 0.5, 1) and summed. The background is estimated by gaussian blur and subtracted. The image is inverted.
+    Prepare image for thresholding and analysis. Channels are weighted by (0, 0.5, 1) and summed. The background is estimated by gaussian blur, at a resolution reduced by bgDownsample (see estimate_background), and subtracted. The image is inverted. Like in check_and_negate, the input image is not modified and the working image of the given float dtype is processed in-place.
     '''
-    image = np.copy(orig_image)
 
     #Color channel transformations and convert to grey
-    image = 0.5*image[:,:,1] + 1*image[:,:,2]
+    image = orig_image[:,:,1].astype(dtype)
+    image *= 0.5
+    image += orig_image[:,:,2]
     #Convert to float and rescale to range [0,1]
     #I don't think other fancier methods for histogram normalisation are suitable or required since simple thresholding is applied later
 
     #Estimate background by gaussian. Scale sigma with image area to compensate for different resolutions
-    background = gaussian(image, sigma=np.prod(image.shape)/10000, truncate=4) 
-    image = image - background #This may contain some negative values
+    background = estimate_background(image, np.prod(image.shape)/10000, downsample=bgDownsample)
+    image -= background #This may contain some negative values
+    del background
 
     #Scale image to [0,1] in invert
-    image = image.astype(float)
-    image = image - np.min(image)
-    image = image/np.max(image)
-    image = 1 - image
+    image -= np.min(image)
+    image /= np.max(image)
+    np.subtract(1, image, out=image)
     
     return image
   
-
@@ -1,20 +1,27 @@
-from shutil import which
-from subprocess import check_output
+from subprocess import check_output, Popen, PIPE, CalledProcessError
 from warnings import warn
 import sys
-from os import mkdir
+from os import mkdir, path
 import numpy as np
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_EXCEPTION
+from threading import Event
 import time
+from tempfile import SpooledTemporaryFile
+from shutil import copyfileobj
+import tifffile
+from skimage.io import imsave, imread
+from skimage.transform import downscale_local_mean
 
-def find_scanner(scanner_index):
+from pyphe.fixtures import parse_geometry, scale_geometry
+
+#Scanner output larger than this (in bytes) is spooled to a temporary file on disk rather than held in memory while it is decoded
+spool_size = 16*2**20
+
+def find_scanners():
     '''
-    This function performs a few vital checks before initialising scan sequence and selects a suitable scanner. 
+    This function performs a few vital checks before initialising scan sequence and returns the device names of all scanners found by SANE, in the order reported by scanimage -L.
     '''
-    #Check if ImageMagick can be called from command line
-    if which('convert') is None:
-        raise ImportError("Cannot find ImageMagick's convert tool. Please make sure ImageMagick is installed and can be called from the command line.")
-    
     #Look for scanners
     print('Searching for scanners.')
     scanner_list = check_output('scanimage -L', shell=True).decode('ascii')
@@ -23,14 +30,125 @@ def find_scanner(scanner_index):
     scanner_list = [s for s in scanner_list.split('\n') if not s.strip()=='']
     scanner_list = [s.split()[1][1:-1] for s in scanner_list]
     print('Scanners found: ' + str(scanner_list))
+    
+    return scanner_list
+
+def find_scanner(scanner_index):
+    '''
+    Select a single scanner by its position in the list returned by find_scanners(). 
+    '''
+    scanner_list = find_scanners()
     scanner = scanner_list[scanner_index-1]
 
     print('Using scanner %s'%scanner)
     return scanner
+
+def acquire_raw_scan(scanner, mode, resolution, raw_path, keep_raw='full'):
+    '''
+    Acquire a single raw scan with scanimage. With keep_raw='full', scanimage output is written directly to raw_path (uncompressed tiff). Otherwise, the output is piped into a temporary file (held in memory only for small scans, see spool_size), decoded from there and discarded, so that only the decoded scan is held in memory, and the scan is cropped from the decoded array. In this case, a zlib-compressed copy (keep_raw='compressed'), a 4-fold downsampled and compressed copy (keep_raw='downsampled') or no copy at all (keep_raw='none') of the raw scan is saved.
     
-def scan_batch(n, plateStart, prefix, postfix, fixture, resolution, geometries, scanner, mode, format):
+    Returns:
+    raw (str or ndarray) -- The path of the raw scan if keep_raw is 'full', otherwise the decoded raw scan. Can be passed to crop_plates().
     '''
-    High-level function for scanning a batch of plates. 
+    
+    if keep_raw not in ['full', 'compressed', 'downsampled', 'none']:
+        raise ValueError('keep_raw must be one of full, compressed, downsampled or none.')
+    
+    source = 'TPU8x10' if mode=='Gray' else 'Flatbed'
+    cmdStr = 'scanimage --source %s --mode %s --resolution %i --format=tiff --device-name=%s'%(source, mode, resolution, scanner)
+    
+    if keep_raw == 'full':
+        check_output(cmdStr + ' > %s'%raw_path, shell=True)
+        return raw_path
+    
+    with SpooledTemporaryFile(max_size=spool_size) as spool:
+        proc = Popen(cmdStr, shell=True, stdout=PIPE)
+        copyfileobj(proc.stdout, spool)
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise CalledProcessError(proc.returncode, cmdStr)
+        spool.seek(0)
+        raw = tifffile.imread(spool, name='scanimage.tiff')
+    
+    if keep_raw == 'compressed':
+        tifffile.imwrite(raw_path, raw, compression='zlib')
+    elif keep_raw == 'downsampled':
+        factors = (4, 4) if raw.ndim == 2 else (4, 4, 1)
+        tifffile.imwrite(raw_path, downscale_local_mean(raw, factors).astype(raw.dtype), compression='zlib')
+    
+    return raw
+
+def crop_plates(raw, geometry, out_paths, workers=4, decode_saved=False):
+    '''
+    Crop all plates from a raw scan and save them. The raw scan is decoded only once (memory-mapped if the tiff is uncompressed) and all crops are taken from the same buffer. Geometries are ImageMagick-style strings (<width>x<height>+<x-offset>+<y-offset>). Each crop is rotated by 90 degrees and flipped horizontally, like ImageMagick's -rotate 90 -flop, which amounts to a transposition and is applied as a view. Images are encoded in parallel.
+    
+    Required arguments:
+    raw (str or ndarray) -- Path to the raw scan tiff or the decoded raw scan.
+    geometry (list) -- List of geometry strings, one per plate.
+    out_paths (list) -- List of output file paths, one per plate. The image format is determined by the file extension.
+    
+    Keyword arguments:
+    decode_saved (bool) -- If True, plates saved as jpg are read back from the saved file, so that the returned plates are exactly the (lossy) images on disk. Plates saved in lossless formats are returned from memory. Defaults to False (the lossless crops are returned).
+    
+    Returns:
+    plates (list) -- The cropped images as arrays.
+    '''
+    
+    if isinstance(raw, str):
+        try:
+            raw = tifffile.memmap(raw, mode='r')
+        except ValueError:
+            #Compressed or non-contiguous tiffs can not be memory-mapped
+            raw = tifffile.imread(raw)
+    
+    def save_plate(g, out_path):
+        w, h, x, y = parse_geometry(g)
+        plate = np.ascontiguousarray(raw[y:y+h, x:x+w].swapaxes(0,1))
+        if out_path.lower().endswith(('.jpg', '.jpeg')):
+            imsave(out_path, plate, quality=92, check_contrast=False)
+            if decode_saved:
+                plate = imread(out_path)
+        else:
+            imsave(out_path, plate, check_contrast=False)
+        return plate
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        plates = list(executor.map(save_plate, geometry, out_paths))
+    
+    return plates
+
+def submit_quantification(executor, plate, image_path, out, qc, quantify_args):
+    '''
+    Submit a cropped plate for quantification with pyphe-quantify in the background. The plate is quantified from memory and should be the image as saved (see crop_plates(decode_saved=True)), so that results are the same as running pyphe-quantify on the saved plate. Completion or failure is reported on the command line as soon as the job has finished.
+    
+    Required arguments:
+    executor (Executor) -- The executor to run the job in.
+    plate (ndarray) -- The cropped plate image, as saved.
+    image_path (str) -- Path the plate image was saved to, used to name the results.
+    out (str) -- Folder to save the results table in.
+    qc (str) -- Folder to save the qc image in.
+    quantify_args (dict) -- Arguments passed on to quantify.quantify_single_image(). Must contain grid, auto and mode.
+    
+    Returns:
+    future (Future) -- The future of the job, the result is the results table.
+    '''
+    from pyphe.quantify import quantify_single_image
+    
+    image_name = path.basename(image_path)
+    future = executor.submit(quantify_single_image, plate, image_name, out=out, qc=qc, **quantify_args)
+    
+    def report(f):
+        if f.exception() is not None:
+            print('Quantification of %s failed: %s'%(image_name, str(f.exception())))
+        else:
+            print('Quantification of %s completed: %s'%(image_name, path.join(out, image_name+'.csv')))
+    future.add_done_callback(report)
+    
+    return future
+    
+def scan_batch(n, plateStart, prefix, postfix, fixture, resolution, geometries, scanner, mode, format, quantify_args=None, keep_raw='full'):
+    '''
+    High-level function for scanning a batch of plates. If quantify_args is given, each plate is quantified in a background process while the next scan proceeds (see submit_quantification()). keep_raw controls how raw scans are retained (see acquire_raw_scan()).
     '''
     
     ppscan = len(geometries[fixture])#plates per scan
@@ -39,18 +157,18 @@ def scan_batch(n, plateStart, prefix, postfix, fixture, resolution, geometries,
     geometry = geometries[fixture]
 
     print('Loaded geometry settings for fixture %s: '%fixture + str(geometry))
-    geometry_temp = []
-    for g in geometry:
-        glist = list(map(lambda x: str(int(int(x)*(resolution/600.0))), g.replace('+', 'x').split('x')))
-        geometry_temp.append(glist[0] + 'x' + glist[1] + '+' + glist[2] + '+' + glist[3])
-
-    print('Geometry settings scaled to resolution: ' + str(geometry_temp))
-    geometry = geometry_temp
+    geometry = scale_geometry(geometry, resolution)
+    print('Geometry settings scaled to resolution: ' + str(geometry))
 
     wdir = '%s_%s/'%(prefix,postfix)
     mkdir(wdir)
     rdir = wdir + 'raw_scans/'
-    mkdir(rdir)
+    if keep_raw != 'none':
+        mkdir(rdir)
+    if quantify_args is not None:
+        qexecutor, qjobs = ProcessPoolExecutor(max_workers=1), []
+        mkdir(wdir + 'pyphe_quant/')
+        mkdir(wdir + 'qc_images/')
     print('Successfully created directories. Please make sure the scanner is turned on.')
 
     nscans = int(np.ceil(n/float(ppscan)))
@@ -73,24 +191,29 @@ def scan_batch(n, plateStart, prefix, postfix, fixture, resolution, geometries,
             except Exception:
                 print('Invalid input')
 
-        source = 'TPU8x10' if mode=='Gray' else 'Flatbed'
+        raw = acquire_raw_scan(scanner, mode, resolution, '%s%s_rawscan%s_%s.tiff'%(rdir, prefix, i, postfix), keep_raw=keep_raw)
 
-        cmdStr = 'scanimage --source %s --mode %s --resolution %i --format=tiff --device-name=%s > %s%s_rawscan%s_%s.tiff'%(source, mode, resolution, scanner, rdir, prefix, i, postfix)
-        check_output(cmdStr, shell=True)
-
-        for plate in range(ppscan):
-            plateNr = (i-1)*ppscan+plate
-            if plateNr < n:
-                cmdStr = 'convert %s%s_rawscan%s_%s.tiff -crop %s +repage -rotate 90 -flop %s%s_%i_%s.%s'%(rdir, prefix, i, postfix, geometry[plate], wdir, prefix, plateNr+plateStart, postfix, format)
-                check_output(cmdStr, shell=True)
+        nplates = min(ppscan, n-(i-1)*ppscan)
+        out_paths = ['%s%s_%i_%s.%s'%(wdir, prefix, (i-1)*ppscan+plate+plateStart, postfix, format) for plate in range(nplates)]
+        plates = crop_plates(raw, geometry[:nplates], out_paths, decode_saved=quantify_args is not None)
+        
+        if quantify_args is not None:
+            for plate, out_path in zip(plates, out_paths):
+                qjobs.append(submit_quantification(qexecutor, plate, out_path, wdir + 'pyphe_quant/', wdir + 'qc_images/', quantify_args))
 
+    if quantify_args is not None:
+        print('Waiting for quantification to finish')
+        qexecutor.shutdown(wait=True)
+        nfailed = sum(job.exception() is not None for job in qjobs)
+        if nfailed > 0:
+            warn('Quantification failed for %i plates'%nfailed)
 
     print('Done')
     
 
-def scan_timecourse(nscans, interval, prefix, postfix, fixture, resolution, geometries, scanner, mode, format):
+def scan_timecourse(nscans, interval, prefix, postfix, fixture, resolution, geometries, scanner, mode, format, starttime=None, quantify_args=None, keep_raw='full', stop=None):
     '''
-    High-level function for acquiring image timeseries.
+    High-level function for acquiring image timeseries. Scans are started at fixed deadlines (starttime + n*interval) rather than by sleeping for the interval after each scan, so that the time taken by scanning and cropping does not accumulate over the timecourse. The actual start time of each scan is recorded in the scanlog and timepoints files. If quantify_args is given, each plate is quantified in a background process while the next scan proceeds (see submit_quantification()). keep_raw controls how raw scans are retained (see acquire_raw_scan()). If stop (a threading.Event) is given, the timecourse ends early when it is set, before the next scan is started.
     '''
  
     ppscan = len(geometries[fixture])#plates per scan
@@ -99,13 +222,8 @@ def scan_timecourse(nscans, interval, prefix, postfix, fixture, resolution, geom
     geometry = geometries[fixture]
     
     print('Loaded geometry settings for fixture %s: '%fixture + str(geometry))
-    geometry_temp = []
-    for g in geometry:
-        glist = list(map(lambda x: str(int(int(x)*(resolution/600.0))), g.replace('+', 'x').split('x')))
-        geometry_temp.append(glist[0] + 'x' + glist[1] + '+' + glist[2] + '+' + glist[3])
-
-    print('Geometry settings scaled to resolution: ' + str(geometry_temp))
-    geometry = geometry_temp
+    geometry = scale_geometry(geometry, resolution)
+    print('Geometry settings scaled to resolution: ' + str(geometry))
 
     #Create directories
     wdir = '%s_%s/'%(prefix,postfix)
@@ -113,7 +231,12 @@ def scan_timecourse(nscans, interval, prefix, postfix, fixture, resolution, geom
     for q in range(1, ppscan+1):
         mkdir(wdir+'plate_'+str(q))
     rdir = wdir + 'raw_scans/'
-    mkdir(rdir)
+    if keep_raw != 'none':
+        mkdir(rdir)
+    if quantify_args is not None:
+        qexecutor, qjobs = ProcessPoolExecutor(max_workers=1), []
+        mkdir(wdir + 'pyphe_quant/')
+        mkdir(wdir + 'qc_images/')
     
     #Open log
     log = open(wdir+'/scanlog.txt', 'w')
@@ -122,25 +245,78 @@ def scan_timecourse(nscans, interval, prefix, postfix, fixture, resolution, geom
     
     print('Successfully created directories.')
 
-    starttime = datetime.now()
+    if starttime is None:
+        starttime = datetime.now()
     for i in range(1, nscans+1):
-        print('Preparing for scan %i out of %i'%(i,nscans))
-
-        source = 'TPU8x10' if mode=='Gray' else 'Flatbed'
+        #Wait until this scan is due
+        deadline = starttime + timedelta(minutes=interval*(i-1))
+        delay = (deadline - datetime.now()).total_seconds()
+        if delay > 0:
+            if stop is None:
+                time.sleep(delay)
+            else:
+                stop.wait(delay)
+        elif delay < -1:
+            warn('Scanner %s: scan %i is starting %.1f seconds late. Is the interval too short for the scanning resolution?'%(scanner, i, -delay))
+        if stop is not None and stop.is_set():
+            print('Scanner %s: stopping timecourse after %i scans'%(scanner, i-1))
+            log.write(str(datetime.now()) + ' - Timecourse stopped after %i scans\n'%(i-1))
+            break
         
-        cmdStr = 'scanimage --source %s --mode %s --resolution %i --format=tiff --device-name=%s > %s%s_rawscan%i_%s.tiff'%(source, mode, resolution, scanner, rdir, prefix, i, postfix)
-        check_output(cmdStr, shell=True)
+        print('Scanner %s: starting scan %i out of %i'%(scanner, i, nscans))
+        acquired = datetime.now()
+
+        raw = acquire_raw_scan(scanner, mode, resolution, '%s%s_rawscan%i_%s.tiff'%(rdir, prefix, i, postfix), keep_raw=keep_raw)
 
-        for plate in range(ppscan):
-            cmdStr = 'convert %s%s_rawscan%i_%s.tiff -crop %s +repage -rotate 90 -flop %s%s/%s_%i_%s_plate%i.%s'%(rdir, prefix, i, postfix, geometry[plate], wdir, 'plate_'+str(plate+1), prefix, i, postfix, plate+1, format)
-            check_output(cmdStr, shell=True)
+        out_paths = ['%s%s/%s_%i_%s_plate%i.%s'%(wdir, 'plate_'+str(plate+1), prefix, i, postfix, plate+1, format) for plate in range(ppscan)]
+        plates = crop_plates(raw, geometry, out_paths, decode_saved=quantify_args is not None)
+        
+        if quantify_args is not None:
+            for plate, out_path in zip(plates, out_paths):
+                qjobs.append(submit_quantification(qexecutor, plate, out_path, wdir + 'pyphe_quant/', wdir + 'qc_images/', quantify_args))
 
 
-        log.write(str(datetime.now()) + ' - Scan %i completed sucessfully\n'%i)
+        log.write(str(datetime.now()) + ' - Scan %i (started %s) completed sucessfully\n'%(i, str(acquired)))
         log.flush()
-        timepoints.write(str((datetime.now() - starttime).total_seconds()/(60*60.0)) + '\n')
+        timepoints.write(str((acquired - starttime).total_seconds()/(60*60.0)) + '\n')
         timepoints.flush()
-        time.sleep(interval*60)#Convert to seconds
         
     log.close()
     timepoints.close()
+    
+    if quantify_args is not None:
+        print('Scanner %s: waiting for quantification to finish'%scanner)
+        qexecutor.shutdown(wait=True)
+        nfailed = sum(job.exception() is not None for job in qjobs)
+        if nfailed > 0:
+            warn('Scanner %s: quantification failed for %i plates'%(scanner, nfailed))
+
+def scan_timecourse_multi(nscans, interval, prefix, postfix, fixture, resolution, geometries, scanners, mode, format, quantify_args=None, keep_raw='full'):
+    '''
+    Acquire image timeseries on several scanners concurrently. Each scanner is driven by its own thread running scan_timecourse() and writes into its own folder (the scanner number is appended to the postfix). All scanners share the same start time, so the scan deadlines are synchronised across scanners. If a scanner fails, the error is reported immediately, the timecourse is stopped on all other scanners after their current scan and the error is raised.
+    '''
+    
+    starttime = datetime.now()
+    print('Starting timecourse on %i scanners: %s'%(len(scanners), str(scanners)))
+    
+    stop = Event()
+    with ThreadPoolExecutor(max_workers=len(scanners)) as executor:
+        futures = {}
+        for k, scanner in enumerate(scanners, 1):
+            spostfix = '_'.join([p for p in [postfix, 'scanner%i'%k] if p])
+            futures[executor.submit(scan_timecourse, nscans, interval, prefix, spostfix, fixture, resolution, geometries, scanner, mode, format, starttime=starttime, quantify_args=quantify_args, keep_raw=keep_raw, stop=stop)] = scanner
+        
+        #Stop all scanners as soon as one of them fails
+        done, running = wait(futures, return_when=FIRST_EXCEPTION)
+        failed = [f for f in done if f.exception() is not None]
+        for f in failed:
+            print('Scanner %s failed: %s'%(futures[f], str(f.exception())))
+        if failed:
+            print('Stopping timecourse on all other scanners after their current scan')
+            stop.set()
+    
+    #Re-raise the error of the first failed scanner thread
+    if failed:
+        raise failed[0].exception()
+    
+    print('Done')
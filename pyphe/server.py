@@ -0,0 +1,235 @@
+'''
+A long-running pyphe-quantify server. The server loads pyphe and its dependencies once and quantifies images in a pool of worker processes, so that many small quantification jobs do not each pay for starting Python and importing libraries. Jobs are submitted over a local socket (multiprocessing.connection), either with pyphe-quantify-client or from Python:
+
+    results = server.submit_jobs([{'image' : '/data/plate1.jpg', 'grid' : 'auto_1536', 'out' : '/data/pyphe_quant'}])
+
+A job is a dict with the path of the image, the grid (as for pyphe-quantify --grid) and optionally mode (batch or redness, defaults to batch), out and qc folders (qc can be None to skip the qc image), gridTemplate (path of a saved grid template) and any other keyword arguments of quantify.quantify_single_image (t, d, s, negate, store, ...). Paths are interpreted relative to the working directory of the server.
+Messages are pickled, so a client that can connect can run any code as the user running the server. Connections are therefore authenticated with a key: unless a key is given, the server generates a random key when it starts and writes it to a key file which only the user can read (see default_keyfile), and clients on the same computer read the key from this file. The server only listens on loopback addresses unless allow_remote is set.
+The result of each job is a dict with status (ok or error), image, csv (path of the results table, or <store>::<image name> if it was written to a result store, see pyphe.store), colonies (number of colonies found), time (in seconds) and error (the error message if the job failed).
+'''
+
+import os
+import time
+import socket
+import secrets
+import ipaddress
+import threading
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.connection import Listener, Client
+
+default_address = ('localhost', 6060)
+
+
+def parse_address(address):
+    '''Parse an address given as host:port (or just port) into a (host, port) tuple.'''
+    host, _, port = address.rpartition(':')
+    return (host or default_address[0], int(port))
+
+def default_keyfile(address):
+    '''Path of the file the key of a server listening on address is written to, ~/.pyphe/quantify-server_<host>_<port>.key.'''
+    return os.path.join(os.path.expanduser('~'), '.pyphe', 'quantify-server_%s_%i.key'%address)
+
+def write_authkey(keyfile):
+    '''Generate a random key and write it to keyfile, readable and writable by the user only. Returns the key.'''
+    authkey = secrets.token_bytes(32)
+    os.makedirs(os.path.dirname(os.path.abspath(keyfile)), mode=0o700, exist_ok=True)
+    #Write to a new file first, so that clients never read a partly written key
+    tmp = '%s.%i.tmp'%(keyfile, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    os.replace(tmp, keyfile)
+    return authkey
+
+def read_authkey(address=default_address, keyfile=None):
+    '''Read the key of a server from its key file (by default default_keyfile(address)).'''
+    keyfile = keyfile or default_keyfile(address)
+    if not os.path.isfile(keyfile):
+        raise IOError('Key file %s does not exist. Is the server running on %s:%i? Otherwise, pass the key of the server explicitly.'%(keyfile, address[0], address[1]))
+    with open(keyfile, 'rb') as f:
+        return f.read()
+
+def is_loopback(host):
+    '''Whether host resolves to a loopback address, which only accepts connections from the same computer.'''
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (socket.gaierror, ValueError):
+        return False
+
+def _warm_up():
+    '''Import everything needed for quantification once when a worker process starts.'''
+    from pyphe import quantify
+    from skimage.io import imread
+    from matplotlib import pyplot
+
+@lru_cache(maxsize=16)
+def _load_grid_template(path, mtime):
+    from pyphe.quantify import load_grid_template
+    return load_grid_template(path)
+
+def run_job(job):
+    '''
+    Quantify a single image as described by a job dict (see module docstring) and return the result dict. Errors are reported in the result rather than raised.
+    '''
+    from skimage.io import imread
+    from pyphe import quantify
+
+    start = time.perf_counter()
+    result = {'image' : job.get('image'), 'csv' : None, 'colonies' : None, 'error' : None}
+    try:
+        args = dict(job)
+        image_path = args.pop('image')
+        grid, auto = quantify.parse_grid(args.pop('grid'))
+        mode = args.pop('mode', 'batch')
+        args.setdefault('out', 'pyphe_quant')
+        args.setdefault('qc', 'qc_images')
+        if isinstance(args.get('gridTemplate'), str):
+            args['gridTemplate'] = _load_grid_template(args['gridTemplate'], os.path.getmtime(args['gridTemplate']))
+        for folder in [args['out'], args['qc']]:
+            if folder is not None:
+                os.makedirs(folder, exist_ok=True)
+
+        image_name = os.path.basename(image_path)
+        data = quantify.quantify_single_image(imread(image_path), image_name, grid, auto, mode, **args)
+        result['status'] = 'ok'
+        result['colonies'] = len(data.index)
+        if args.get('store') is not None:
+            result['csv'] = args['store'] + '::' + image_name
+        elif args['out'] is not None:
+            result['csv'] = os.path.join(args['out'], image_name+'.csv')
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = '%s: %s'%(type(e).__name__, e)
+    result['time'] = time.perf_counter() - start
+    return result
+
+def serve(address=default_address, authkey=None, workers=None, max_queue=None, keyfile=None, allow_remote=False):
+    '''
+    Run the quantification server until it receives a shutdown command or is interrupted with Ctrl+C. Each client connection is handled in its own thread and jobs are run in a pool of worker processes. At most workers + max_queue jobs are accepted at any time, submitting further jobs blocks until earlier jobs have finished.
+
+    Keyword arguments:
+    address (tuple) -- (host, port) to listen on. Defaults to localhost:6060.
+    authkey (bytes) -- Key which clients need to connect. Defaults to None (a random key is generated and written to keyfile, which is removed when the server stops).
+    workers (int) -- Number of worker processes. Defaults to the number of processors.
+    max_queue (int) -- Number of jobs which can wait for a worker. Defaults to 4*workers.
+    keyfile (str) -- File to write the generated key to. Defaults to default_keyfile(address).
+    allow_remote (bool) -- Allow listening on addresses other than loopback addresses, so that other computers can connect.
+    '''
+
+    if not allow_remote and not is_loopback(address[0]):
+        raise ValueError('Refusing to listen on %s, which accepts connections from other computers. Anyone who can connect to the server can run code as your user, only do this on trusted networks and set allow_remote (--allowRemote).'%address[0])
+    generated = authkey is None
+    if generated:
+        keyfile = keyfile or default_keyfile(address)
+        authkey = write_authkey(keyfile)
+
+    workers = workers or os.cpu_count()
+    max_queue = max_queue if max_queue is not None else 4*workers
+    slots = threading.BoundedSemaphore(workers + max_queue)
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_warm_up)
+    counts = {'submitted' : 0, 'completed' : 0, 'failed' : 0}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def finished(future):
+        slots.release()
+        with lock:
+            failed = (future.exception() is not None) or (future.result()['status'] != 'ok')
+            counts['failed' if failed else 'completed'] += 1
+
+    def handle(conn):
+        with conn:
+            try:
+                request = conn.recv()
+            except EOFError:
+                return
+
+            if request['command'] == 'status':
+                with lock:
+                    conn.send(dict(counts, workers=workers, max_queue=max_queue))
+
+            elif request['command'] == 'shutdown':
+                stop.set()
+                conn.send('ok')
+                #Wake up the main thread waiting for connections
+                Client(address, authkey=authkey).close()
+
+            elif request['command'] == 'quantify':
+                futures = []
+                for job in request['jobs']:
+                    slots.acquire()
+                    with lock:
+                        counts['submitted'] += 1
+                    future = executor.submit(run_job, job)
+                    future.add_done_callback(finished)
+                    futures.append((job, future))
+                for job, future in futures:
+                    try:
+                        conn.send(future.result())
+                    except Exception as e:
+                        conn.send({'image' : job.get('image'), 'status' : 'error', 'csv' : None, 'colonies' : None, 'error' : '%s: %s'%(type(e).__name__, e), 'time' : None})
+
+    listener = Listener(address, authkey=authkey)
+    print('pyphe-quantify server listening on %s:%i with %i workers'%(address[0], address[1], workers))
+    if generated:
+        print('Key for clients written to %s'%keyfile)
+    try:
+        while not stop.is_set():
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                #Failed authentication or connections closed during the handshake
+                print('Refused connection: %s'%str(e))
+                continue
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print('Shutting down, waiting for running jobs to finish')
+        listener.close()
+        executor.shutdown(wait=True)
+        if generated and os.path.isfile(keyfile):
+            os.remove(keyfile)
+    print('Jobs completed: %i, failed: %i'%(counts['completed'], counts['failed']))
+
+def _request(request, address, authkey, keyfile=None):
+    if authkey is None:
+        authkey = read_authkey(address, keyfile)
+    conn = Client(address, authkey=authkey)
+    conn.send(request)
+    return conn
+
+def submit_jobs(jobs, address=default_address, authkey=None, callback=None, keyfile=None):
+    '''
+    Submit jobs to a running server and wait for them to finish.
+
+    Required arguments:
+    jobs (list) -- List of job dicts (see module docstring).
+
+    Keyword arguments:
+    address (tuple) -- (host, port) of the server.
+    authkey (bytes) -- Key of the server. Defaults to None (read from keyfile).
+    callback (function) -- Called with each result as soon as it is received.
+    keyfile (str) -- Key file of the server. Defaults to default_keyfile(address).
+
+    Returns:
+    results (list) -- Result dicts, in the same order as jobs.
+    '''
+    results = []
+    with _request({'command' : 'quantify', 'jobs' : jobs}, address, authkey, keyfile) as conn:
+        for job in jobs:
+            results.append(conn.recv())
+            if callback:
+                callback(results[-1])
+    return results
+
+def server_status(address=default_address, authkey=None, keyfile=None):
+    '''Return the number of submitted, completed and failed jobs and the number of workers of a running server as a dict. The key is read from keyfile unless it is given.'''
+    with _request({'command' : 'status'}, address, authkey, keyfile) as conn:
+        return conn.recv()
+
+def shutdown_server(address=default_address, authkey=None, keyfile=None):
+    '''Ask a running server to shut down after finishing all running jobs. The key is read from keyfile unless it is given.'''
+    with _request({'command' : 'shutdown'}, address, authkey, keyfile) as conn:
+        return conn.recv()
@@ -0,0 +1,143 @@
+'''
+A result store for pyphe-quantify: the results of all images of a screen are written into a single SQLite database instead of one csv file per image, which is much faster to write, copy and read for large screens. Only the Python standard library is required. The store has two tables:
+
+colonies -- The results table of each image, stored column by column: one row per image with the number of colonies and the columns label, row and column (int64) and area, centroid_y, centroid_x, mean_intensity, perimeter and circularity (float64), each as a little-endian binary array. Storing columns as arrays rather than one database row per colony makes writing and reading tables much faster, see read_results.
+images -- One row per image with mode, number of colonies, the threshold used (NULL for local thresholding), the grid fit (grid_rows, grid_columns, grid_x1, grid_y1, grid_x2, grid_y2 and grid_spacing, like a grid definition), timings (stage timings as JSON, if recorded with --timings) and the time the image was written.
+
+Each image is written in a single transaction and images which are quantified again are replaced, so several processes (e.g. the workers of pyphe-quantify-server) can write to the same store at the same time. The database uses write-ahead logging, which requires the store to be on a local file system rather than a network share.
+Results of single images can be referred to as <store path>::<image name> in the Data_path column of the Experimental Design Table of pyphe-analyse.
+'''
+
+import os
+import json
+import sqlite3
+import datetime
+from contextlib import closing
+import numpy as np
+import pandas as pd
+
+colony_columns = [('label', '<i8'), ('row', '<i8'), ('column', '<i8'), ('area', '<f8'), ('centroid_y', '<f8'), ('centroid_x', '<f8'),
+                  ('mean_intensity', '<f8'), ('perimeter', '<f8'), ('circularity', '<f8')]
+image_columns = [('mode', 'TEXT'), ('colonies', 'INTEGER'), ('threshold', 'REAL'), ('grid_rows', 'INTEGER'), ('grid_columns', 'INTEGER'), ('grid_x1', 'REAL'), ('grid_y1', 'REAL'),
+                 ('grid_x2', 'REAL'), ('grid_y2', 'REAL'), ('grid_spacing', 'REAL'), ('timings', 'TEXT'), ('written', 'TEXT')]
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS images ("image" TEXT PRIMARY KEY, %s);
+CREATE TABLE IF NOT EXISTS colonies ("image" TEXT PRIMARY KEY, "n" INTEGER, %s);
+'''%(', '.join('"%s" %s'%c for c in image_columns), ', '.join('"%s" BLOB'%c for c, _ in colony_columns))
+
+_separator = '::'
+
+
+def connect(path, timeout=60.0):
+    '''Open a store, creating it if it does not exist. Writers wait for up to timeout seconds for other writers to finish.'''
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(_schema)
+    return conn
+
+def _quote(columns):
+    return ', '.join('"%s"'%c for c in columns)
+
+def write_results(path, image_name, data, mode='batch', timings=None):
+    '''
+    Write the results table of a single image, as returned by the quantify functions, to a store. Results of an image with the same name already in the store are replaced.
+
+    Required arguments:
+    path (str) -- Path of the store.
+    image_name (str) -- Name of the image.
+    data (DataFrame) -- Results table, indexed by label. The threshold and grid fit are taken from data.attrs (see quantify.assign_to_grid).
+
+    Keyword arguments:
+    mode (str) -- Mode the image was quantified in (batch or redness).
+    timings (dict) -- Wall time of each processing stage of the image (see timing.image_timings).
+    '''
+
+    centroids = np.array(list(data['centroid']), dtype=float).reshape(-1, 2)
+    colonies = {'label' : data.index, 'centroid_y' : centroids[:,0], 'centroid_x' : centroids[:,1]}
+    for c in ['row', 'column', 'area', 'mean_intensity', 'perimeter', 'circularity']:
+        colonies[c] = data[c]
+    colonies = [np.asarray(colonies[c]).astype(dtype).tobytes() for c, dtype in colony_columns]
+    columns = ['image', 'n'] + [c for c, _ in colony_columns]
+
+    attrs = data.attrs
+    image = dict({c : attrs.get(c) for c, _ in image_columns}, mode=mode, colonies=len(data.index), timings=json.dumps(timings) if timings else None,
+                 written=datetime.datetime.now().isoformat(timespec='seconds'))
+
+    with closing(connect(path)) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('INSERT OR REPLACE INTO colonies (%s) VALUES (%s)'%(_quote(columns), ', '.join(['?']*len(columns))), [image_name, len(data.index)] + colonies)
+            conn.execute('INSERT OR REPLACE INTO images ("image", %s) VALUES (?, %s)'%(_quote(image), ', '.join(['?']*len(image))), [image_name] + list(image.values()))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+def read_results(path, images=None):
+    '''
+    Read results tables from a store.
+
+    Required arguments:
+    path (str) -- Path of the store.
+
+    Keyword arguments:
+    images (list) -- Names of the images to read. Defaults to None (all images).
+
+    Returns:
+    results (dict) -- Results tables indexed by label, with the image names as keys. Images which are not in the store are missing.
+    '''
+
+    if not os.path.isfile(path):
+        raise IOError('Result store does not exist: %s'%path)
+    columns = [c for c, _ in colony_columns]
+    query = 'SELECT "image", %s FROM colonies'%_quote(columns)
+    with closing(sqlite3.connect(path)) as conn:
+        if images is None:
+            rows = conn.execute(query + ' ORDER BY "image"').fetchall()
+        else:
+            #Select images with a join rather than a list of query parameters, which is limited in length
+            conn.execute('CREATE TEMP TABLE selected ("image" TEXT PRIMARY KEY)')
+            conn.executemany('INSERT OR IGNORE INTO selected VALUES (?)', [(i,) for i in images])
+            rows = conn.execute(query + ' JOIN selected USING ("image")').fetchall()
+
+    results = {}
+    for row in rows:
+        table = pd.DataFrame({c : np.frombuffer(b, dtype=dtype) for (c, dtype), b in zip(colony_columns, row[1:])})
+        results[row[0]] = table.set_index('label')
+    return results
+
+def list_images(path, conn=None):
+    '''Return the images table of a store as a DataFrame indexed by image name, with the timings of each image as a dict.'''
+    if conn is None:
+        with closing(sqlite3.connect(path)) as conn:
+            return list_images(path, conn=conn)
+    images = pd.read_sql_query('SELECT * FROM images ORDER BY "image"', conn, index_col='image')
+    images['timings'] = images['timings'].map(lambda x: json.loads(x) if x else {})
+    return images
+
+def split_data_path(data_path):
+    '''Split a data path of the form <store path>::<image name> into the store path and image name. Returns None for paths of data files.'''
+    if not isinstance(data_path, str) or _separator not in data_path:
+        return None
+    return tuple(data_path.split(_separator, 1))
+
+def read_data_paths(data_paths):
+    '''
+    Read the results tables of all data paths of the form <store path>::<image name>, reading all images of a store at once. Returns a dict of results tables with the data paths as keys. Other data paths are ignored.
+    '''
+
+    stores = {}
+    for p in data_paths:
+        split = split_data_path(p)
+        if split is not None:
+            stores.setdefault(split[0], []).append(split[1])
+
+    results = {}
+    for store, images in stores.items():
+        tables = read_results(store, images)
+        missing = [i for i in images if i not in tables]
+        if missing:
+            raise KeyError('Images not found in result store %s: %s'%(store, ', '.join(missing)))
+        results.update({store + _separator + i : tables[i] for i in images})
+    return results
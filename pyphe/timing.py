@@ -0,0 +1,137 @@
+'''
+Instrumentation for measuring wall time and peak memory of processing stages, used by pyphe-quantify --timings. Code to be measured is wrapped in a stage:
+
+    with timing.stage('make_mask'):
+        ...
+
+Stages can be nested and nested stages are reported as <outer>/<inner>. Timing is disabled by default and stage() then returns a shared no-op context manager, so the overhead is negligible. Peak memory is measured with tracemalloc (which also traces numpy arrays) and is reported relative to the memory in use when the stage was entered. Measuring peak memory per stage requires Python 3.9 or later, on older versions only wall time is recorded (peak memory is reported as NaN).
+
+Timing is enabled for the whole process and all threads record into the same table. The current image and the stack of open stages are kept per thread, so stages can be recorded from several threads at the same time (e.g. the scanner threads of pyphe-scan-timecourse). However, tracemalloc measures the memory of the whole process, so the peak memory of a stage includes allocations made by other threads while it was running.
+'''
+
+import time
+import threading
+import tracemalloc
+from warnings import warn
+import numpy as np
+import pandas as pd
+
+enabled = False
+records = []
+_local = threading.local()
+
+#tracemalloc.reset_peak() was added in Python 3.9
+_measure_memory = hasattr(tracemalloc, 'reset_peak')
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+class _NullStage():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_stage = _NullStage()
+
+
+class _Stage():
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = _stack()
+        if stack:
+            parent = stack[-1]
+            if _measure_memory:
+                parent.peak = max(parent.peak, tracemalloc.get_traced_memory()[1])
+            self.name = parent.name + '/' + self.name
+        if _measure_memory:
+            tracemalloc.reset_peak()
+            self.mem_start = self.peak = tracemalloc.get_traced_memory()[0]
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall_time = time.perf_counter() - self.start
+        stack = _stack()
+        stack.pop()
+        if _measure_memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+            peak_memory = (self.peak - self.mem_start)/1e6
+        else:
+            peak_memory = np.nan
+        records.append({'image' : getattr(_local, 'image', None), 'stage' : self.name, 'wall_time_s' : wall_time, 'peak_memory_MB' : peak_memory})
+        return False
+
+
+def enable():
+    '''Start recording stages. Starts tracemalloc if it is not running already and peak memory can be measured.'''
+    global enabled
+    enabled = True
+    if not _measure_memory:
+        warn('Measuring peak memory requires Python 3.9 or later, only wall time is recorded.')
+    elif not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    '''Stop recording stages and stop tracemalloc.'''
+    global enabled
+    enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def set_image(name):
+    '''Set the name of the image that subsequent stages in the calling thread are recorded for.'''
+    _local.image = name
+
+def stage(name):
+    '''Return a context manager which records wall time and peak memory of the code it wraps under the given stage name.'''
+    if not enabled:
+        return _null_stage
+    return _Stage(name)
+
+def get_timings():
+    '''
+    Return all recorded stages as a DataFrame with one row per stage and image.
+    '''
+    return pd.DataFrame(records, columns=['image', 'stage', 'wall_time_s', 'peak_memory_MB'])
+
+def image_timings(image):
+    '''
+    Return the total wall time of each stage recorded so far for the given image as a dict. Empty if timing is disabled.
+    '''
+    totals = {}
+    for r in records:
+        if r['image'] == image:
+            totals[r['stage']] = totals.get(r['stage'], 0) + r['wall_time_s']
+    return totals
+
+def summarise(timings=None):
+    '''
+    Summarise recorded stages across images. Returns a DataFrame with the number of images, total and mean wall time and maximum peak memory for each stage, in the order stages were first recorded.
+    '''
+    if timings is None:
+        timings = get_timings()
+    grouped = timings.groupby('stage', sort=False)
+    summary = pd.DataFrame({'n' : grouped['wall_time_s'].count(),
+                            'total_time_s' : grouped['wall_time_s'].sum(),
+                            'mean_time_s' : grouped['wall_time_s'].mean(),
+                            'max_peak_memory_MB' : grouped['peak_memory_MB'].max()})
+    return summary
+
+def report(path):
+    '''
+    Save all recorded stages as csv to path and print a summary table.
+    '''
+    timings = get_timings()
+    timings.to_csv(path)
+    print('Timings saved to %s. Summary:'%path)
+    print(summarise(timings).round(3).to_string())
@@ -15,7 +15,7 @@ setup(name='pyphe',
       license='MIT',
       packages=['pyphe'],
       scripts=['bin/pyphe-scan', 'bin/pyphe-scan-timecourse', 'bin/pyphe-growthcurves', 'bin/pyphe-analyse', 'bin/pyphe-quantify', 'bin/pyphe-interpret',
-      'bin/pyphe-analyse-gui',
+      'bin/pyphe-analyse-gui', 'bin/pyphe-quantify-server', 'bin/pyphe-quantify-client',
       'bin/pyphe-growthcurves.bat', 'bin/pyphe-analyse.bat', 'bin/pyphe-quantify.bat', 'bin/pyphe-interpret.bat',],
       install_requires=[
           'pandas',
@@ -24,7 +24,7 @@ setup(name='pyphe',
           'seaborn',
           'scipy',
           'scikit-image',
-          'scikit-learn'
+          'tifffile'
       ],
       classifiers=[
         "Development Status :: 4 - Beta", 
@@ -0,0 +1,117 @@
+'''
+Tests for pyphe-scan and pyphe-scan-timecourse with the scanimage stub in this folder: plates quantified in the background while scanning give the same results tables as pyphe-quantify run on the cropped plates afterwards, timecourses on several scanners keep to the same scan deadlines, and a failing scanner stops the timecourse on all scanners. Run with python -m pytest test.
+'''
+
+import os
+import sys
+import subprocess
+import time
+from datetime import datetime
+from glob import glob
+
+import pytest
+import tifffile
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(test_dir)
+sys.path.insert(0, repo_dir)
+
+from pyphe import scan
+from pyphe.fixtures import geometries
+from pyphe.quantify import parse_grid
+
+interval = 0.1 #minutes
+
+
+def use_stub(monkeypatch, tmp_path):
+    monkeypatch.setenv('PATH', os.pathsep.join([test_dir, os.environ['PATH']]))
+    monkeypatch.chdir(tmp_path)
+
+def read_scanlog(path):
+    '''Return the start time of each scan recorded in a scanlog.'''
+    with open(path) as f:
+        lines = f.readlines()[1:]
+    return [datetime.fromisoformat(l.split('(started ')[1].split(')')[0]) for l in lines if '(started ' in l]
+
+
+@pytest.mark.parametrize('format', ['jpg', 'tiff'])
+def test_scan_batch_matches_pyphe_quantify(tmp_path, monkeypatch, format):
+    use_stub(monkeypatch, tmp_path)
+    monkeypatch.setattr('builtins.input', lambda prompt: 'y')
+
+    scanner = scan.find_scanner(1)
+    grid, auto = parse_grid('auto_1536')
+    quantify_args = {'grid':grid, 'auto':auto, 'mode':'batch', 't':1, 'd':2, 's':0.2}
+    scan.scan_batch(2, 1, 'stub', 'test', 'som3', 600, geometries, scanner, 'Gray', format, quantify_args=quantify_args, keep_raw='none')
+
+    wdir = tmp_path / 'stub_test'
+    assert not os.path.exists(str(wdir / 'raw_scans'))
+    plates = sorted(glob(str(wdir / ('*.' + format))))
+    assert [os.path.basename(p) for p in plates] == ['stub_1_test.' + format, 'stub_2_test.' + format]
+
+    #Results of the background quantification can be reproduced from the saved (for jpg, lossy) plates
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([repo_dir, os.environ.get('PYTHONPATH', '')]), MPLBACKEND='Agg')
+    subprocess.run([sys.executable, os.path.join(repo_dir, 'bin', 'pyphe-quantify'), 'batch', '--grid', 'auto_1536', '--pattern', str(wdir / ('*.' + format)),
+                    '--out', str(tmp_path / 'cli_quant'), '--qc', str(tmp_path / 'cli_qc'), '--t', '1', '--d', '2', '--s', '0.2'],
+                   env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    for p in plates:
+        name = os.path.basename(p) + '.csv'
+        with open(str(wdir / 'pyphe_quant' / name), 'rb') as f, open(str(tmp_path / 'cli_quant' / name), 'rb') as g:
+            assert f.read() == g.read()
+
+@pytest.mark.parametrize('spool_size', [2**30, 1024])
+def test_acquire_raw_scan_streamed(tmp_path, monkeypatch, spool_size):
+    use_stub(monkeypatch, tmp_path)
+    monkeypatch.setattr(scan, 'spool_size', spool_size)
+    full = scan.acquire_raw_scan('pyphe-stub:0', 'Gray', 600, str(tmp_path / 'full.tiff'), keep_raw='full')
+    raw = scan.acquire_raw_scan('pyphe-stub:0', 'Gray', 600, str(tmp_path / 'compressed.tiff'), keep_raw='compressed')
+    assert (raw == tifffile.imread(full)).all()
+    assert (raw == tifffile.imread(str(tmp_path / 'compressed.tiff'))).all()
+
+def test_acquire_raw_scan_checks_keep_raw(tmp_path, monkeypatch):
+    use_stub(monkeypatch, tmp_path)
+    #keep_raw is checked before scanning, so the missing scanner is never used
+    with pytest.raises(ValueError):
+        scan.acquire_raw_scan('pyphe-stub:missing', 'Gray', 600, str(tmp_path / 'raw.tiff'), keep_raw='zip')
+    with pytest.raises(subprocess.CalledProcessError):
+        scan.acquire_raw_scan('pyphe-stub:missing', 'Gray', 600, str(tmp_path / 'raw.tiff'), keep_raw='none')
+
+def test_scan_timecourse_multi_keeps_deadlines(tmp_path, monkeypatch):
+    use_stub(monkeypatch, tmp_path)
+    scanners = scan.find_scanners()
+    assert scanners == ['pyphe-stub:0', 'pyphe-stub:1']
+    scan.scan_timecourse_multi(3, interval, 'stub', 'test', 'som3', 600, geometries, scanners, 'Gray', 'tiff', keep_raw='none')
+
+    starts = []
+    for k in [1, 2]:
+        wdir = tmp_path / ('stub_test_scanner%i'%k)
+        assert not os.path.exists(str(wdir / 'raw_scans'))
+        for q in range(1, 5):
+            assert sorted(os.listdir(str(wdir / ('plate_%i'%q)))) == ['stub_%i_test_scanner%i_plate%i.tiff'%(i, k, q) for i in range(1, 4)]
+
+        #Scans start at fixed deadlines, starttime + n*interval, recorded in hours in timepoints.txt
+        with open(str(wdir / 'timepoints.txt')) as f:
+            timepoints = [float(l)*60 for l in f]
+        assert timepoints == pytest.approx([0, interval, 2*interval], abs=1/60.0)
+
+        #The scanlog records the same start times
+        started = read_scanlog(str(wdir / 'scanlog.txt'))
+        assert len(started) == 3
+        assert [(s - started[0]).total_seconds()/60 for s in started] == pytest.approx([t - timepoints[0] for t in timepoints], abs=0.01/60)
+        starts.append(started)
+
+    #Both scanners share the same deadlines
+    for s1, s2 in zip(*starts):
+        assert abs((s1 - s2).total_seconds()) < 1
+
+def test_scan_timecourse_multi_stops_on_failed_scanner(tmp_path, monkeypatch):
+    use_stub(monkeypatch, tmp_path)
+    start = time.time()
+    with pytest.raises(subprocess.CalledProcessError):
+        scan.scan_timecourse_multi(100, interval, 'stub', 'test', 'som3', 600, geometries, ['pyphe-stub:0', 'pyphe-stub:missing'], 'Gray', 'tiff', keep_raw='none')
+    #The working scanner is stopped after its current scan rather than running all 100 scans
+    assert time.time() - start < 10*60*interval
+    with open(str(tmp_path / 'stub_test_scanner1' / 'timepoints.txt')) as f:
+        assert len(f.readlines()) == 1
+    with open(str(tmp_path / 'stub_test_scanner1' / 'scanlog.txt')) as f:
+        assert 'Timecourse stopped after 1 scans' in f.read()
@@ -0,0 +1,68 @@
+'''
+Tests for pyphe-quantify-server: an image quantified through the server gives the same results table as pyphe-quantify, clients need the key written by the server, and the server stops on request. Run with python -m pytest test.
+'''
+
+import os
+import sys
+import socket
+import subprocess
+import time
+from multiprocessing import AuthenticationError
+
+import pytest
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(test_dir)
+sys.path.insert(0, repo_dir)
+
+from pyphe import server
+
+image = os.path.join(test_dir, 'images', 'p1_53.jpg')
+quantify_args = ['--s', '0.2', '--d', '2']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def test_server_matches_pyphe_quantify(tmp_path):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([repo_dir, os.environ.get('PYTHONPATH', '')]), MPLBACKEND='Agg')
+    address = ('localhost', free_port())
+    keyfile = str(tmp_path / 'server.key')
+    proc = subprocess.Popen([sys.executable, os.path.join(repo_dir, 'bin', 'pyphe-quantify-server'), '--address', '%s:%i'%address, '--workers', '1', '--keyfile', keyfile],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        #Wait for the server to write its key and accept connections
+        for i in range(300):
+            try:
+                server.server_status(address, keyfile=keyfile)
+                break
+            except OSError:
+                assert proc.poll() is None, 'Server exited while starting'
+                time.sleep(0.1)
+        assert os.stat(keyfile).st_mode & 0o777 == 0o600
+
+        with pytest.raises(AuthenticationError):
+            server.server_status(address, authkey=b'pyphe')
+
+        job = {'image' : image, 'grid' : 'auto_1536', 's' : 0.2, 'd' : 2, 'out' : str(tmp_path / 'server_quant'), 'qc' : None}
+        results = server.submit_jobs([job], address, keyfile=keyfile)
+        assert results[0]['status'] == 'ok', results[0]['error']
+
+        subprocess.run([sys.executable, os.path.join(repo_dir, 'bin', 'pyphe-quantify'), 'batch', '--grid', 'auto_1536', '--pattern', image,
+                        '--out', str(tmp_path / 'cli_quant'), '--qc', str(tmp_path / 'cli_qc')] + quantify_args,
+                       env=env, cwd=str(tmp_path), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        with open(results[0]['csv'], 'rb') as f, open(str(tmp_path / 'cli_quant' / 'p1_53.jpg.csv'), 'rb') as g:
+            assert f.read() == g.read()
+
+        server.shutdown_server(address, keyfile=keyfile)
+        assert proc.wait(timeout=120) == 0
+        assert not os.path.exists(keyfile)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+
+def test_server_refuses_remote_address():
+    with pytest.raises(ValueError):
+        server.serve(('0.0.0.0', free_port()), workers=1)
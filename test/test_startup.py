@@ -0,0 +1,37 @@
+'''
+Tests for start-up time of the command line tools: --help works without importing the analysis libraries, and importing the pyphe modules does not import plotting or statistics libraries, which are only imported when they are needed. Run with python -m pytest test.
+'''
+
+import os
+import sys
+import subprocess
+
+import pytest
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(test_dir)
+
+scripts = ['pyphe-analyse', 'pyphe-growthcurves', 'pyphe-interpret', 'pyphe-quantify', 'pyphe-quantify-client', 'pyphe-quantify-server', 'pyphe-scan', 'pyphe-scan-timecourse']
+slow_modules = ['matplotlib.pyplot', 'seaborn', 'statsmodels']
+
+
+def run_python(args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([repo_dir, os.environ.get('PYTHONPATH', '')]))
+    return subprocess.run([sys.executable] + args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+@pytest.mark.parametrize('script', scripts)
+def test_help_does_not_import_libraries(script):
+    #-X importtime lists every module imported on stderr
+    result = run_python(['-X', 'importtime', os.path.join(repo_dir, 'bin', script), '--help'])
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.startswith('usage: ')
+    imported = set(l.split('|')[-1].strip() for l in result.stderr.splitlines() if l.startswith('import time:'))
+    assert not imported & set(slow_modules + ['pandas', 'scipy', 'skimage'])
+
+def test_import_does_not_import_slow_modules():
+    result = run_python(['-c', 'import sys, pyphe.quantify, pyphe.analysis, pyphe.interpret; print(" ".join(sys.modules))'])
+    assert result.returncode == 0, result.stderr
+    imported = set(result.stdout.split())
+    assert 'pyphe.quantify' in imported
+    for m in slow_modules:
+        assert m not in imported